@@ -102,6 +102,16 @@ async function fetchWithTimeout(resource, options = {}) {
   return response;
 }
 
+// gzip the request body, if the browser supports CompressionStream
+async function compressBody(text) {
+  if (typeof CompressionStream === 'undefined') {
+    return null;
+  }
+
+  const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+  return await new Response(stream).arrayBuffer();
+}
+
 async function postData(url = '', token = null, data = {}) {
 
     headers = new Headers({
@@ -112,7 +122,15 @@ async function postData(url = '', token = null, data = {}) {
       headers.set('Authorization', 'Bearer ' + token);
     }
 
+    let body = JSON.stringify(data);
+
     try {
+      const compressedBody = await compressBody(body);
+      if (compressedBody) {
+        headers.set('Content-Encoding', 'gzip');
+        body = compressedBody;
+      }
+
       const response = await fetchWithTimeout(url, {
         timeout: 6000,
         // Default options are marked with *
@@ -123,7 +141,7 @@ async function postData(url = '', token = null, data = {}) {
         headers: headers,
         redirect: 'follow', // manual, *follow, error
         referrerPolicy: 'no-referrer', // no-referrer, *no-referrer-when-downgrade, origin, origin-when-cross-origin, same-origin, strict-origin, strict-origin-when-cross-origin, unsafe-url
-        body: JSON.stringify(data) // body data type must match "Content-Type" header
+        body: body // body data type must match "Content-Type" header
       });
       const answer = await response.json();
       cleanup_buffer();
@@ -5,15 +5,17 @@ import tempfile
 import datetime
 import fs
 import fs.errors
-from flask import Blueprint, render_template, abort, url_for, send_file
+from flask import Blueprint, render_template, abort, url_for, send_file, request
 from flask import current_app as app
 from flask_login import login_required, current_user
 from pathlib import Path
 import project.thumbnailer
+from PIL import Image
 
 import urllib.parse
 
 from project.middleware.storages import Storages, normalize_path
+from project.server.renditions import Rendition
 from project.server.tools.cache import cache
 
 import project.server.tools.directory
@@ -114,6 +116,11 @@ def index(name, path):
 @login_required
 def thumbnail(storage_name, path):
 
+    try:
+        rendition = Rendition.from_request(request)
+    except ValueError:
+        abort(400)
+
     storage_location = Storages.location(
         name=storage_name,
         path=normalize_path(urllib.parse.unquote(path))
@@ -121,7 +128,8 @@ def thumbnail(storage_name, path):
 
     filesystem = fs.open_fs(storage_location.storage.fs_identifier)
 
-    cache_entry = cache.get(str(storage_location.path), extension='.png')
+    #   Every rendition has its own cache entry
+    cache_entry = cache.get('{!s} {}'.format(storage_location.path, rendition.key), extension=rendition.extension)
 
     print('{!r} maps to cache {!r}'.format(storage_location.path, cache_entry))
 
@@ -154,16 +162,20 @@ def thumbnail(storage_name, path):
 
         thumbnailer = project.thumbnailer.Thumbnailer(
             mode=project.thumbnailer.Season.CENTERED,
-            size=(256, 256),
+            size=(rendition.pixels, rendition.pixels),
         )
 
-        cache_file = cache_entry.open('wb+')
-        thumbnailer.thumbnail(file_input=temporary_file_name, file_output=cache_file)
-        cache_file.close()
+        with Image.open(temporary_file_name) as image:
+            data = rendition.render(thumbnailer.thumbnail(image=image))
+
+        with cache_entry.open('wb+') as cache_file:
+            cache_file.write(data)
 
         Path(temporary_file_name).unlink()
 
-    return send_file(cache_entry.path, mimetype='image/jpeg')
+    response = send_file(cache_entry.path, mimetype=rendition.mimetype)
+    response.vary.add('Accept')
+    return response
 
 
 @gallery_blueprint.route('/entry/<name>/<path:path>')
@@ -1,23 +1,37 @@
+import base64
 import datetime
 import json
 import logging
 import urllib.parse
 import uuid
-from pathlib import Path
+from http import HTTPStatus
 import io
-from subprocess import Popen, PIPE
 
-
-from diskcache import Cache
-from flask import Blueprint, current_app, send_file, make_response, \
-    jsonify
+from flask import Blueprint, send_file, make_response, \
+    jsonify, Response, stream_with_context
 from flask import url_for, render_template, request
 from flask_login import login_required, current_user
+from requests import RequestException
 
-from project.server.link import factory, LinkType
+from project.server.link import HOSTERS, Link, LinkType
 
+from project.server.conditional import conditional_response, response_cache
 from project.server.database import db
-from project.server.models import Hit, Order, Archive
+from project.server.export import export_hits, parse_since, \
+    EXPORT_FORMATS, EXPORT_MIMETYPES
+from project.server.ingest import store_hits, validate_hits, import_hits, \
+    IMPORT_FORMATS, IMPORT_CHUNK_SIZE
+from project.server import rollups
+from project.server.models import Hit, Order, Archive, Generation
+from project.server.prefetch import thumbnail_prefetcher
+from project.server.renditions import Rendition
+from project.server.search import search_hits
+from project.server.sprites import SpriteLayout, render_sprite, MAXIMAL_SPRITE_IDS
+from project.server.spool import spool
+from project.server.identity import identity_cache
+from project.server.token_cache import token_cache
+from project.server.tools.cache import thumbnail_cache
+from project.server.video_index import video_index
 
 
 logger = logging.getLogger()
@@ -38,22 +52,12 @@ hits_blueprint = Blueprint(
 )
 
 
-def sad(youtube_id: str):
-
-    command = [
-        'bin/yi.py',
-        '.',
-        '--output-format=json',
-        '-s',
-        youtube_id
-    ]
-
-    logger.debug('Starting my youtube lookup: {}'.format(' '.join(command)))
-
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-
-    return len(stdout) > 0
+def archived_links(links):
+    """
+    Resolves the archive state of all video links of a page at once.
+    Returns the set of `(source, name)` pairs that are in our archive.
+    """
+    return Archive.resolve(link.archive() for link in links if link.video_id)
 
 
 @hits_blueprint.route('/collection', methods=['POST'])
@@ -77,21 +81,24 @@ def store():
             }
             return make_response(jsonify(d), 200)
 
-        for r in data['hits']:
+        message = validate_hits(data['hits'])
+        if message:
+            d = {
+                'status': 'ERROR',
+                'message': message,
+            }
+            return make_response(jsonify(d), 200)
+
+        if spool.accepts():
+            spool.append(data['hits'])
 
-            hit = db.session.query(Hit).filter(Hit.url == r['url']).one_or_none()
+            d = {
+                'status': 'OK',
+                'spooled': len(data['hits']),
+            }
+            return make_response(jsonify(d), HTTPStatus.ACCEPTED)
 
-            if hit:
-                hit.visited += 1
-                hit.mtime = datetime.datetime.fromtimestamp(int(r['timestamp_ms']) / 1000)
-            else:
-                hit = Hit(
-                    url=r['url'],
-                    mtime=datetime.datetime.fromtimestamp(int(r['timestamp_ms']) / 1000),
-                    title=r['title'],
-                    visited=1,
-                )
-                db.session.add(hit)
+        store_hits(data['hits'])
 
         db.session.commit()
 
@@ -100,26 +107,224 @@ def store():
     }
 
 
+@hits_blueprint.route('/import', methods=['POST'])
+@login_required
+def bulk_import():
+    """
+    Streams a hit dump from the request body into `hits`:
+
+        curl -H 'Content-Type: application/x-ndjson' --data-binary @hits.ndjson .../hits/import
+    """
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'tsv' if request.mimetype == 'text/tab-separated-values' else 'ndjson'
+
+    if fmt not in IMPORT_FORMATS:
+        d = {
+            'status': 'ERROR',
+            'message': "Unknown format '{}'".format(fmt),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    chunk_size = request.args.get('chunk_size', default=IMPORT_CHUNK_SIZE, type=int)
+
+    def progress(state):
+        logger.info('Import: {} lines, {} hits, {:.1f} hits/s'.format(
+            state.lines, state.result.received, state.rate))
+
+    state = import_hits(request.stream, fmt=fmt, chunk_size=max(1, chunk_size), progress=progress)
+
+    return jsonify(status='OK', progress=state.as_json())
+
+
+@hits_blueprint.route('/export')
+@login_required
+def export():
+    """
+    Streams all hits, archived ones included, oldest first, as NDJSON
+    (default) or CSV:
+
+        curl --compressed '.../hits/export?format=csv&since=2024-01-01T00:00:00'
+
+    `since` (ISO 8601 or milliseconds) exports only the hits visited after
+    then. Clients that accept gzip get the stream compressed.
+    """
+    fmt = request.args.get('format', default='ndjson')
+    if fmt not in EXPORT_FORMATS:
+        d = {
+            'status': 'ERROR',
+            'message': "Unknown format '{}'".format(fmt),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    since = None
+    if request.args.get('since'):
+        try:
+            since = parse_since(request.args['since'])
+        except ValueError:
+            d = {
+                'status': 'ERROR',
+                'message': "Invalid 'since', expected ISO 8601 or milliseconds",
+            }
+            return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    gzip = request.accept_encodings['gzip'] > 0
+
+    response = Response(
+        stream_with_context(export_hits(fmt=fmt, since=since, gzip=gzip)),
+        mimetype=EXPORT_MIMETYPES[fmt],
+    )
+    response.headers['Content-Disposition'] = 'attachment; filename=hits.{}'.format(fmt)
+    response.vary.add('Accept-Encoding')
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+#   Seconds a browser may show a placeholder before it asks again
+PLACEHOLDER_MAX_AGE = 60 * 60
+
+
 @hits_blueprint.route('/thumbnail/<hit_id>')
 @login_required
 def thumbnail(hit_id):
 
+    """
+    The thumbnail of a hit, `?size=128|256|512&scale=1|2`. The format
+    (WebP, JPEG or PNG) follows the `Accept` header.
+    """
+    try:
+        rendition = Rendition.from_request(request)
+    except ValueError as e:
+        d = {
+            'status': 'ERROR',
+            'message': str(e),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
     hit = db.session.query(Hit).filter(Hit.id == hit_id).one_or_none()
 
     if hit is None:
-        return
+        return placeholder(HTTPStatus.NOT_FOUND)
 
-    cache_directory = Path(current_app.instance_path).parent
-    cache = Cache(cache_directory / '.cache')
+    link = hit.link
 
-    link = factory(hit.url)
-    thumbnail_image_stream = link.thumbnail_image_stream(cache)
-    cache.close()
+    try:
+        thumbnail_image_stream = link.thumbnail_image_stream(thumbnail_cache.handle(), rendition)
+    except RequestException:
+        #   Maybe better next time, so don't let the browser keep it
+        return placeholder(max_age=0)
 
     if not thumbnail_image_stream:
-        return
+        return placeholder()
+
+    response = send_file(thumbnail_image_stream, mimetype=rendition.mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def placeholder(status=HTTPStatus.OK, max_age=PLACEHOLDER_MAX_AGE):
+    response = send_file(Link.placeholder_stream(), mimetype='image/jpeg', max_age=max_age)
+    response.status_code = status
+    response.headers['X-Thumbnail'] = 'placeholder'
+    return response
+
 
-    return send_file(thumbnail_image_stream, mimetype='image/jpg')
+#   CSS pixels of a thumbnail on the dashboard
+DASHBOARD_THUMBNAIL_SIZE = 128
+
+
+def sprite_request():
+    """The layout and rendition of `?ids=1,2,3&size=<px>&scale=<1|2>`, raises ValueError"""
+    ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+
+    if not ids:
+        raise ValueError("Expected a list of hit IDs in 'ids'")
+    if len(ids) > MAXIMAL_SPRITE_IDS:
+        raise ValueError("Too many IDs (maximal {})".format(MAXIMAL_SPRITE_IDS))
+
+    rendition = Rendition.from_request(request, default_size=DASHBOARD_THUMBNAIL_SIZE)
+
+    return SpriteLayout(ids, rendition.size, rendition.scale), rendition
+
+
+@hits_blueprint.route('/sprite')
+@login_required
+def sprite():
+    """
+    The thumbnails of many hits in one image, `?ids=1,2,3&size=&scale=`.
+    `/hits/sprite.json` with the same arguments tells where each one is.
+    """
+    try:
+        layout, rendition = sprite_request()
+    except ValueError as e:
+        d = {
+            'status': 'ERROR',
+            'message': str(e),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    hits = db.session.query(Hit).filter(Hit.id.in_(layout.ids)).all()
+    links = {hit.id: hit.link for hit in hits}
+
+    data = render_sprite(layout, links, thumbnail_cache.handle(), rendition)
+
+    response = send_file(io.BytesIO(data), mimetype=rendition.mimetype, max_age=PLACEHOLDER_MAX_AGE)
+    response.vary.add('Accept')
+    return response
+
+
+@hits_blueprint.route('/sprite.json')
+@login_required
+def sprite_map():
+    try:
+        layout, rendition = sprite_request()
+    except ValueError as e:
+        d = {
+            'status': 'ERROR',
+            'message': str(e),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    ids = ','.join(map(str, layout.ids))
+
+    return jsonify(
+        sprite=url_for('.sprite', ids=ids, size=layout.size),
+        sprite_2x=url_for('.sprite', ids=ids, size=layout.size, scale=2),
+        **layout.as_json(),
+    )
+
+
+def hit_statuses(hits):
+    """
+    Computes the download status of many hits with one archive query and
+    the shared video index. Returns a dict hit id -> status.
+    """
+    links = [hit.link for hit in hits]
+    archived = archived_links(links)
+
+    statuses = {}
+
+    for hit, link in zip(hits, links):
+        #   We know the following states:
+        #   1) Unknown kind of link
+        #   2) A video link that was already downloaded
+        #   3) A video link that can be downloaded
+        json_hit = {
+            'status': '?',
+        }
+
+        if link.video_id:
+            if link.archive() in archived or video_index.contains(link.video_id):
+                json_hit['status'] = 'was-downloaded'
+            else:
+                json_hit['status'] = 'can-be-downloaded'
+                json_hit['download_url'] = url_for('hits.download', hit_id=hit.id)
+
+        statuses[hit.id] = json_hit
+
+    return statuses
 
 
 @hits_blueprint.route('/status/<hit_id>')
@@ -131,31 +336,51 @@ def status(hit_id):
     if hit is None:
         return jsonify(status={'code': '?'})
 
-    #   We know the following states:
-    #   1) Unknown kind of link
-    #   2) A video link that was already downloaded
-    #   3) A video link that can be downloaded
-    json_hit = {
-        'status': '?',
-    }
+    return jsonify(hit=hit_statuses([hit])[hit.id])
 
-    link = factory(hit.url)
-    if link.video_id:
 
-        archive_source, archive_name = link.archive()
+#   More IDs than a dashboard page shows make no sense here
+MAXIMAL_STATUS_IDS = 100
 
-        archive = db.session.query(Archive).where(
-            Archive.source == archive_source,
-            Archive.name == archive_name,
-        ).one_or_none()
 
-        if archive or sad(link.video_id):
-            json_hit['status'] = 'was-downloaded'
-        else:
-            json_hit['status'] = 'can-be-downloaded'
-            json_hit['download_url'] = url_for('hits.download', hit_id=hit.id)
+@hits_blueprint.route('/status', methods=['GET', 'POST'])
+@login_required
+def statuses():
+    """
+    Status of many hits in one request, either `GET /hits/status?ids=1,2,3`
+    or `POST /hits/status` with `{"ids": [1, 2, 3]}`. Unknown IDs are
+    missing in the answer.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        ids = data.get('ids') if isinstance(data, dict) else None
+        if not isinstance(ids, list):
+            ids = None
+    else:
+        ids = request.args.get('ids', '').split(',')
+
+    try:
+        ids = {int(i) for i in ids if str(i).strip()}
+    except (TypeError, ValueError):
+        ids = None
+
+    if ids is None:
+        d = {
+            'status': 'ERROR',
+            'message': "Expected a list of hit IDs in 'ids'",
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    if len(ids) > MAXIMAL_STATUS_IDS:
+        d = {
+            'status': 'ERROR',
+            'message': "Too many IDs (maximal {})".format(MAXIMAL_STATUS_IDS),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    hits = db.session.query(Hit).filter(Hit.id.in_(ids)).all()
 
-    return jsonify(hit=json_hit)
+    return jsonify(hits={str(hit_id): json_hit for hit_id, json_hit in hit_statuses(hits).items()})
 
 
 @hits_blueprint.route('/download/<hit_id>', methods=['POST'])
@@ -170,7 +395,7 @@ def download(hit_id):
     order_uuid = uuid.uuid4()
     registered_on = datetime.datetime.now()
 
-    link = factory(hit.url)
+    link = hit.link
     if link.video_id:
         order = Order(
             registered_on=registered_on,
@@ -195,111 +420,188 @@ def download(hit_id):
     return jsonify(status={'text': 'Starting Download...'})
 
 
-@hits_blueprint.route('/current')
+#   Default and maximal number of rows of /hits/videos/unarchived
+UNARCHIVED_LIMITS = (100, 1000)
+
+
+@hits_blueprint.route('/videos/unarchived')
 @login_required
-def current():
+def unarchived_videos():
+    """The latest video hits that aren't in our archive, `?hoster=youtube&limit=<n>`"""
+    hoster = request.args.get('hoster', default='youtube')
+    if hoster not in HOSTERS:
+        d = {
+            'status': 'ERROR',
+            'message': "Unknown hoster '{}'".format(hoster),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
 
-    maximal_hits = 10
+    default_limit, maximal_limit = UNARCHIVED_LIMITS
+    limit = min(max(1, request.args.get('limit', default=default_limit, type=int)), maximal_limit)
 
-    json_rows = []
+    videos = []
+    for row in Hit.unarchived_videos(hoster, limit):
+        videos.append({
+            'id': row.id,
+            'title': row.title,
+            'mtime': row.mtime.strftime("%Y-%m-%d %H:%M:%S"),
+            'link': row.url,
+            'video_id': row.video_id,
+            'url': url_for('.download', _external=True, hit_id=row.id),
+        })
 
-    with db.engine.begin() as con:
+    return jsonify(hoster=hoster, videos=videos)
 
-        ids = []
 
-        rs = con.exec_driver_sql(
-                'SELECT MIN(id) FROM hits GROUP BY url ORDER BY mtime DESC LIMIT ? OFFSET ?', (maximal_hits, 0))
-        for row in rs:
-            ids.append(row[0])
+def view_key():
+    """What a cached listing depends on besides the generations"""
+    return current_user.get_id(), request.full_path
 
-        objects_rows = db.session.query(Hit).\
-            filter(Hit.id.in_(ids)).\
-            order_by(Hit.mtime.desc()).all()
 
-        logger.error(objects_rows)
+@hits_blueprint.route('/current')
+@login_required
+def current():
+    return conditional_response(view_key(), (Generation.HITS, Generation.ARCHIVE), build_current)
 
-        for row in objects_rows:
 
-            archive = None
+def build_current():
 
-            link = factory(row.url)
-            if link.video_id:
-                archive_source, archive_name = link.archive()
+    maximal_hits = 10
 
-                archive = db.session.query(Archive).where(
-                    Archive.source == archive_source,
-                    Archive.name == archive_name,
-                ).one_or_none()
+    json_rows = []
 
-            json_rows.append({
-                'id': row.id,
-                'title': row.title,
-                'mtime': row.mtime.strftime("%Y-%m-%d %H:%M:%S"),
-                'link': row.url,
-                'url': url_for('.download', _external=True, hit_id=row.id),
-                'archive': True if archive else False,
-            })
+    objects_rows = Hit.latest(limit=maximal_hits)
+
+    links = [row.link for row in objects_rows]
+    archived = archived_links(links)
+
+    for row, link in zip(objects_rows, links):
+
+        json_rows.append({
+            'id': row.id,
+            'title': row.title,
+            'mtime': row.mtime.strftime("%Y-%m-%d %H:%M:%S"),
+            'link': row.url,
+            'url': url_for('.download', _external=True, hit_id=row.id),
+            'archive': link.video_id is not None and link.archive() in archived,
+        })
 
     return jsonify(queue=json_rows)
 
 
 class Page:
-    def __init__(self, offset):
-        self.offset = offset
-        self.limit = 20
+    """
+    One page of the dashboard, addressed by an opaque cursor instead of an
+    offset. A cursor encodes the (mtime, id) key of the row the page starts
+    after (`direction='after'`, older rows) or before (`'before'`, newer
+    rows), see `Hit.latest()`.
+    """
+    limit = 20
+
+    def __init__(self, cursor=None, direction='after'):
+        self.direction = direction
+        self.key = Page.decode_cursor(cursor)
+
+        if self.key is None:
+            self.direction = 'after'
+
+        #   Fetch one row more than needed to know if there is another page
+        if self.direction == 'before':
+            rows = Hit.latest(limit=self.limit + 1, before=self.key)
+
+            if len(rows) > self.limit:
+                self.has_prev = True
+                self.has_next = True
+                self.rows = rows[-self.limit:]
+                return
+
+            #   We reached the newest rows, that's simply the first page
+            self.key = None
+
+        rows = Hit.latest(limit=self.limit + 1, after=self.key)
+        self.has_prev = self.key is not None
+        self.has_next = len(rows) > self.limit
+        self.rows = rows[:self.limit]
+
+    @staticmethod
+    def encode_cursor(hit):
+        data = json.dumps([hit.mtime.isoformat(), hit.id]).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        if not cursor:
+            return None
+
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            mtime, hit_id = json.loads(data)
+            return datetime.datetime.fromisoformat(mtime), int(hit_id)
+        except (ValueError, TypeError):
+            return None
 
     @property
-    def valid(self):
-        if self.offset >= 0:
-            return True
-
-        return False
+    def prev_cursor(self):
+        if not self.rows:
+            return None
+        return Page.encode_cursor(self.rows[0])
 
-    def prev(self):
-        return Page(offset=self.offset-self.limit)
-
-    def next(self):
-        return Page(offset=self.offset+self.limit)
+    @property
+    def next_cursor(self):
+        if not self.rows:
+            return None
+        return Page.encode_cursor(self.rows[-1])
 
 
 @hits_blueprint.route('/dashboard')
 @login_required
 def dashboard():
+    return conditional_response(view_key(), (Generation.HITS,), build_dashboard)
 
-    # https://medium.com/@pgjones/an-asyncio-socket-tutorial-5e6f3308b8b0
-    ids = []
 
-    sql_offset = request.args.get("offset", default=0, type=int)
+def build_dashboard():
 
-    page = Page(sql_offset)
+    # https://medium.com/@pgjones/an-asyncio-socket-tutorial-5e6f3308b8b0
+    if 'before' in request.args:
+        page = Page(request.args.get('before'), direction='before')
+    else:
+        page = Page(request.args.get('after'), direction='after')
 
     navigation = {
         'left': {
-            'disabled': not page.prev().valid,
-            'url': url_for('.dashboard', offset=page.prev().offset),
+            'disabled': not page.has_prev,
+            'url': url_for('.dashboard', before=page.prev_cursor),
+            'cursor': page.prev_cursor,
         },
         'right': {
-            'disabled': not page.next().valid,
-            'url': url_for('.dashboard', offset=page.next().offset),
+            'disabled': not page.has_next,
+            'url': url_for('.dashboard', after=page.next_cursor),
+            'cursor': page.next_cursor,
         }
     }
 
-    with db.engine.begin() as con:
-
-        rs = con.exec_driver_sql(
-                'SELECT MIN(id) FROM hits GROUP BY url ORDER BY mtime DESC LIMIT ? OFFSET ?', (page.limit, page.offset))
-        for row in rs:
-            ids.append(row[0])
-
-        objects_rows = db.session.query(Hit).\
-            filter(Hit.id.in_(ids)).\
-            order_by(Hit.mtime.desc()).all()
+    objects_rows = page.rows
+
+    #   One sprite for all thumbnails of the page
+    links = {row.id: row.link for row in objects_rows}
+    layout = SpriteLayout([hit_id for hit_id, link in links.items() if link.kind == LinkType.VIDEO],
+                          DASHBOARD_THUMBNAIL_SIZE)
+    tiles = layout.tiles()
+
+    sprite_ids = ','.join(map(str, layout.ids))
+    sprite = {
+        'url': url_for('hits.sprite', ids=sprite_ids, size=layout.size),
+        'url_2x': url_for('hits.sprite', ids=sprite_ids, size=layout.size, scale=2),
+        'width': layout.width,
+        'height': layout.height,
+        'size': layout.size,
+    }
 
     jinja2_rows = []
 
     for row in objects_rows:
 
-        youtube_link = factory(row.url)
+        youtube_link = links[row.id]
 
         #   video
         #   list-music
@@ -323,6 +625,7 @@ def dashboard():
             'preview': url_for('hits.thumbnail', hit_id=row.id),
             'thumbnail': {
                 'id': row.id,
+                'tile': tiles.get(row.id),
             },
             'status_url': url_for('hits.status', hit_id=row.id),
             'database_name': database_name,
@@ -339,8 +642,107 @@ def dashboard():
         'navigation': navigation,
         'current_user': current_user,
         'rows': jinja2_rows,
+        'sprite': sprite,
+        'status_url': url_for('hits.statuses'),
         'json_data': json.dumps({'foobar': 1, 'test': '<&;">'}),
     }
 
     return render_template('hits-dashboard.jinja2', **p)
 
+
+@hits_blueprint.route('/search')
+@login_required
+def search():
+    """Full text search, `/hits/search?q=<words>&page=<n>`, best matches first"""
+    text = request.args.get('q', default='')
+    page = max(1, request.args.get('page', default=1, type=int))
+
+    limit = Page.limit
+
+    #   One row more tells us if there is a next page
+    rows = search_hits(text, limit=limit + 1, offset=(page - 1) * limit)
+
+    results = []
+    for row in rows[:limit]:
+        results.append({
+            'id': row['id'],
+            'title': row['title'],
+            'link': row['url'],
+            'mtime': row['mtime'].strftime("%Y-%m-%d %H:%M:%S"),
+            'visited': row['visited'],
+            'snippet': row['snippet'],
+        })
+
+    return jsonify(
+        query=text,
+        page=page,
+        next_page=url_for('.search', q=text, page=page + 1) if len(rows) > limit else None,
+        prev_page=url_for('.search', q=text, page=page - 1) if page > 1 else None,
+        results=results,
+    )
+
+
+#   Default and maximal period of /hits/stats per granularity
+STATS_PERIODS = {
+    'hour': (datetime.timedelta(days=2), datetime.timedelta(days=31)),
+    'day': (datetime.timedelta(days=90), datetime.timedelta(days=3 * 366)),
+}
+
+
+@hits_blueprint.route('/stats')
+@login_required
+def stats():
+    """
+    Visits for sparklines and heatmaps, read from the rollups:
+
+        /hits/stats?granularity=hour|day&domain=<domain>&days=<n>
+    """
+    granularity = request.args.get('granularity', default='hour')
+    if granularity not in STATS_PERIODS:
+        d = {
+            'status': 'ERROR',
+            'message': "Unknown granularity '{}'".format(granularity),
+        }
+        return make_response(jsonify(d), HTTPStatus.BAD_REQUEST)
+
+    default_period, maximal_period = STATS_PERIODS[granularity]
+
+    period = default_period
+    days = request.args.get('days', type=int)
+    if days is not None and days > 0:
+        period = min(datetime.timedelta(days=days), maximal_period)
+
+    domain = request.args.get('domain', default=rollups.ALL_DOMAINS)
+
+    until = datetime.datetime.now()
+    since = until - period
+
+    visits = rollups.series(granularity, since, until, domain=domain)
+
+    d = {
+        'granularity': granularity,
+        'domain': domain,
+        'since': since.strftime("%Y-%m-%d %H:%M:%S"),
+        'until': until.strftime("%Y-%m-%d %H:%M:%S"),
+        'total': sum(v for _, v in visits),
+        'series': [[bucket.strftime("%Y-%m-%d %H:%M:%S"), v] for bucket, v in visits],
+        'top_domains': [[name, v] for name, v in rollups.top_domains(since, until)],
+    }
+
+    if granularity == 'hour':
+        d['heatmap'] = rollups.heatmap(visits)
+
+    return jsonify(d)
+
+
+@hits_blueprint.route('/metrics')
+@login_required
+def metrics():
+    return jsonify(
+        spool=spool.stats(),
+        video_index=video_index.stats(),
+        response_cache=response_cache.stats(),
+        thumbnails=thumbnail_prefetcher.stats(),
+        identities=identity_cache.stats(),
+        tokens=token_cache.stats(),
+    )
@@ -0,0 +1,122 @@
+import io
+import zlib
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+BUFFER_SIZE = 65_536
+
+
+class DecompressingStream(io.RawIOBase):
+    """
+    Inflates a gzip or deflate compressed `wsgi.input` while it is read.
+    At most `max_size` decompressed bytes are handed out, so a small zip
+    bomb can't blow up a worker.
+    """
+    def __init__(self, stream, encoding, max_size, content_length=None):
+        self.stream = stream
+        self.encoding = encoding
+        self.max_size = max_size
+        self.remaining = content_length
+
+        self.size = 0
+        self.pending = b''
+        self.started = False
+
+        if encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            #   RFC 9110 says zlib format, some clients send raw deflate
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+
+    def readable(self):
+        return True
+
+    def _read_compressed(self):
+        n = BUFFER_SIZE
+        if self.remaining is not None:
+            n = min(n, self.remaining)
+            if n <= 0:
+                return b''
+
+        data = self.stream.read(n)
+
+        if self.remaining is not None:
+            self.remaining -= len(data)
+
+        return data
+
+    def _decompress(self, data, max_length):
+        try:
+            return self.decompressor.decompress(data, max_length)
+        except zlib.error:
+            if self.encoding == 'deflate' and not self.started:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self._decompress(data, max_length)
+
+            raise BadRequest('Malformed {} request body'.format(self.encoding))
+        finally:
+            self.started = True
+
+    def readinto(self, b):
+        while not self.pending:
+            if self.decompressor.eof:
+                return 0
+
+            data = self.decompressor.unconsumed_tail or self._read_compressed()
+            if not data:
+                raise BadRequest('Truncated {} request body'.format(self.encoding))
+
+            self.pending = self._decompress(data, len(b))
+
+            self.size += len(self.pending)
+            if self.size > self.max_size:
+                raise RequestEntityTooLarge('Decompressed request body exceeds {} bytes'.format(self.max_size))
+
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+
+        return n
+
+
+class RequestDecompression:
+    """
+    WSGI middleware for `Content-Encoding: gzip` and `deflate` request
+    bodies. `limits` maps path prefixes to the maximal decompressed size
+    of a body, requests to other paths are passed through untouched.
+    """
+    ENCODINGS = ('gzip', 'deflate')
+
+    def __init__(self, app, limits):
+        self.app = app
+        self.limits = limits
+
+    def limit(self, path):
+        for prefix, max_size in self.limits.items():
+            if path.startswith(prefix):
+                return max_size
+
+        return None
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+
+        if encoding in RequestDecompression.ENCODINGS:
+            max_size = self.limit(environ.get('PATH_INFO', ''))
+
+            if max_size is not None:
+                content_length = environ.get('CONTENT_LENGTH')
+
+                stream = DecompressingStream(
+                    environ['wsgi.input'],
+                    encoding,
+                    max_size,
+                    content_length=int(content_length) if content_length else None,
+                )
+
+                environ['wsgi.input'] = io.BufferedReader(stream, BUFFER_SIZE)
+                environ['wsgi.input_terminated'] = True
+                environ.pop('CONTENT_LENGTH', None)
+                environ.pop('HTTP_CONTENT_ENCODING', None)
+
+        return self.app(environ, start_response)
@@ -0,0 +1,133 @@
+# project/server/conditional.py
+
+import hashlib
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from pathlib import Path
+
+from flask import make_response, request, Response
+
+from project.server.models import Generation
+
+#   The package whose code and templates render the cached views
+SOURCE_DIRECTORY = Path(__file__).resolve().parents[1]
+
+#   Code and templates (the Jinja2 ones are mostly `.jinja2`)
+SOURCE_SUFFIXES = ('.py', '.html', '.jinja2')
+
+
+def source_version(directory=SOURCE_DIRECTORY):
+    """Hash of the code and the templates, a deploy changes every ETag"""
+    digest = hashlib.sha1()
+
+    for path in sorted(directory.rglob('*')):
+        if path.suffix in SOURCE_SUFFIXES and path.is_file():
+            digest.update(str(path.relative_to(directory)).encode())
+            digest.update(path.read_bytes())
+
+    return digest.hexdigest()[:12]
+
+
+class ResponseCache:
+    """
+    Small per-process LRU of rendered response bodies, keyed by ETag. An
+    ETag contains the generations the body was built from, so entries never
+    go stale: after a write the new ETag simply misses.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('RESPONSE_CACHE_SIZE', self.maxsize)
+        self.version = app.config.get('RESPONSE_VERSION') or source_version()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def get(self, etag):
+        with self._lock:
+            entry = self.entries.get(etag)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(etag)
+            self.hits += 1
+            return entry
+
+    def put(self, etag, entry):
+        with self._lock:
+            self.entries[etag] = entry
+            self.entries.move_to_end(etag)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+response_cache = ResponseCache()
+
+
+def _finish(response, etag):
+    response.set_etag(etag)
+
+    #   Browsers may keep the body, but have to ask us before using it
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+
+    return response
+
+
+def conditional_response(key, names, build):
+    """
+    Answers a GET with a body that only changes with the generations
+    `names`. `key` identifies the view (user, path and arguments), `build`
+    renders the body on a miss and returns a response.
+
+    A poll with a matching `If-None-Match` costs one read of the generation
+    counters and gets a 304. There is no `Last-Modified`: the generations
+    change several times a second, which its resolution of a second can't
+    tell apart.
+    """
+    generations = Generation.current(*names)
+
+    versions = [generations[name][0] for name in names]
+    digest = hashlib.sha1(repr((response_cache.version, key, versions)).encode()).hexdigest()
+    etag = digest[:20]
+
+    if request.if_none_match.contains(etag):
+        return _finish(Response(status=HTTPStatus.NOT_MODIFIED), etag)
+
+    entry = response_cache.get(etag)
+
+    if entry is None:
+        response = make_response(build())
+        if response.status_code != HTTPStatus.OK:
+            return response
+
+        entry = (response.get_data(), response.mimetype)
+        response_cache.put(etag, entry)
+
+    body, mimetype = entry
+
+    response = _finish(Response(body, mimetype=mimetype), etag)
+
+    return response.make_conditional(request)
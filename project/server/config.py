@@ -2,6 +2,7 @@
 
 import os
 import sys
+import tempfile
 from pathlib import Path
 
 basedir = Path(__file__).absolute().parent.parent.parent
@@ -21,6 +22,54 @@ class BaseConfig:
     BCRYPT_LOG_ROUNDS = 13
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    #   Write-behind ingestion for /hits/collection (see project.server.spool)
+    HITS_SPOOL = False
+    HITS_SPOOL_DIRECTORY = basedir / 'data' / 'spool'
+    HITS_SPOOL_FLUSH_INTERVAL = 5               # seconds between two flushes
+    HITS_SPOOL_FLUSH_HITS = 5000                # hits per group commit
+    HITS_SPOOL_FLUSH_BYTES = 1024 * 1024        # flush early above this backlog
+    HITS_SPOOL_MAX_BYTES = 64 * 1024 * 1024     # ingest synchronously above this backlog
+    HITS_SPOOL_MAX_LAG = 60                     # seconds, see /hits/metrics
+    HITS_SPOOL_MAX_ATTEMPTS = 3                 # flushes of a failing batch before it's set aside
+
+    #   `flask data compact` moves hits not visited for this many days into
+    #   `hits_archive` (see project.server.retention), None keeps them all
+    HITS_RETENTION_DAYS = None
+
+    #   Where the downloaded videos are, see project.server.video_index
+    VIDEO_ARCHIVE_DIRECTORY = '.'
+    VIDEO_ARCHIVE_RECURSIVE = True
+    VIDEO_INDEX_REFRESH_INTERVAL = 30           # seconds
+
+    #   Thumbnails of new video hits are rendered in the background, see
+    #   project.server.prefetch
+    THUMBNAIL_PREFETCH = True
+    THUMBNAIL_PREFETCH_WORKERS = 2              # concurrent fetches per process
+    THUMBNAIL_PREFETCH_QUEUE = 256              # queued links, more are dropped
+    THUMBNAIL_PREFETCH_RETRIES = 3
+    THUMBNAIL_PREFETCH_RETRY_DELAY = 2          # seconds, doubled per retry
+
+    #   HTTP client for preview images, see project.server.fetcher
+    FETCHER_TIMEOUT = (3.05, 10)                # seconds to connect, to read
+    FETCHER_RETRIES = 3
+    FETCHER_BACKOFF = 0.5                       # seconds, doubled per retry
+    FETCHER_PER_HOST = 4                        # concurrent requests per host
+    FETCHER_WORKERS = 8                         # threads of fetch_many()
+    FETCHER_MAX_SIZE = 16 * 1024 * 1024         # bytes per image
+
+    #   Bearer authentication, see project.server.token_cache
+    TOKEN_CACHE_SIZE = 1024                     # verified tokens per process
+    TOKEN_BLACKLIST_REFRESH_INTERVAL = 5        # seconds until a revocation reaches every process
+    IDENTITY_CACHE_TTL = 60                     # seconds until a change of a user reaches every process, 0 disables
+    IDENTITY_CACHE_SIZE = 1024                  # users per process
+
+    #   Path prefixes that accept gzip/deflate request bodies, mapped to the
+    #   maximal decompressed size (see project.middleware.decompress)
+    REQUEST_DECOMPRESSION = {
+        '/hits/collection': 16 * 1024 * 1024,
+        '/result/': 16 * 1024 * 1024,
+    }
+
 
 class DevelopmentConfig(BaseConfig):
     """Development configuration."""
@@ -73,6 +122,9 @@ class TestingConfig(BaseConfig):
     BCRYPT_LOG_ROUNDS = 4
     SQLALCHEMY_DATABASE_URI = sqlite3_filename('_testing')
     PRESERVE_CONTEXT_ON_EXCEPTION = False
+    THUMBNAIL_PREFETCH = False
+    #   Outside of the checkout, tests must not leave a cache behind in it
+    THUMBNAIL_CACHE_DIRECTORY = Path(tempfile.gettempdir()) / 'self-hosted-logging-cache-testing'
 
 
 class ProductionConfig(BaseConfig):
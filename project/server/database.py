@@ -2,3 +2,6 @@ from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+#   Bound parameters per statement of SQLite before 3.32
+SQLITE_MAX_VARIABLES = 999
+
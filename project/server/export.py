@@ -0,0 +1,145 @@
+# project/server/export.py
+
+import csv
+import datetime
+import heapq
+import io
+import json
+import zlib
+
+from project.server.database import db
+from project.server.models import Hit, HitArchive
+
+#   Rows fetched from the cursor at a time
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CSV_COLUMNS = ('id', 'url', 'title', 'mtime', 'timestamp_ms', 'visited', 'archived')
+
+
+def parse_since(value):
+    """
+    `since` is either an ISO 8601 time or milliseconds since the epoch
+    (like `timestamp_ms` of a hit). Raises ValueError for anything else.
+    """
+    value = value.strip()
+
+    if value.isdigit():
+        return datetime.datetime.fromtimestamp(int(value) / 1000)
+
+    return datetime.datetime.fromisoformat(value)
+
+
+def _rows(table, since, batch_size, archived):
+    statement = db.select(table.c.id, table.c.url, table.c.title, table.c.mtime, table.c.visited).\
+        order_by(table.c.mtime, table.c.id)
+
+    if since is not None:
+        statement = statement.where(table.c.mtime > since)
+
+    result = db.session.execute(statement.execution_options(stream_results=True, yield_per=batch_size))
+
+    for row in result:
+        yield row.mtime, archived, row
+
+
+def export_rows(since=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields every hit (as a dict) whose last visit is after `since`, the
+    ones of `hits` and the compacted ones of `hits_archive` (marked
+    `archived`), oldest first. Both tables are streamed from the cursor
+    along their `mtime` index `batch_size` rows at a time, so memory
+    doesn't grow with the tables.
+
+    A visit moves a hit to a newer `mtime`, so the `mtime` of the last row
+    is the `since` for the next incremental export; `since` itself is
+    excluded.
+    """
+    rows = heapq.merge(
+        _rows(Hit.__table__, since, batch_size, archived=False),
+        _rows(HitArchive.__table__, since, batch_size, archived=True),
+        key=lambda entry: (entry[0], entry[1], entry[2].id),
+    )
+
+    for mtime, archived, row in rows:
+        yield {
+            'id': row.id,
+            'url': row.url,
+            'title': row.title,
+            'mtime': mtime.isoformat(),
+            'timestamp_ms': round(mtime.timestamp() * 1000),
+            'visited': row.visited,
+            'archived': archived,
+        }
+
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, lineterminator="\n")
+
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def _batched(lines, batch_size):
+    #   One chunk per batch of rows instead of one tiny write per row
+    batch = []
+
+    for line in lines:
+        batch.append(line)
+
+        if len(batch) >= batch_size:
+            yield ''.join(batch).encode()
+            batch = []
+
+    if batch:
+        yield ''.join(batch).encode()
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def export_hits(fmt='ndjson', since=None, gzip=False, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the export as chunks of bytes. NDJSON lines can be read back by
+    `flask data import`, which takes over their `visited` and `mtime`; CSV
+    starts with a header line.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format '{}'".format(fmt))
+
+    rows = export_rows(since=since, batch_size=batch_size)
+    lines = _csv_lines(rows) if fmt == 'csv' else _ndjson_lines(rows)
+
+    chunks = _batched(lines, batch_size)
+
+    if gzip:
+        chunks = _gzipped(chunks)
+
+    return chunks
@@ -0,0 +1,182 @@
+# project/server/fetcher.py
+
+import logging
+import os
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 65_536
+
+
+class FetchResult:
+    def __init__(self, url, status_code=None, stream=None, error=None):
+        self.url = url
+        self.status_code = status_code
+        self.stream = stream
+        self.error = error
+
+    def __repr__(self):
+        return '<FetchResult {} status={} error={!r}>'.format(self.url, self.status_code, self.error)
+
+    @property
+    def ok(self):
+        return self.stream is not None
+
+    def raise_for_error(self):
+        """Raises the error of a request that got no answer at all (after its retries)"""
+        if self.status_code is None and self.error is not None:
+            raise self.error
+
+
+class Fetcher:
+    """
+    Shared HTTP client for preview images.
+
+    One `requests.Session` keeps the connections to a host alive, its
+    adapter retries connection errors and 429/5xx answers with exponential
+    backoff. At most `FETCHER_PER_HOST` requests per host run at once, no
+    matter how many threads fetch. Bodies are spooled into temporary files
+    that only stay in memory while they are small.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self):
+        self.app = None
+
+        self.timeout = (3.05, 10)
+        self.retries = 3
+        self.backoff = 0.5
+        self.per_host = 4
+        self.workers = 8
+        self.max_size = 16 * 1024 * 1024
+        self.memory_size = 1024 * 1024
+
+        self._session = None
+        self._executor = None
+        self._semaphores = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+        self.timeout = tuple(app.config.get('FETCHER_TIMEOUT', self.timeout))
+        self.retries = app.config.get('FETCHER_RETRIES', self.retries)
+        self.backoff = app.config.get('FETCHER_BACKOFF', self.backoff)
+        self.per_host = app.config.get('FETCHER_PER_HOST', self.per_host)
+        self.workers = app.config.get('FETCHER_WORKERS', self.workers)
+        self.max_size = app.config.get('FETCHER_MAX_SIZE', self.max_size)
+
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                if self._session is not None:
+                    self._session.close()
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+
+            self._forget()
+
+    def _forget(self):
+        self._session = None
+        self._executor = None
+        self._semaphores = {}
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        #   A forked uWSGI worker must not share the sockets of its parent
+        if self._pid != os.getpid():
+            self._forget()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            self._check_fork()
+
+            if self._session is None:
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff,
+                    status_forcelist=Fetcher.RETRY_STATUS,
+                    allowed_methods=('GET', 'HEAD'),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=16,
+                    pool_maxsize=max(self.per_host, self.workers),
+                    max_retries=retry,
+                )
+
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                self._session = session
+
+            return self._session
+
+    def _semaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc.lower()
+
+        with self._lock:
+            self._check_fork()
+
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return semaphore
+
+    def fetch(self, url):
+        """
+        GETs `url`. The result has the body as a file (positioned at 0) for
+        a 200, else only the status code or the error.
+        """
+        with self._semaphore(url):
+            try:
+                with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                    if response.status_code != requests.codes.ok:
+                        return FetchResult(url, status_code=response.status_code)
+
+                    stream = tempfile.SpooledTemporaryFile(max_size=self.memory_size)
+                    size = 0
+
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_size:
+                            stream.close()
+                            return FetchResult(url, status_code=response.status_code,
+                                               error='larger than {} bytes'.format(self.max_size))
+                        stream.write(chunk)
+
+                    stream.seek(0)
+                    return FetchResult(url, status_code=response.status_code, stream=stream)
+
+            except requests.RequestException as e:
+                logger.warning('Fetching {} failed: {}'.format(url, e))
+                return FetchResult(url, error=e)
+
+    def fetch_many(self, urls):
+        """Fetches many URLs at once on the worker pool, returns a dict url -> FetchResult"""
+        urls = list(dict.fromkeys(urls))
+
+        with self._lock:
+            self._check_fork()
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fetcher')
+            executor = self._executor
+
+        return dict(zip(urls, executor.map(self.fetch, urls)))
+
+
+fetcher = Fetcher()
@@ -0,0 +1,110 @@
+# project/server/identity.py
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from sqlalchemy import event
+
+from project.server.database import db
+from project.server.models import User
+
+
+@dataclass(frozen=True)
+class IdentityRecord:
+    id: int
+    email: str
+    admin: bool
+
+
+class IdentityCache:
+    """
+    Per-process cache user id -> `IdentityRecord` for the Flask-Login
+    loaders (session cookie and bearer token), so an authenticated request
+    doesn't query `users`. Unknown IDs are cached as well.
+
+    Entries live `IDENTITY_CACHE_TTL` seconds. Changes of a user through
+    the ORM invalidate its entry in this process at once; other processes
+    see them after the TTL. A TTL of 0 disables the cache.
+    """
+    def __init__(self):
+        self.app = None
+
+        self.ttl = 60
+        self.maxsize = 1024
+
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+        self.ttl = app.config.get('IDENTITY_CACHE_TTL', self.ttl)
+        self.maxsize = app.config.get('IDENTITY_CACHE_SIZE', self.maxsize)
+
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self.entries.pop(int(user_id), None)
+
+    def get(self, user_id):
+        """The record of the user, None if there is no such user"""
+        user_id = int(user_id)
+
+        with self._lock:
+            entry = self.entries.get(user_id)
+
+            if entry is not None:
+                record, expires_at = entry
+
+                if time.monotonic() < expires_at:
+                    self.entries.move_to_end(user_id)
+                    self.hits += 1
+                    return record
+
+                del self.entries[user_id]
+
+            self.misses += 1
+
+        row = db.session.query(User.id, User.email, User.admin).filter(User.id == user_id).one_or_none()
+        record = IdentityRecord(id=row.id, email=row.email, admin=row.admin) if row else None
+
+        if self.ttl > 0:
+            with self._lock:
+                self.entries[user_id] = (record, time.monotonic() + self.ttl)
+
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+
+        return record
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+identity_cache = IdentityCache()
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user(mapper, connection, target):
+    if target.id is not None:
+        identity_cache.invalidate(target.id)
@@ -0,0 +1,497 @@
+# project/server/ingest.py
+
+import datetime
+import json
+import logging
+import time
+from collections import Counter
+
+from sqlalchemy import bindparam, update
+from sqlalchemy.dialects.sqlite import insert
+
+from project.server.database import db, SQLITE_MAX_VARIABLES
+from project.server.link import canonical_url, url_key, link_metadata
+from project.server.models import Hit, HitArchive, Generation
+from project.server.prefetch import thumbnail_prefetcher
+from project.server.rollups import count_visit, store_rollups
+
+logger = logging.getLogger()
+
+#   SQLite limits the number of bound parameters per statement, so big
+#   batches are written in slices of this many URLs: the insert of new
+#   URLs binds (at most) every column of `hits` per row.
+CHUNK_SIZE = SQLITE_MAX_VARIABLES // len(Hit.__table__.columns)
+
+#   Hits per commit of a bulk import
+IMPORT_CHUNK_SIZE = 5000
+
+IMPORT_FORMATS = ('ndjson', 'tsv')
+
+
+class IngestResult:
+    def __init__(self):
+        self.received = 0
+        self.inserted = 0
+        self.updated = 0
+
+    def __repr__(self):
+        return '<IngestResult received={} inserted={} updated={}>'.format(
+            self.received, self.inserted, self.updated)
+
+    def add(self, other):
+        self.received += other.received
+        self.inserted += other.inserted
+        self.updated += other.updated
+        return self
+
+
+def validate_hits(rows):
+    """Returns an error message for a malformed batch of raw hits, else None"""
+    if not isinstance(rows, list):
+        return "Key 'hits' must be a list"
+
+    for i, r in enumerate(rows):
+        if not isinstance(r, dict):
+            return "Hit #{} is not a hash".format(i)
+
+        for key in ('url', 'timestamp_ms', 'title'):
+            if key not in r:
+                return "Hit #{} misses the key '{}'".format(i, key)
+
+        if not isinstance(r['url'], str) or not isinstance(r['title'], str):
+            return "Hit #{} needs the strings 'url' and 'title'".format(i)
+
+        try:
+            datetime.datetime.fromtimestamp(int(r['timestamp_ms']) / 1000)
+        except (TypeError, ValueError, OverflowError, OSError):
+            return "Hit #{} has an invalid 'timestamp_ms'".format(i)
+
+    return None
+
+
+def collapse_hits(rows, rollups=None):
+    """
+    Folds a batch of raw hits (as sent by the browser extension) into one
+    entry per canonical URL. The first title wins, the latest timestamp
+    wins and every occurrence counts as one visit. Each visit is added to
+    the `rollups` counter, if given.
+    """
+    collapsed = {}
+
+    for r in rows:
+        mtime = datetime.datetime.fromtimestamp(int(r['timestamp_ms']) / 1000)
+
+        url = canonical_url(r['url'])
+        key = url_key(url)
+
+        if rollups is not None:
+            count_visit(rollups, url, mtime)
+
+        entry = collapsed.get(key)
+        if entry is None:
+            collapsed[key] = {
+                'url': url,
+                'url_key': key,
+                'mtime': mtime,
+                'title': r['title'],
+                'visited': 1,
+            }
+        else:
+            entry['visited'] += 1
+            entry['mtime'] = max(entry['mtime'], mtime)
+
+    return collapsed
+
+
+def _chunks(entries, n):
+    for i in range(0, len(entries), n):
+        yield entries[i:i + n]
+
+
+def store_hits(rows, session=None, prefetch=True):
+    """
+    Stores a batch of raw hits with a constant number of statements per
+    chunk: one lookup of all known URLs, one executemany UPDATE and one
+    INSERT ... ON CONFLICT for the new URLs, plus one upsert of the
+    visit rollups and the bump of the hits generation. The caller commits.
+
+    With `prefetch` the thumbnails of new video links are queued for the
+    background prefetch.
+    """
+    if session is None:
+        session = db.session
+
+    result = IngestResult()
+
+    rows = list(rows)
+    result.received = len(rows)
+
+    rollups = Counter()
+    collapsed = collapse_hits(rows, rollups)
+
+    hits = Hit.__table__
+
+    statement_update = update(hits).\
+        where(hits.c.id == bindparam('b_id')).\
+        values(visited=hits.c.visited + bindparam('b_visited'),
+               mtime=db.func.max(hits.c.mtime, bindparam('b_mtime', type_=hits.c.mtime.type)))
+
+    for chunk in _chunks(list(collapsed.values()), CHUNK_SIZE):
+
+        known = dict(session.execute(
+            db.select(hits.c.url_key, hits.c.id).where(hits.c.url_key.in_([e['url_key'] for e in chunk]))
+        ).all())
+
+        updates = []
+        inserts = []
+
+        for entry in chunk:
+            if entry['url_key'] in known:
+                updates.append({
+                    'b_id': known[entry['url_key']],
+                    'b_visited': entry['visited'],
+                    'b_mtime': entry['mtime'],
+                })
+            else:
+                #   Only new URLs get parsed, once, see `Hit.link`
+                inserts.append(dict(entry, download=False, deleted=False, **link_metadata(entry['url'])))
+
+        if updates:
+            session.execute(statement_update, updates)
+
+        if inserts:
+            #   Another process may have inserted one of our URLs since the
+            #   lookup above, so the insert still merges on the unique key.
+            statement_insert = insert(hits).values(inserts)
+            statement_insert = statement_insert.on_conflict_do_update(
+                index_elements=[hits.c.url_key],
+                set_={
+                    'visited': hits.c.visited + statement_insert.excluded.visited,
+                    #   An old dump doesn't move the last visit back
+                    'mtime': db.func.max(hits.c.mtime, statement_insert.excluded.mtime),
+                },
+            )
+            session.execute(statement_insert)
+
+        result.updated += len(updates)
+        result.inserted += len(inserts)
+
+        if prefetch:
+            for entry in inserts:
+                if entry['video_id']:
+                    thumbnail_prefetcher.enqueue(entry['url'], entry['link_kind'], entry['link_hoster'],
+                                                 entry['video_id'])
+
+    store_rollups(rollups, session)
+
+    if collapsed:
+        Generation.bump(Generation.HITS, session)
+
+    logger.debug(result)
+
+    return result
+
+
+def store_snapshots(rows, session=None):
+    """
+    Stores hits of an export (see `project.server.export`): their
+    `visited` and last visit replace the ones of the row instead of
+    counting as a new visit, so importing the same export again changes
+    nothing. Hits marked `archived` go into `hits_archive`. The rollups
+    stay as they are, an export doesn't know when the visits were. The
+    caller commits.
+    """
+    if session is None:
+        session = db.session
+
+    result = IngestResult()
+
+    hot = {}
+    archived = {}
+
+    for r in rows:
+        result.received += 1
+
+        url = canonical_url(r['url'])
+        key = url_key(url)
+
+        (archived if r.get('archived') else hot)[key] = {
+            'url': url,
+            'url_key': key,
+            'mtime': datetime.datetime.fromtimestamp(int(r['timestamp_ms']) / 1000),
+            'title': r['title'],
+            'visited': int(r['visited']),
+        }
+
+    hits = Hit.__table__
+
+    statement_hits = insert(hits)
+    statement_hits = statement_hits.on_conflict_do_update(
+        index_elements=[hits.c.url_key],
+        set_={
+            'visited': statement_hits.excluded.visited,
+            'mtime': statement_hits.excluded.mtime,
+        },
+    )
+
+    for chunk in _chunks(list(hot.values()), CHUNK_SIZE):
+        known = session.execute(
+            db.select(db.func.count()).where(hits.c.url_key.in_([e['url_key'] for e in chunk]))
+        ).scalar()
+
+        session.execute(statement_hits, [
+            dict(entry, download=False, deleted=False, **link_metadata(entry['url'])) for entry in chunk
+        ])
+
+        result.updated += known
+        result.inserted += len(chunk) - known
+
+    archive = HitArchive.__table__
+    archived_on = datetime.datetime.now()
+
+    statement_archive = insert(archive)
+    statement_archive = statement_archive.on_conflict_do_update(
+        index_elements=[archive.c.url_key],
+        set_={
+            'visited': statement_archive.excluded.visited,
+            'mtime': statement_archive.excluded.mtime,
+            'month': statement_archive.excluded.month,
+        },
+    )
+
+    for chunk in _chunks(list(archived.values()), CHUNK_SIZE):
+        known = session.execute(
+            db.select(db.func.count()).where(archive.c.url_key.in_([e['url_key'] for e in chunk]))
+        ).scalar()
+
+        session.execute(statement_archive, [
+            dict(entry, month=entry['mtime'].strftime('%Y-%m'), archived_on=archived_on) for entry in chunk
+        ])
+
+        result.updated += known
+        result.inserted += len(chunk) - known
+
+    if hot or archived:
+        Generation.bump(Generation.HITS, session)
+
+    logger.debug(result)
+
+    return result
+
+
+def canonicalize_hits(batch_size=CHUNK_SIZE, session=None):
+    """
+    Gives rows without `url_key` (older than that column) their canonical
+    URL and key. Rows that turn out to be the same page as an existing row
+    are merged into it. Commits after every batch, returns the numbers of
+    updated and merged rows.
+    """
+    if session is None:
+        session = db.session
+
+    updated = 0
+    merged = 0
+    last_id = 0
+
+    while True:
+        rows = session.query(Hit).\
+            filter(Hit.url_key.is_(None), Hit.id > last_id).\
+            order_by(Hit.id).limit(batch_size).all()
+
+        if not rows:
+            break
+
+        last_id = rows[-1].id
+
+        for hit in rows:
+            url = canonical_url(hit.url)
+            key = url_key(url)
+
+            survivor = session.query(Hit).filter(Hit.url_key == key).one_or_none()
+
+            if survivor is None:
+                hit.url = url
+                hit.url_key = key
+                for column, value in link_metadata(url).items():
+                    setattr(hit, column, value)
+                updated += 1
+
+                #   Later rows of this batch may merge into this one
+                session.flush()
+                continue
+
+            survivor.visited = (survivor.visited or 0) + (hit.visited or 1)
+            survivor.mtime = max(survivor.mtime, hit.mtime)
+            if survivor.order_id is None:
+                survivor.order_id = hit.order_id
+
+            session.delete(hit)
+            session.flush()
+            merged += 1
+
+        Generation.bump(Generation.HITS, session)
+        session.commit()
+
+    return updated, merged
+
+
+def backfill_link_metadata(batch_size=CHUNK_SIZE, session=None):
+    """
+    Fills `link_kind`, `link_hoster` and `video_id` of rows older than
+    these columns. Commits after every batch, returns the number of rows.
+    """
+    if session is None:
+        session = db.session
+
+    hits = Hit.__table__
+
+    statement_update = update(hits).\
+        where(hits.c.id == bindparam('b_id')).\
+        values(link_kind=bindparam('b_link_kind'),
+               link_hoster=bindparam('b_link_hoster'),
+               video_id=bindparam('b_video_id'))
+
+    updated = 0
+    last_id = 0
+
+    while True:
+        rows = session.execute(
+            db.select(hits.c.id, hits.c.url).
+            where(hits.c.link_kind.is_(None), hits.c.id > last_id).
+            order_by(hits.c.id).limit(batch_size)
+        ).all()
+
+        if not rows:
+            break
+
+        last_id = rows[-1].id
+
+        session.execute(statement_update, [
+            {'b_' + column: value for column, value in dict(link_metadata(row.url), id=row.id).items()}
+            for row in rows
+        ])
+        session.commit()
+
+        updated += len(rows)
+
+    return updated
+
+
+class ImportProgress:
+    def __init__(self):
+        self.lines = 0
+        self.skipped = 0
+        self.chunks = 0
+        self.result = IngestResult()
+        self.time_start = time.monotonic()
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.time_start
+
+    @property
+    def rate(self):
+        seconds = self.seconds
+        if seconds <= 0:
+            return 0.0
+        return self.result.received / seconds
+
+    def as_json(self):
+        return {
+            'lines': self.lines,
+            'skipped': self.skipped,
+            'chunks': self.chunks,
+            'hits': self.result.received,
+            'inserted': self.result.inserted,
+            'updated': self.result.updated,
+            'seconds': round(self.seconds, 3),
+            'hits_per_second': round(self.rate, 1),
+        }
+
+
+def parse_line(line, fmt):
+    """
+    Parses one line of a hit dump into a raw hit. NDJSON lines are hashes
+    like the ones of the browser extension or the ones of an export (with
+    `visited`), TSV lines are `url<TAB>timestamp_ms<TAB>title`. Returns
+    None for broken lines.
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf8', errors='replace')
+
+    line = line.rstrip("\r\n")
+    if not line:
+        return None
+
+    if fmt == 'tsv':
+        data = line.split("\t")
+        if len(data) < 3:
+            return None
+
+        r = {
+            'url': data[0],
+            'timestamp_ms': data[1],
+            'title': data[2],
+        }
+    else:
+        try:
+            r = json.loads(line)
+        except ValueError:
+            return None
+
+    if validate_hits([r]):
+        return None
+
+    if 'visited' in r and not (isinstance(r['visited'], int) and r['visited'] > 0):
+        return None
+
+    return r
+
+
+def import_hits(lines, fmt='ndjson', chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """
+    Imports an iterable of dump lines in chunks of `chunk_size` hits with
+    one commit per chunk, so memory stays bounded no matter how big the
+    dump is. Lines of an export are stored by `store_snapshots()`, all
+    others count as visits. `progress` is called with an `ImportProgress`
+    after every commit.
+    """
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError("Unknown import format '{}'".format(fmt))
+
+    state = ImportProgress()
+    rows = []
+
+    def commit():
+        snapshots = [r for r in rows if 'visited' in r]
+        visits = [r for r in rows if 'visited' not in r]
+
+        #   Old dumps don't need their thumbnails right now
+        if visits:
+            state.result.add(store_hits(visits, prefetch=False))
+        if snapshots:
+            state.result.add(store_snapshots(snapshots))
+        db.session.commit()
+        state.chunks += 1
+
+        if progress:
+            progress(state)
+
+    for line in lines:
+        state.lines += 1
+
+        r = parse_line(line, fmt)
+        if r is None:
+            state.skipped += 1
+            continue
+
+        rows.append(r)
+
+        if len(rows) >= chunk_size:
+            commit()
+            rows = []
+
+    if rows:
+        commit()
+
+    return state
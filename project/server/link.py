@@ -3,15 +3,19 @@ import io
 import json
 import logging
 import subprocess
+import time
 import urllib.parse
 from builtins import super
 from enum import IntEnum
 from http import HTTPStatus
 
-import requests as requests
 from PIL import Image
+from diskcache import Lock
 from flask import Blueprint
 
+from project.server.fetcher import fetcher
+from project.server.renditions import Rendition
+
 logger = logging.getLogger()
 
 
@@ -43,6 +47,134 @@ def working_checksum(i):
     return filename_hex_digest
 
 
+#   Query parameters that only track where a visitor came from
+TRACKING_PARAMETERS = {
+    'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'igshid',
+    'mc_cid', 'mc_eid', '_ga', '_gl', 'ref_src',
+}
+TRACKING_PARAMETER_PREFIXES = ('utm_',)
+
+YOUTUBE_HOSTS = ('www.youtube.com', 'youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtu.be')
+
+#   Query parameters of a YouTube video page that don't change the video
+YOUTUBE_IGNORED_PARAMETERS = {'t', 'feature', 'si', 'pp', 'ab_channel', 'index', 'start_radio'}
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+
+
+def canonical_url(url: str):
+    """
+    Normalizes a URL, so different spellings of the same page map to the
+    same string: lower case scheme and host, no default port, no tracking
+    parameters, sorted query and no fragment (unless it's a `#/` or `#!`
+    route of a single page app). YouTube video links all become
+    `https://www.youtube.com/watch?v=<id>`.
+    """
+    try:
+        o = urllib.parse.urlsplit(url.strip())
+        port = o.port
+    except ValueError:
+        return url
+
+    scheme = o.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not o.hostname:
+        return url
+
+    host = o.hostname.lower()
+    path = o.path or '/'
+    parameters = _query_parameters(o.query)
+
+    ignored = set()
+    if host in YOUTUBE_HOSTS:
+        if host == 'youtu.be' and len(path) > 1:
+            parameters.append(('v', path[1:].split('/')[0]))
+            path = '/watch'
+
+        host = 'www.youtube.com'
+        scheme = 'https'
+        port = None
+
+        if path == '/watch':
+            ignored = YOUTUBE_IGNORED_PARAMETERS
+
+    parameters = sorted(
+        ((k, v) for k, v in parameters
+         if k not in TRACKING_PARAMETERS and k not in ignored and not k.startswith(TRACKING_PARAMETER_PREFIXES)),
+        key=lambda p: (p[0], p[1] is not None, p[1] or ''),
+    )
+
+    #   IPv6 addresses keep their brackets
+    netloc = '[{}]'.format(host) if ':' in host else host
+    if o.username or o.password:
+        netloc = o.netloc.rsplit('@', 1)[0] + '@' + netloc
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc += ':{}'.format(port)
+
+    fragment = o.fragment if o.fragment[:1] in ('/', '!') else ''
+
+    return urllib.parse.urlunsplit((scheme, netloc, path, _query_string(parameters), fragment))
+
+
+def _query_parameters(query):
+    """The (key, value) pairs of a query, the value is None for a bare `?flag`"""
+    parameters = []
+
+    for part in query.split('&'):
+        if not part:
+            continue
+
+        key, equals, value = part.partition('=')
+        parameters.append((urllib.parse.unquote_plus(key), urllib.parse.unquote_plus(value) if equals else None))
+
+    return parameters
+
+
+def _query_string(parameters):
+    return '&'.join(
+        urllib.parse.quote_plus(k) if v is None else urllib.parse.quote_plus(k) + '=' + urllib.parse.quote_plus(v)
+        for k, v in parameters
+    )
+
+
+def domain_of(url: str):
+    """Host of a URL without `www.`, the scheme for URLs without a host (`about`, `file`, ...)"""
+    try:
+        o = urllib.parse.urlsplit(url)
+    except ValueError:
+        return ''
+
+    host = (o.hostname or '').lower()
+    if not host:
+        return o.scheme.lower()
+
+    if host.startswith('www.'):
+        host = host[4:]
+
+    return host
+
+
+def url_key(url: str):
+    """Fixed width key of a canonical URL, see `Hit.url_key`"""
+    return hashlib.blake2b(url.encode('utf8'), digest_size=16).hexdigest()
+
+
+#   Seconds after which a thumbnail lock of a crashed process is given up
+THUMBNAIL_LOCK_EXPIRE = 60
+
+#   A video without any preview image is asked again after an hour, then
+#   after 2, 4, 8, ... hours, but at least once a week.
+THUMBNAIL_MISSING_TTL = 60 * 60
+THUMBNAIL_MISSING_MAX_TTL = 7 * 24 * 60 * 60
+
+PLACEHOLDER_SIZE = (256, 144)
+
+
+_placeholder = None
+
+
 class LinkType(IntEnum):
     UNKNOWN = 1
     VIDEO = 2
@@ -51,69 +183,148 @@ class LinkType(IntEnum):
 
 class Link:
     PREVIEW_IMAGE_SIZE = (256, 256)
+    hoster = None
     #   We need the following arguments for a link:
     #   hoster      →   youtube.com
     #   video_id    →   1234567890
     #  
     #
 
-    def __init__(self, link):
+    def __init__(self, link, kind=None, video_id=None):
         self.link = link
         self.kind = LinkType.UNKNOWN
 
         self.video_id = None
 
-        self.analyze()
+        #   Links restored from the columns of a hit are parsed already
+        if kind is None:
+            self.analyze()
+        else:
+            self.kind = LinkType(kind)
+            self.video_id = video_id
 
     def analyze(self):
         pass
 
-    def thumbnail_image_stream(self, cache):
+    def preview_url(self):
+        return None
+
+    def preview_stream(self, result=None):
+        """The preview image, None if there is none; `result` is its download by `fetch_previews()`"""
+        return None
+
+    def _preview_key(self):
+        return working_checksum('Download preview image for video {}'.format(self.video_id))
+
+    def _missing_key(self):
+        return 'missing-{}-{}'.format(self.hoster, self.video_id)
+
+    def thumbnail_missing(self, cache):
+        """True while the negative cache says this video has no preview image"""
+        entry = cache.get(self._missing_key())
+        return entry is not None and time.time() < entry['retry_at']
 
-        logger.debug('1')
+    def _remember_missing(self, cache):
+        key = self._missing_key()
+
+        entry = cache.get(key)
+        failures = entry['failures'] + 1 if entry else 1
+
+        ttl = min(THUMBNAIL_MISSING_TTL * 2 ** (failures - 1), THUMBNAIL_MISSING_MAX_TTL)
+        logger.info('No preview image for video {}, asking again in {}s'.format(self.video_id, ttl))
+
+        #   The entry outlives its TTL, so the next failure doubles it
+        cache.set(key, {'failures': failures, 'retry_at': time.time() + ttl}, expire=ttl + THUMBNAIL_MISSING_MAX_TTL)
+
+    def thumbnail_image_stream(self, cache, rendition=None, preview=None):
+        """
+        The thumbnail in the given rendition (default: 256px JPEG), rendered
+        from the preview image once and then read from `cache`. `preview` is
+        the download of the preview image, if `fetch_previews()` did it.
+        """
+        if rendition is None:
+            rendition = Rendition()
+
+        if self.video_id is None:
+            return None
 
         thumbnail_description = 'Create thumbnail from preview image for video {}'.format(self.video_id)
+        if not rendition.is_default:
+            thumbnail_description += ' as {}'.format(rendition.key)
         thumbnail_hex_digest = working_checksum(thumbnail_description)
         logger.debug(thumbnail_description)
 
-        if thumbnail_hex_digest not in cache:
+        if thumbnail_hex_digest in cache:
+            return cache.get(thumbnail_hex_digest, read=True)
 
-            preview_description = 'Download preview image for video {}'.format(self.video_id)
-            preview_hex_digest = working_checksum(preview_description)
-            logger.debug(preview_description)
+        if self.thumbnail_missing(cache):
+            return None
 
-            if preview_hex_digest not in cache:
-                preview_image_stream = self.preview_stream()
+        #   Single flight: the first request (of any process) renders the
+        #   thumbnail, the others wait here and read its result.
+        with Lock(cache, 'lock-' + thumbnail_hex_digest, expire=THUMBNAIL_LOCK_EXPIRE):
+            if thumbnail_hex_digest in cache:
+                return cache.get(thumbnail_hex_digest, read=True)
 
-                if preview_image_stream is None:
-                    return None
+            if self.thumbnail_missing(cache):
+                return None
 
-                cache.set(preview_hex_digest, preview_image_stream, read=True)
-                preview_image_stream.seek(0, io.SEEK_SET)
+            #   Errors of the transport raise and are not remembered
+            stream = self._render_thumbnail(cache, thumbnail_hex_digest, rendition, preview)
+
+            if stream is None:
+                self._remember_missing(cache)
             else:
-                preview_image_stream = cache.get(preview_hex_digest, read=True)
+                cache.delete(self._missing_key())
 
-            if preview_image_stream is None:
-                return
+            return stream
 
-            image = Image.open(preview_image_stream)
-            image.thumbnail(Link.PREVIEW_IMAGE_SIZE)
+    @staticmethod
+    def placeholder_stream():
+        """A neutral grey JPEG for links without a thumbnail"""
+        global _placeholder
+
+        if _placeholder is None:
             file_out = io.BytesIO(b'')
-            image.save(file_out, format='JPEG')
-            file_out.seek(0, io.SEEK_SET)
+            Image.new('RGB', PLACEHOLDER_SIZE, (200, 200, 200)).save(file_out, format='JPEG')
+            _placeholder = file_out.getvalue()
+
+        return io.BytesIO(_placeholder)
 
-            cache.set(thumbnail_hex_digest, file_out, read=True)
-            file_out.seek(0, io.SEEK_SET)
-            thumbnail_image_stream = file_out
+    def _render_thumbnail(self, cache, thumbnail_hex_digest, rendition, preview=None):
+
+        preview_hex_digest = self._preview_key()
+        logger.debug('Download preview image for video {}'.format(self.video_id))
+
+        if preview_hex_digest not in cache:
+            preview_image_stream = self.preview_stream(preview)
+
+            if preview_image_stream is None:
+                return None
+
+            cache.set(preview_hex_digest, preview_image_stream, read=True)
+            preview_image_stream.seek(0, io.SEEK_SET)
         else:
-            thumbnail_image_stream = cache.get(thumbnail_hex_digest, read=True)
+            preview_image_stream = cache.get(preview_hex_digest, read=True)
 
-        return thumbnail_image_stream
+        if preview_image_stream is None:
+            return
+
+        #   The preview stays in the cache, every rendition is made from it
+        with preview_image_stream, Image.open(preview_image_stream) as image:
+            file_out = io.BytesIO(rendition.render(image))
+
+        cache.set(thumbnail_hex_digest, file_out, read=True)
+        file_out.seek(0, io.SEEK_SET)
+
+        return file_out
 
 
 class Youtube(Link):
-    def __init__(self, link):
-        super().__init__(link)
+    hoster = 'youtube'
+
+    def __init__(self, link, kind=None, video_id=None):
+        super().__init__(link, kind=kind, video_id=video_id)
 
 #    @staticmethod
 #   def analyse(url):
@@ -127,30 +338,28 @@ class Youtube(Link):
 
         if o.netloc in ('www.youtube.com', 'youtube.com') and o.path == '/watch':
             params = urllib.parse.parse_qs(o.query)
-            self.video_id = params['v'][0]
-            self.kind = LinkType.VIDEO
 
-    @staticmethod
-    def _binary_stream_from_response(response):
-
-        file_out = io.BytesIO(b'')
-
-        for chunk in response.iter_content(65_536):
-            file_out.write(chunk)
-
-        file_out.seek(0, io.SEEK_SET)
-        return file_out
+            video_id = params.get('v', [None])[0]
+            if video_id:
+                self.video_id = video_id
+                self.kind = LinkType.VIDEO
+            elif params.get('list'):
+                #   `/watch?list=...` without a video plays the playlist
+                self.kind = LinkType.PLAYLIST
 
-    def preview_stream(self):
+    def preview_url(self):
+        return 'https://i.ytimg.com/vi/{}/maxresdefault.jpg'.format(self.video_id)
 
-        youtube_url = 'https://i.ytimg.com/vi/{}/maxresdefault.jpg'.format(self.video_id)
+    def preview_stream(self, result=None):
 
-        response = requests.get(youtube_url, stream=True, timeout=5)
+        if result is None:
+            result = fetcher.fetch(self.preview_url())
+        result.raise_for_error()
 
-        if response.status_code == HTTPStatus.OK:
-            return Youtube._binary_stream_from_response(response)
+        if result.ok:
+            return result.stream
 
-        elif response.status_code == HTTPStatus.NOT_FOUND:
+        elif result.status_code == HTTPStatus.NOT_FOUND:
 
             command = [
                 'youtube-dl', '--dump-single-json', 'https://www.youtube.com/watch?v={}'.format(self.video_id)
@@ -178,14 +387,42 @@ class Youtube(Link):
                 if len(json_data['thumbnails']) == 0:
                     return None
 
-                response = requests.get(json_data["thumbnails"][-1]['url'], stream=True)
+                result = fetcher.fetch(json_data["thumbnails"][-1]['url'])
+                result.raise_for_error()
 
-                if response.status_code == HTTPStatus.OK:
-                    return Youtube._binary_stream_from_response(response)
+                if result.ok:
+                    return result.stream
 
         return None
 
 
+def fetch_previews(links, cache):
+    """
+    Downloads the preview images of `links` (a dict key -> Link) that are
+    neither cached nor known to be missing, all at once on the pool of the
+    fetcher. Returns a dict key -> FetchResult for the `preview` of
+    `Link.thumbnail_image_stream()`.
+    """
+    pending = {}
+
+    for key, link in links.items():
+        url = link.preview_url() if link.video_id is not None else None
+        if url is None or link._preview_key() in cache or link.thumbnail_missing(cache):
+            continue
+
+        #   A stream can be read once, the next link of the same video finds
+        #   the preview in the cache
+        if url not in pending.values():
+            pending[key] = url
+
+    if not pending:
+        return {}
+
+    results = fetcher.fetch_many(pending.values())
+
+    return {key: results[url] for key, url in pending.items()}
+
+
 def factory(link: str):
     o = urllib.parse.urlparse(link)
 
@@ -193,3 +430,27 @@ def factory(link: str):
         return Youtube(link)
 
     return Link(link)
+
+
+HOSTERS = {
+    Youtube.hoster: Youtube,
+}
+
+
+def link_metadata(url: str):
+    """The columns `link_kind`, `link_hoster` and `video_id` of a hit with this URL"""
+    link = factory(url)
+
+    return {
+        'link_kind': int(link.kind),
+        'link_hoster': link.hoster,
+        'video_id': link.video_id,
+    }
+
+
+def stored_link(url: str, kind, hoster, video_id):
+    """The link of a hit from its columns, parses only rows that were never backfilled"""
+    if kind is None:
+        return factory(url)
+
+    return HOSTERS.get(hoster, Link)(url, kind=kind, video_id=video_id)
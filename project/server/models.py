@@ -1,7 +1,9 @@
 # project/server/models.py
 
 import datetime
+import hashlib
 import json
+import time
 from pathlib import Path
 
 import jwt
@@ -9,14 +11,21 @@ from flask import current_app
 
 # from project.server import startup, models, bcrypt
 from sqlalchemy import ForeignKey
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from project.server import crypt
 from project.server.database import db
+from project.server.link import stored_link
 from sqlalchemy.orm import relationship
 
 DEFAULT_ALGORITHM = 'HS256'
 
 
+def token_digest(auth_token):
+    """SHA-256 of an auth token, as stored in `blacklist_tokens`"""
+    return hashlib.sha256(str(auth_token).encode()).hexdigest()
+
+
 def convert_json_data(s: dict, converter):
 
     for name, field_names in converter.items():
@@ -81,13 +90,22 @@ class User(db.Model):
         :param auth_token:
         :return: integer|string
         """
-        try:
-            payload = jwt.decode(auth_token, current_app.config.get('SECRET_KEY'), algorithms=DEFAULT_ALGORITHM)
-            is_blacklisted_token = BlacklistToken.check_blacklist(auth_token)
-            if is_blacklisted_token:
-                raise ValueError('Token blacklisted. Please log in again.')
+        payload = User.decode_signature(auth_token)
+
+        is_blacklisted_token = BlacklistToken.check_blacklist(auth_token)
+        if is_blacklisted_token:
+            raise ValueError('Token blacklisted. Please log in again.')
+
+        return payload
 
-            return payload
+    @staticmethod
+    def decode_signature(auth_token):
+        """
+        Checks signature and expiry of the auth token, but not the blacklist
+        (see `project.server.token_cache`)
+        """
+        try:
+            return jwt.decode(auth_token, current_app.config.get('SECRET_KEY'), algorithms=DEFAULT_ALGORITHM)
         except jwt.ExpiredSignatureError:
             raise ValueError('Signature expired. Please log in again.')
         except jwt.InvalidTokenError:
@@ -97,33 +115,94 @@ class User(db.Model):
 class Archive(db.Model):
 
     __tablename__ = "archive"
+    __table_args__ = (
+        db.Index('ix_archive_source_name', 'source', 'name', unique=True),
+    )
+
+    #   SQLite limits the number of bound parameters per statement
+    RESOLVE_CHUNK_SIZE = 400
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     source = db.Column(db.Text(), unique=False, nullable=False)
     name = db.Column(db.Text(), unique=False, nullable=False)
 
+    @staticmethod
+    def resolve(pairs):
+        """
+        Returns the subset of the given `(source, name)` pairs that are
+        archived, with one `(source, name) IN (...)` query per chunk.
+        """
+        pairs = list(set(pairs))
+        found = set()
+
+        for i in range(0, len(pairs), Archive.RESOLVE_CHUNK_SIZE):
+            chunk = pairs[i:i + Archive.RESOLVE_CHUNK_SIZE]
+
+            rows = db.session.query(Archive.source, Archive.name).\
+                filter(db.tuple_(Archive.source, Archive.name).in_(chunk)).all()
+
+            found.update((row.source, row.name) for row in rows)
+
+        return found
+
+    @staticmethod
+    def merge_duplicates(connection=None):
+        """Removes duplicate archive entries, needed before `ix_archive_source_name` can be created"""
+        if connection is None:
+            connection = db.session
+
+        rs = connection.execute(db.text(
+            'DELETE FROM archive WHERE id NOT IN (SELECT MIN(id) FROM archive GROUP BY source, name)'
+        ))
+        return rs.rowcount
+
 
 class BlacklistToken(db.Model):
     """
-    Token Model for storing JWT tokens
+    Revoked JWT tokens. Only the SHA-256 digest of a token is stored, with
+    its `exp`; once that has passed the token is refused anyway and its
+    row can go (see `purge()`).
     """
     __tablename__ = 'blacklist_tokens'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    token = db.Column(db.String(500), unique=True, nullable=False)
+    digest = db.Column(db.String(64), unique=True, nullable=False)
+    #   Expiry of the token in seconds since the epoch
+    exp = db.Column(db.Integer, nullable=False, index=True)
     blacklisted_on = db.Column(db.DateTime, nullable=False)
 
-    def __init__(self, token):
-        self.token = token
+    def __init__(self, token, exp):
+        self.digest = token_digest(token)
+        self.exp = int(exp)
         self.blacklisted_on = datetime.datetime.now()
 
     def __repr__(self):
-        return '<id: token: {}'.format(self.token)
+        return '<id: {} digest: {}>'.format(self.id, self.digest)
+
+    @staticmethod
+    def revoke(auth_token):
+        """
+        Blacklists the auth token and drops expired entries, the caller
+        commits. The token must have been verified before.
+        """
+        payload = jwt.decode(auth_token, options={'verify_signature': False, 'verify_exp': False})
+
+        BlacklistToken.purge()
+        db.session.add(BlacklistToken(token=str(auth_token), exp=payload['exp']))
+        Generation.bump(Generation.BLACKLIST)
+
+    @staticmethod
+    def purge(now=None):
+        """Deletes the entries of tokens expired by `now`, returns their number; the caller commits"""
+        if now is None:
+            now = time.time()
+
+        return BlacklistToken.query.filter(BlacklistToken.exp <= int(now)).delete(synchronize_session=False)
 
     @staticmethod
     def check_blacklist(auth_token):
         # check whether auth token has been blacklisted
-        res = BlacklistToken.query.filter_by(token=str(auth_token)).first()
+        res = BlacklistToken.query.filter_by(digest=token_digest(auth_token)).first()
         if res:
             return True
         else:
@@ -134,11 +213,23 @@ class Hit(db.Model):
     """
     Token Model for storing our hits brought by the external
     REST API.
+
+    There is exactly one row per canonical URL (see `project.server.ingest`), so a
+    row doubles as the summary of that URL: `id` is the first sighting,
+    `mtime` the last one and `visited` the number of visits.
     """
     __tablename__ = 'hits'
+    __table_args__ = (
+        db.Index('ix_hits_mtime_id', 'mtime', 'id'),
+        db.Index('ix_hits_hoster_video', 'link_hoster', 'video_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     url = db.Column(db.String(512), unique=False, nullable=False)
+    #   Hash of the canonical URL, see `project.server.link.canonical_url()`.
+    #   Nullable only for rows older than this column, `flask data dedupe`
+    #   fills them.
+    url_key = db.Column(db.String(32), unique=True, index=True, nullable=True)
     mtime = db.Column(db.DateTime, unique=False, nullable=False)
     title = db.Column(db.String(512), unique=False, nullable=False)
 
@@ -147,10 +238,139 @@ class Hit(db.Model):
 
     visited = db.Column(db.Integer, unique=False, nullable=False)
 
+    #   The parsed URL, see `project.server.link.link_metadata()`. NULL for
+    #   rows older than these columns, `flask data backfill-links` fills them.
+    link_kind = db.Column(db.Integer, nullable=True)
+    link_hoster = db.Column(db.String(32), nullable=True)
+    video_id = db.Column(db.String(64), nullable=True)
+
     order_id = db.Column(db.Integer, ForeignKey('orders.id'))
     order = relationship("Order", back_populates="hits")
     # order = relationship("Order", back_populates="hit")
 
+    @property
+    def link(self):
+        return stored_link(self.url, self.link_kind, self.link_hoster, self.video_id)
+
+    @staticmethod
+    def unarchived_videos(hoster, limit):
+        """The latest video hits of `hoster` without an archive entry, one query along `ix_hits_hoster_video`"""
+        return db.session.query(Hit).\
+            outerjoin(Archive, db.and_(Archive.source == Hit.link_hoster, Archive.name == Hit.video_id)).\
+            filter(Hit.link_hoster == hoster, Hit.video_id.is_not(None), Archive.id.is_(None)).\
+            order_by(Hit.mtime.desc(), Hit.id.desc()).\
+            limit(limit).all()
+
+    @staticmethod
+    def latest(limit, after=None, before=None):
+        """
+        Keyset pagination over `ix_hits_mtime_id`, newest first.
+
+        `after` and `before` are (mtime, id) keys: `after` returns the rows
+        older than the key, `before` the rows newer than it. Either way the
+        index is entered at the key, so every page costs the same.
+        """
+        key = db.tuple_(Hit.mtime, Hit.id)
+        query = db.session.query(Hit)
+
+        if before is not None:
+            rows = query.filter(key > db.tuple_(*before)).\
+                order_by(Hit.mtime.asc(), Hit.id.asc()).\
+                limit(limit).all()
+            rows.reverse()
+            return rows
+
+        if after is not None:
+            query = query.filter(key < db.tuple_(*after))
+
+        return query.order_by(Hit.mtime.desc(), Hit.id.desc()).limit(limit).all()
+
+
+class HitArchive(db.Model):
+    """
+    Hits that were moved out of `hits` by `flask data compact`, one row per
+    canonical URL with the visits summed up. `month` (YYYY-MM of the last
+    visit) partitions the table, see `project.server.retention`.
+    """
+    __tablename__ = 'hits_archive'
+    __table_args__ = (
+        db.Index('ix_hits_archive_mtime_id', 'mtime', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    #   `hits.id` of the row archived last; SQLite hands out the IDs of
+    #   deleted hits again, so it's no key
+    hit_id = db.Column(db.Integer, nullable=True)
+    url = db.Column(db.String(512), nullable=False)
+    url_key = db.Column(db.String(32), unique=True, index=True, nullable=False)
+    mtime = db.Column(db.DateTime, nullable=False)
+    title = db.Column(db.String(512), nullable=False)
+    visited = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.String(7), index=True, nullable=False)
+    archived_on = db.Column(db.DateTime, nullable=False)
+
+
+class HitRollup(db.Model):
+    """
+    Visits per hour and per day, overall (`domain` = '') and per domain.
+    Maintained by the ingest, see `project.server.rollups`.
+    """
+    __tablename__ = 'hit_rollups'
+    __table_args__ = (
+        db.Index('ix_hit_rollups_bucket', 'granularity', 'domain', 'bucket', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    granularity = db.Column(db.String(8), nullable=False)
+    domain = db.Column(db.String(255), nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)
+    visits = db.Column(db.Integer, nullable=False)
+
+
+class Generation(db.Model):
+    """
+    Change counters: every write to the tables behind a name bumps its
+    counter in the same transaction. Drives the ETags of the hit listings,
+    see `project.server.conditional`.
+    """
+    __tablename__ = 'generations'
+
+    HITS = 'hits'
+    ARCHIVE = 'archive'
+    BLACKLIST = 'blacklist'
+
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
+    changed_on = db.Column(db.DateTime, nullable=False)
+
+    @staticmethod
+    def bump(name, session=None):
+        """Counts up the generation `name`, the caller commits"""
+        if session is None:
+            session = db.session
+
+        table = Generation.__table__
+
+        statement = sqlite_insert(table).values(name=name, value=1, changed_on=datetime.datetime.now())
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={
+                'value': table.c.value + 1,
+                'changed_on': statement.excluded.changed_on,
+            },
+        )
+        session.execute(statement)
+
+    @staticmethod
+    def current(*names):
+        """Returns a dict name -> (value, changed_on), (0, None) for unknown names"""
+        rows = db.session.query(Generation.name, Generation.value, Generation.changed_on).\
+            filter(Generation.name.in_(names)).all()
+
+        found = {row.name: (row.value, row.changed_on) for row in rows}
+
+        return {name: found.get(name, (0, None)) for name in names}
+
 
 class YoutubeVideo(db.Model):
 
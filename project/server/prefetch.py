@@ -0,0 +1,145 @@
+# project/server/prefetch.py
+
+import logging
+import os
+import queue
+import threading
+import time
+from project.server.link import stored_link
+from project.server.tools.cache import thumbnail_cache
+
+logger = logging.getLogger()
+
+
+class ThumbnailPrefetcher:
+    """
+    Warms the thumbnail cache for new video hits in the background, so the
+    dashboard usually finds them ready.
+
+    `store_hits()` enqueues every new video link. A bounded queue feeds
+    `THUMBNAIL_PREFETCH_WORKERS` threads (the concurrency cap); when the
+    queue is full further links are dropped and rendered on demand as
+    before. A failing fetch is retried `THUMBNAIL_PREFETCH_RETRIES` times
+    with exponential backoff.
+    """
+    def __init__(self):
+        self.app = None
+
+        self.enabled = False
+        self.workers = 2
+        self.queue_size = 256
+        self.retries = 3
+        self.retry_delay = 2.0
+
+        self.queue = queue.Queue(self.queue_size)
+        self.pending = set()
+
+        self.done = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.busy = 0
+
+        self._threads = []
+        self._threads_pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+        self.enabled = app.config.get('THUMBNAIL_PREFETCH', False)
+        self.workers = app.config.get('THUMBNAIL_PREFETCH_WORKERS', self.workers)
+        self.queue_size = app.config.get('THUMBNAIL_PREFETCH_QUEUE', self.queue_size)
+        self.retries = app.config.get('THUMBNAIL_PREFETCH_RETRIES', self.retries)
+        self.retry_delay = app.config.get('THUMBNAIL_PREFETCH_RETRY_DELAY', self.retry_delay)
+
+        self.queue = queue.Queue(self.queue_size)
+        self.pending = set()
+
+    def enqueue(self, url, kind, hoster, video_id):
+        """Queues the thumbnail of a video link, returns False if it was dropped"""
+        if not self.enabled or video_id is None:
+            return False
+
+        key = (hoster, video_id)
+
+        with self._lock:
+            if key in self.pending:
+                return True
+
+            try:
+                self.queue.put_nowait((url, kind, hoster, video_id))
+            except queue.Full:
+                self.dropped += 1
+                return False
+
+            self.pending.add(key)
+
+        self._ensure_workers()
+        return True
+
+    def prefetch(self, url, kind, hoster, video_id):
+        link = stored_link(url, kind, hoster, video_id)
+
+        for attempt in range(self.retries + 1):
+            try:
+                stream = link.thumbnail_image_stream(thumbnail_cache.handle())
+                if stream is not None:
+                    stream.close()
+                return True
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception('Prefetching the thumbnail of {} failed'.format(url))
+                    return False
+
+                self.retried += 1
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def _run(self):
+        while True:
+            url, kind, hoster, video_id = self.queue.get()
+
+            with self._lock:
+                self.busy += 1
+
+            try:
+                if self.prefetch(url, kind, hoster, video_id):
+                    self.done += 1
+                else:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    self.pending.discard((hoster, video_id))
+                self.queue.task_done()
+
+    def _ensure_workers(self):
+        #   Like the spool flusher: uWSGI forks after loading the app, so
+        #   every process starts its own workers on first use.
+        with self._lock:
+            if self._threads_pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+
+            self._threads_pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._run, name='thumbnail-prefetch-{}'.format(i), daemon=True)
+                for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'workers': self.workers,
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue_size,
+            'busy': self.busy,
+            'done': self.done,
+            'failed': self.failed,
+            'retried': self.retried,
+            'dropped': self.dropped,
+        }
+
+
+thumbnail_prefetcher = ThumbnailPrefetcher()
@@ -0,0 +1,120 @@
+# project/server/renditions.py
+
+import io
+
+from PIL import Image
+
+#   Formats in order of preference: PIL format, mimetype, save() options
+RENDITION_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'image/png', {'optimize': True}),
+}
+
+RENDITION_SIZES = (128, 256, 512)
+RENDITION_SCALES = (1, 2)
+
+DEFAULT_SIZE = 256
+
+#   What every browser can show if it doesn't tell us more
+DEFAULT_FORMAT = 'jpeg'
+
+
+def negotiate_format(accept):
+    """
+    Picks the format for an `Accept` header (werkzeug's MIMEAccept). Only
+    formats the client names explicitly count, `*/*` alone gets JPEG.
+    """
+    named = {value.lower() for value, quality in accept if quality > 0}
+
+    best = None
+    for fmt, (_, mimetype, _) in RENDITION_FORMATS.items():
+        if mimetype not in named:
+            continue
+
+        if best is None or accept.quality(mimetype) > accept.quality(RENDITION_FORMATS[best][1]):
+            best = fmt
+
+    return best or DEFAULT_FORMAT
+
+
+class Rendition:
+    """One variant of a thumbnail: a box of `size` x `size` CSS pixels at `scale` in format `fmt`"""
+    def __init__(self, size=DEFAULT_SIZE, scale=1, fmt=DEFAULT_FORMAT):
+        if size not in RENDITION_SIZES:
+            raise ValueError('Size must be one of {}'.format(', '.join(map(str, RENDITION_SIZES))))
+        if scale not in RENDITION_SCALES:
+            raise ValueError('Scale must be one of {}'.format(', '.join(map(str, RENDITION_SCALES))))
+        if fmt not in RENDITION_FORMATS:
+            raise ValueError("Unknown format '{}'".format(fmt))
+
+        self.size = size
+        self.scale = scale
+        self.fmt = fmt
+
+    def __repr__(self):
+        return '<Rendition {}>'.format(self.key)
+
+    @staticmethod
+    def from_request(request, default_size=DEFAULT_SIZE):
+        """`?size=<px>&scale=<1|2>` of the request and the format for its `Accept` header"""
+        return Rendition(
+            size=request.args.get('size', default=default_size, type=int),
+            scale=request.args.get('scale', default=1, type=int),
+            fmt=negotiate_format(request.accept_mimetypes),
+        )
+
+    @property
+    def key(self):
+        return '{}x{}@{}.{}'.format(self.size, self.size, self.scale, self.fmt)
+
+    @property
+    def is_default(self):
+        return self.size == DEFAULT_SIZE and self.scale == 1 and self.fmt == DEFAULT_FORMAT
+
+    @property
+    def pixels(self):
+        return self.size * self.scale
+
+    @property
+    def mimetype(self):
+        return RENDITION_FORMATS[self.fmt][1]
+
+    @property
+    def extension(self):
+        return '.' + self.fmt
+
+    def render(self, image: Image.Image):
+        """Returns the bytes of `image` scaled into this rendition"""
+        image = image.copy()
+        image.thumbnail((self.pixels, self.pixels), Image.Resampling.LANCZOS)
+
+        return self.encode(image)
+
+    def encode(self, image: Image.Image):
+        """Returns the bytes of `image` in the format of this rendition, without scaling"""
+        pil_format, _, options = RENDITION_FORMATS[self.fmt]
+
+        if pil_format == 'JPEG':
+            image = flatten(image)
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        file_out = io.BytesIO()
+        image.save(file_out, format=pil_format, **options)
+
+        return file_out.getvalue()
+
+
+def flatten(image: Image.Image, background=(255, 255, 255)):
+    """JPEG has no alpha channel, transparent pixels become `background`"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, background)
+        flat.paste(image, mask=image.getchannel('A'))
+        return flat
+
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+
+    return image
@@ -0,0 +1,128 @@
+# project/server/retention.py
+
+import datetime
+import logging
+
+from sqlalchemy.dialects.sqlite import insert
+
+from project.server.database import db
+from project.server.link import canonical_url, url_key
+from project.server.models import Hit, HitArchive, Generation
+
+logger = logging.getLogger()
+
+COMPACT_BATCH_SIZE = 1000
+
+
+class CompactResult:
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self.rows = 0
+        self.visits = 0
+        self.months = set()
+
+    def as_json(self):
+        return {
+            'cutoff': self.cutoff.strftime("%Y-%m-%d %H:%M:%S"),
+            'rows': self.rows,
+            'visits': self.visits,
+            'months': sorted(self.months),
+        }
+
+
+def totals():
+    """Rows and visits of the hot table and the archive"""
+    hot = db.session.query(db.func.count(Hit.id), db.func.coalesce(db.func.sum(Hit.visited), 0)).one()
+    archived = db.session.query(db.func.count(HitArchive.id),
+                                db.func.coalesce(db.func.sum(HitArchive.visited), 0)).one()
+
+    return {
+        'hot': {'rows': hot[0], 'visits': hot[1]},
+        'archive': {'rows': archived[0], 'visits': archived[1]},
+        'visits': hot[1] + archived[1],
+    }
+
+
+def compact_hits(days, batch_size=COMPACT_BATCH_SIZE, dry_run=False):
+    """
+    Moves every hit whose last visit is older than `days` days from `hits`
+    into `hits_archive`. A URL that is archived already gets its visits
+    added to the archived row, so no visit is lost; the visits over time
+    stay in `hit_rollups`. Commits after every batch. With `dry_run` the
+    rows are only counted.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    result = CompactResult(cutoff)
+
+    if dry_run:
+        month = db.func.strftime('%Y-%m', Hit.mtime)
+
+        rows = db.session.query(
+            month,
+            db.func.count(Hit.id),
+            db.func.coalesce(db.func.sum(Hit.visited), 0),
+        ).filter(Hit.mtime < cutoff).group_by(month).all()
+
+        for month, n, visits in rows:
+            result.rows += n
+            result.visits += visits
+            result.months.add(month)
+
+        return result
+
+    archive = HitArchive.__table__
+    archived_on = datetime.datetime.now()
+
+    statement = insert(archive)
+    #   A URL that was archived before: sum up its visits
+    statement = statement.on_conflict_do_update(
+        index_elements=[archive.c.url_key],
+        set_={
+            'hit_id': statement.excluded.hit_id,
+            'visited': archive.c.visited + statement.excluded.visited,
+            'mtime': db.func.max(archive.c.mtime, statement.excluded.mtime),
+            'month': db.func.max(archive.c.month, statement.excluded.month),
+            'archived_on': statement.excluded.archived_on,
+        },
+    )
+
+    while True:
+        #   Walks ix_hits_mtime_id from the oldest row on
+        rows = db.session.query(Hit).filter(Hit.mtime < cutoff).\
+            order_by(Hit.mtime, Hit.id).limit(batch_size).all()
+
+        if not rows:
+            break
+
+        entries = []
+
+        for hit in rows:
+            visited = hit.visited or 1
+            month = hit.mtime.strftime('%Y-%m')
+
+            entries.append({
+                'hit_id': hit.id,
+                'url': hit.url,
+                'url_key': hit.url_key or url_key(canonical_url(hit.url)),
+                'mtime': hit.mtime,
+                'title': hit.title,
+                'visited': visited,
+                'month': month,
+                'archived_on': archived_on,
+            })
+
+            result.rows += 1
+            result.visits += visited
+            result.months.add(month)
+
+        db.session.execute(statement, entries)
+
+        db.session.query(Hit).filter(Hit.id.in_([hit.id for hit in rows])).\
+            delete(synchronize_session=False)
+
+        Generation.bump(Generation.HITS)
+        db.session.commit()
+
+    logger.info('Compacted {} hits older than {}'.format(result.rows, cutoff))
+
+    return result
@@ -0,0 +1,122 @@
+# project/server/rollups.py
+
+import datetime
+from collections import Counter
+
+from sqlalchemy.dialects.sqlite import insert
+
+from project.server.database import db, SQLITE_MAX_VARIABLES
+from project.server.link import domain_of
+from project.server.models import HitRollup
+
+GRANULARITIES = ('hour', 'day')
+
+#   `domain` of the rollups over all domains
+ALL_DOMAINS = ''
+
+#   Rollups per upsert, each binds four columns
+ROLLUP_CHUNK_SIZE = SQLITE_MAX_VARIABLES // 4
+
+
+def bucket_of(mtime: datetime.datetime, granularity):
+    if granularity == 'hour':
+        return mtime.replace(minute=0, second=0, microsecond=0)
+
+    return mtime.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def step_of(granularity):
+    if granularity == 'hour':
+        return datetime.timedelta(hours=1)
+
+    return datetime.timedelta(days=1)
+
+
+def count_visit(counts: Counter, url, mtime):
+    """Adds one visit of `url` at `mtime` to the rollup `counts`"""
+    domain = domain_of(url)
+
+    for granularity in GRANULARITIES:
+        bucket = bucket_of(mtime, granularity)
+
+        counts[(granularity, ALL_DOMAINS, bucket)] += 1
+        if domain:
+            counts[(granularity, domain, bucket)] += 1
+
+
+def store_rollups(counts: Counter, session=None):
+    """Adds `counts` to the rollup table with one upsert per chunk. The caller commits."""
+    if session is None:
+        session = db.session
+
+    rollups = HitRollup.__table__
+
+    entries = [
+        {
+            'granularity': granularity,
+            'domain': domain,
+            'bucket': bucket,
+            'visits': visits,
+        }
+        for (granularity, domain, bucket), visits in counts.items()
+    ]
+
+    for i in range(0, len(entries), ROLLUP_CHUNK_SIZE):
+        statement = insert(rollups).values(entries[i:i + ROLLUP_CHUNK_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=[rollups.c.granularity, rollups.c.domain, rollups.c.bucket],
+            set_={
+                'visits': rollups.c.visits + statement.excluded.visits,
+            },
+        )
+        session.execute(statement)
+
+
+def series(granularity, since, until, domain=ALL_DOMAINS):
+    """
+    Visits per bucket between `since` and `until`, buckets without visits
+    included. Returns a list of (bucket, visits).
+    """
+    since = bucket_of(since, granularity)
+
+    rows = db.session.query(HitRollup.bucket, HitRollup.visits).filter(
+        HitRollup.granularity == granularity,
+        HitRollup.domain == domain,
+        HitRollup.bucket >= since,
+        HitRollup.bucket <= until,
+    ).all()
+
+    visits = {row.bucket: row.visits for row in rows}
+
+    result = []
+    bucket = since
+    step = step_of(granularity)
+
+    while bucket <= until:
+        result.append((bucket, visits.get(bucket, 0)))
+        bucket += step
+
+    return result
+
+
+def heatmap(hour_series):
+    """Sums an hourly series into a 7 x 24 matrix, Monday first"""
+    matrix = [[0] * 24 for _ in range(7)]
+
+    for bucket, visits in hour_series:
+        matrix[bucket.weekday()][bucket.hour] += visits
+
+    return matrix
+
+
+def top_domains(since, until, limit=10):
+    visits = db.func.sum(HitRollup.visits).label('visits')
+
+    rows = db.session.query(HitRollup.domain, visits).filter(
+        HitRollup.granularity == 'day',
+        HitRollup.domain != ALL_DOMAINS,
+        HitRollup.bucket >= bucket_of(since, 'day'),
+        HitRollup.bucket <= until,
+    ).group_by(HitRollup.domain).order_by(visits.desc()).limit(limit).all()
+
+    return [(row.domain, row.visits) for row in rows]
@@ -0,0 +1,133 @@
+# project/server/schema.py
+
+import logging
+import time
+
+import jwt
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from project.server.database import db
+from project.server.models import Archive, BlacklistToken, token_digest
+
+logger = logging.getLogger()
+
+#   Indexes of earlier versions the models don't have anymore: the unique
+#   URL, which the canonical `url_key` replaced
+OBSOLETE_INDEXES = ['ix_hits_url']
+
+#   Commands that fill a new column for the rows that are already there
+BACKFILLS = {
+    'hits.url_key': 'flask data dedupe',
+    'hits.link_kind': 'flask data backfill-links',
+}
+
+#   Cleanups the data of older versions needs before a unique index fits
+BEFORE_INDEX = {
+    'ix_archive_source_name': Archive.merge_duplicates,
+}
+
+
+def upgrade_schema(connection):
+    """
+    Brings the tables of an existing database up to the models.
+    `db.create_all()` creates missing tables but never touches existing
+    ones, so this rebuilds tables whose layout changed and adds the columns
+    and indexes that are missing. Every step looks at the database first,
+    so it runs at every start. Returns a description of every change.
+    """
+    changes = []
+
+    changes.extend(_rebuild_blacklist_tokens(connection))
+
+    for name in OBSOLETE_INDEXES:
+        if connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)
+        ).first():
+            connection.exec_driver_sql('DROP INDEX {}'.format(name))
+            changes.append('Dropped the index {}'.format(name))
+
+    inspector = inspect(connection)
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            if not column.nullable:
+                raise RuntimeError("Can't add the NOT NULL column {}.{} to an existing table".format(
+                    table.name, column.name))
+
+            connection.exec_driver_sql('ALTER TABLE {} ADD COLUMN {}'.format(
+                table.name, CreateColumn(column).compile(dialect=connection.dialect)))
+            changes.append('Added the column {}.{}'.format(table.name, column.name))
+
+            backfill = BACKFILLS.get('{}.{}'.format(table.name, column.name))
+            if backfill:
+                logger.warning('Run `{}` to fill {}.{} of the existing rows'.format(
+                    backfill, table.name, column.name))
+
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name in indexes:
+                continue
+
+            cleanup = BEFORE_INDEX.get(index.name)
+            if cleanup:
+                removed = cleanup(connection)
+                if removed:
+                    changes.append('Removed {} rows of {} that {} refuses'.format(removed, table.name, index.name))
+
+            index.create(connection)
+            changes.append('Created the index {}'.format(index.name))
+
+    for change in changes:
+        logger.info(change)
+
+    return changes
+
+
+def _columns(connection, name):
+    return {row[1] for row in connection.exec_driver_sql('PRAGMA table_info({})'.format(name))}
+
+
+def _rebuild_blacklist_tokens(connection):
+    """
+    `blacklist_tokens` used to keep the whole token. The tokens that are
+    still valid move over as digest and `exp`, expired ones are dropped.
+    """
+    columns = _columns(connection, 'blacklist_tokens')
+    if 'token' not in columns or 'digest' in columns:
+        return []
+
+    rows = connection.exec_driver_sql('SELECT token, blacklisted_on FROM blacklist_tokens').all()
+
+    connection.exec_driver_sql('DROP TABLE blacklist_tokens')
+    BlacklistToken.__table__.create(connection)
+
+    now = time.time()
+    entries = {}
+
+    for token, blacklisted_on in rows:
+        try:
+            payload = jwt.decode(token, options={'verify_signature': False, 'verify_exp': False})
+            exp = int(payload['exp'])
+        except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+            continue
+
+        if exp > now:
+            entries[token_digest(token)] = (exp, blacklisted_on)
+
+    if entries:
+        #   blacklisted_on is copied as it's stored
+        connection.exec_driver_sql(
+            'INSERT INTO blacklist_tokens (digest, exp, blacklisted_on) VALUES (?, ?, ?)',
+            [(digest, exp, blacklisted_on) for digest, (exp, blacklisted_on) in entries.items()])
+
+    return ['Rebuilt blacklist_tokens with {} of {} tokens, the others had expired'.format(len(entries), len(rows))]
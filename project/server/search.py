@@ -0,0 +1,121 @@
+# project/server/search.py
+
+import html
+import logging
+import re
+
+from project.server.database import db
+
+logger = logging.getLogger()
+
+#   An external content FTS5 table over `hits`. The triggers keep it in sync
+#   with every insert, delete and title/url change; the ingest upsert only
+#   touches `visited` and `mtime` of known URLs and doesn't fire them.
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS hits_fts USING fts5("
+    "title, url, content='hits', content_rowid='id', tokenize='unicode61')",
+
+    "CREATE TRIGGER IF NOT EXISTS hits_fts_insert AFTER INSERT ON hits BEGIN "
+    "INSERT INTO hits_fts(rowid, title, url) VALUES (new.id, new.title, new.url); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS hits_fts_delete AFTER DELETE ON hits BEGIN "
+    "INSERT INTO hits_fts(hits_fts, rowid, title, url) VALUES ('delete', old.id, old.title, old.url); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS hits_fts_update AFTER UPDATE OF title, url ON hits BEGIN "
+    "INSERT INTO hits_fts(hits_fts, rowid, title, url) VALUES ('delete', old.id, old.title, old.url); "
+    "INSERT INTO hits_fts(rowid, title, url) VALUES (new.id, new.title, new.url); "
+    "END",
+]
+
+#   bm25() weights of the columns title and url
+RANK_WEIGHTS = (10.0, 1.0)
+
+#   Markers for snippet(), replaced by <mark> after the text was escaped
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+
+def ensure_search_index(connection):
+    """
+    Creates the search index if it's missing and fills it from `hits`.
+    Returns True if the index had to be created.
+    """
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hits_fts'"
+    ).first()
+
+    for statement in SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+
+    if exists:
+        return False
+
+    rebuild_search_index(connection)
+    return True
+
+
+def rebuild_search_index(connection):
+    connection.exec_driver_sql("INSERT INTO hits_fts(hits_fts) VALUES ('rebuild')")
+
+
+def match_expression(text):
+    """
+    Turns user input into a FTS5 query: every word is quoted (so no FTS5
+    syntax gets through) and the last one is a prefix search.
+    """
+    words = [w for w in re.split(r'\s+', text.strip()) if w]
+    if not words:
+        return None
+
+    terms = ['"{}"'.format(w.replace('"', '""')) for w in words]
+    terms[-1] += '*'
+
+    return ' '.join(terms)
+
+
+def highlighted(snippet):
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search_hits(text, limit=20, offset=0):
+    """
+    Ranked full text search over the titles and URLs of our hits. Returns
+    a list of dicts with the hit columns and HTML snippets (escaped, with
+    the matches in <mark>).
+    """
+    expression = match_expression(text)
+    if expression is None:
+        return []
+
+    rs = db.session.execute(db.text(
+        'SELECT hits.id, hits.title, hits.url, hits.mtime, hits.visited, '
+        '  snippet(hits_fts, 0, :start, :end, \'…\', 12) AS title_snippet, '
+        '  snippet(hits_fts, 1, :start, :end, \'…\', 12) AS url_snippet '
+        'FROM hits_fts JOIN hits ON hits.id = hits_fts.rowid '
+        'WHERE hits_fts MATCH :expression '
+        'ORDER BY bm25(hits_fts, {:f}, {:f}) '
+        'LIMIT :limit OFFSET :offset'.format(*RANK_WEIGHTS)
+    ).columns(mtime=db.DateTime), {
+        'start': MARK_START,
+        'end': MARK_END,
+        'expression': expression,
+        'limit': limit,
+        'offset': offset,
+    })
+
+    return [
+        {
+            'id': row.id,
+            'title': row.title,
+            'url': row.url,
+            'mtime': row.mtime,
+            'visited': row.visited,
+            'snippet': {
+                'title': highlighted(row.title_snippet),
+                'url': highlighted(row.url_snippet),
+            },
+        }
+        for row in rs
+    ]
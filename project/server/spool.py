@@ -0,0 +1,337 @@
+# project/server/spool.py
+
+import fcntl
+import io
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from project.server.database import db
+from project.server.ingest import store_hits
+
+logger = logging.getLogger()
+
+
+class HitSpool:
+    """
+    Write-behind buffer for `/hits/collection`.
+
+    A request appends its validated batch as one JSON line to an append-only
+    file and returns at once. A background thread in every process (or
+    `flask data flush`) merges the spooled batches into `hits`, committing
+    once per `HITS_SPOOL_FLUSH_HITS` hits instead of once per request.
+
+    Files in `HITS_SPOOL_DIRECTORY`:
+
+        hits.ndjson             new batches are appended here
+        hits.flushing.ndjson    the segment that is currently merged
+        hits.flushing.offset    bytes of the segment that are committed
+        hits.dead.ndjson        batches that failed `HITS_SPOOL_MAX_ATTEMPTS`
+                                flushes, with their error
+        flush.lock              only one process flushes at a time
+    """
+    SPOOL_NAME = 'hits.ndjson'
+    SEGMENT_NAME = 'hits.flushing.ndjson'
+    OFFSET_NAME = 'hits.flushing.offset'
+    DEAD_NAME = 'hits.dead.ndjson'
+    LOCK_NAME = 'flush.lock'
+
+    def __init__(self):
+        self.app = None
+        self.directory = None
+
+        self.enabled = False
+        self.flush_interval = 5
+        self.flush_hits = 5000
+        self.flush_bytes = 1024 * 1024
+        self.max_bytes = 64 * 1024 * 1024
+        self.max_lag = 60
+        self.max_attempts = 3
+
+        self.last_flush_at = None
+        self.flushed_batches = 0
+        self.flushed_hits = 0
+        self.dead_batches = 0
+
+        #   (inode of the segment, offset of the batch) -> failed flushes
+        self._attempts = {}
+
+        self._thread = None
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+
+        self.enabled = app.config.get('HITS_SPOOL', False)
+        self.directory = Path(app.config.get('HITS_SPOOL_DIRECTORY', Path(app.instance_path) / 'spool'))
+        self.flush_interval = app.config.get('HITS_SPOOL_FLUSH_INTERVAL', self.flush_interval)
+        self.flush_hits = app.config.get('HITS_SPOOL_FLUSH_HITS', self.flush_hits)
+        self.flush_bytes = app.config.get('HITS_SPOOL_FLUSH_BYTES', self.flush_bytes)
+        self.max_bytes = app.config.get('HITS_SPOOL_MAX_BYTES', self.max_bytes)
+        self.max_lag = app.config.get('HITS_SPOOL_MAX_LAG', self.max_lag)
+        self.max_attempts = app.config.get('HITS_SPOOL_MAX_ATTEMPTS', self.max_attempts)
+
+    def path(self, name) -> Path:
+        return self.directory / name
+
+    @staticmethod
+    def _size(path: Path):
+        try:
+            return path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _offset(self):
+        try:
+            return int(self.path(HitSpool.OFFSET_NAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        p = self.path(HitSpool.OFFSET_NAME)
+        p_tmp = p.with_suffix('.tmp')
+        p_tmp.write_text(str(offset))
+        os.replace(p_tmp, p)
+
+    def pending_bytes(self):
+        return self._size(self.path(HitSpool.SPOOL_NAME)) + \
+               self._size(self.path(HitSpool.SEGMENT_NAME)) - self._offset()
+
+    def accepts(self):
+        """False if the spool is disabled or full, callers ingest synchronously then"""
+        return self.enabled and self.pending_bytes() < self.max_bytes
+
+    def append(self, hits):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        line = json.dumps({'spooled_at': time.time(), 'hits': hits}, separators=(',', ':')).encode() + b"\n"
+
+        spool_path = self.path(HitSpool.SPOOL_NAME)
+
+        while True:
+            with io.open(spool_path, 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+                #   The flusher may have renamed the file while we were
+                #   waiting for the lock, our line belongs into a new one.
+                try:
+                    if os.fstat(f.fileno()).st_ino != os.stat(spool_path).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+                break
+
+        self._ensure_flusher()
+
+        if self.pending_bytes() >= self.flush_bytes or self.lag() >= self.max_lag:
+            self._wakeup.set()
+
+    def _oldest_pending(self):
+        candidates = [
+            (self.path(HitSpool.SEGMENT_NAME), self._offset()),
+            (self.path(HitSpool.SPOOL_NAME), 0),
+        ]
+
+        for p, offset in candidates:
+            try:
+                with io.open(p, 'rb') as f:
+                    f.seek(offset)
+                    line = f.readline()
+            except FileNotFoundError:
+                continue
+
+            try:
+                return json.loads(line)['spooled_at']
+            except (ValueError, KeyError):
+                continue
+
+        return None
+
+    def lag(self):
+        """Age in seconds of the oldest batch that is not in `hits` yet"""
+        oldest = self._oldest_pending()
+        if oldest is None:
+            return 0.0
+
+        return max(0.0, time.time() - oldest)
+
+    def stats(self):
+        lag = self.lag()
+
+        return {
+            'enabled': self.enabled,
+            'pending_bytes': self.pending_bytes(),
+            'lag_seconds': round(lag, 3),
+            'max_lag_seconds': self.max_lag,
+            'lag_exceeded': lag > self.max_lag,
+            'last_flush_at': self.last_flush_at,
+            'flushed_batches': self.flushed_batches,
+            'flushed_hits': self.flushed_hits,
+            'dead_batches': self.dead_batches,
+            'dead_bytes': self._size(self.path(HitSpool.DEAD_NAME)),
+        }
+
+    def _rotate(self):
+        spool_path = self.path(HitSpool.SPOOL_NAME)
+
+        if self._size(spool_path) == 0:
+            return False
+
+        with io.open(spool_path, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            os.replace(spool_path, self.path(HitSpool.SEGMENT_NAME))
+
+        self._write_offset(0)
+        return True
+
+    def flush(self):
+        """
+        Merges all spooled batches into `hits`. Returns the number of
+        batches, or None when another process is flushing right now.
+        """
+        if not self.directory.exists():
+            return 0
+
+        with io.open(self.path(HitSpool.LOCK_NAME), 'ab') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            batches = 0
+
+            while self.path(HitSpool.SEGMENT_NAME).exists() or self._rotate():
+                batches += self._flush_segment()
+
+            self.last_flush_at = time.time()
+            return batches
+
+    def _flush_segment(self):
+        segment_path = self.path(HitSpool.SEGMENT_NAME)
+
+        batches = 0
+        rows = []
+        #   (start offset, end offset, line) of the batches in `rows`
+        group = []
+
+        def commit(offset):
+            try:
+                store_hits(rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                #   Find the batch that fails, the others are stored
+                for start, end, line in group:
+                    self._flush_batch(segment_path, start, end, line)
+                return
+
+            self._write_offset(offset)
+
+            self.flushed_hits += len(rows)
+            self.flushed_batches += len(group)
+
+        with io.open(segment_path, 'rb') as f:
+            f.seek(self._offset())
+
+            while True:
+                start = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+
+                try:
+                    rows.extend(json.loads(line)['hits'])
+                    group.append((start, f.tell(), line))
+                    batches += 1
+                except (ValueError, KeyError, TypeError):
+                    logger.error('Skipping a broken line in {}'.format(segment_path))
+
+                if len(rows) >= self.flush_hits:
+                    commit(f.tell())
+                    rows = []
+                    group = []
+
+            if rows:
+                commit(f.tell())
+
+        segment_path.unlink()
+        self.path(HitSpool.OFFSET_NAME).unlink(missing_ok=True)
+        self._attempts.clear()
+
+        return batches
+
+    def _flush_batch(self, segment_path, start, end, line):
+        """
+        Stores a single batch after its group failed. A batch that failed
+        `max_attempts` flushes goes to the dead letter file, so the batches
+        behind it don't wait forever; until then the error is raised and
+        the next flush tries again.
+        """
+        hits = json.loads(line)['hits']
+
+        try:
+            store_hits(hits)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+
+            key = (segment_path.stat().st_ino, start)
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+
+            if self._attempts[key] < self.max_attempts:
+                raise
+
+            self._dead_letter(line, e)
+            del self._attempts[key]
+        else:
+            self.flushed_hits += len(hits)
+            self.flushed_batches += 1
+
+        self._write_offset(end)
+
+    def _dead_letter(self, line, error):
+        logger.error('Moving a spooled batch that failed {} flushes to {}: {}'.format(
+            self.max_attempts, HitSpool.DEAD_NAME, error))
+
+        entry = dict(json.loads(line), failed_at=time.time(), error=str(error))
+
+        with io.open(self.path(HitSpool.DEAD_NAME), 'ab') as f:
+            f.write(json.dumps(entry, separators=(',', ':')).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.dead_batches += 1
+
+    def _ensure_flusher(self):
+        #   uWSGI forks its workers after loading the app, so the thread is
+        #   started lazily in the process that spools.
+        with self._thread_lock:
+            if self._thread is not None and self._thread_pid == os.getpid() and self._thread.is_alive():
+                return
+
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='hit-spool-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                logger.exception('Flushing the hit spool failed')
+
+
+spool = HitSpool()
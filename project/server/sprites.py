@@ -0,0 +1,149 @@
+# project/server/sprites.py
+
+import logging
+import math
+
+from diskcache import Lock
+from PIL import Image
+from requests import RequestException
+
+from project.server.link import working_checksum, fetch_previews, Link, THUMBNAIL_LOCK_EXPIRE, \
+    THUMBNAIL_MISSING_TTL
+from project.server.renditions import Rendition
+
+logger = logging.getLogger()
+
+SPRITE_COLUMNS = 5
+
+#   A dashboard page has 20 rows
+MAXIMAL_SPRITE_IDS = 50
+
+
+class SpriteLayout:
+    """
+    Where the tiles of a sprite sheet are. Every tile is a cell of
+    `size` x `size` CSS pixels, filled row by row in the order of `ids`.
+    The image has `scale` image pixels per CSS pixel.
+    """
+    def __init__(self, ids, size, scale=1, columns=SPRITE_COLUMNS):
+        self.ids = list(dict.fromkeys(ids))
+        self.size = size
+        self.scale = scale
+        self.columns = max(1, min(columns, len(self.ids)))
+        self.rows = math.ceil(len(self.ids) / self.columns)
+
+    @property
+    def width(self):
+        return self.columns * self.size
+
+    @property
+    def height(self):
+        return self.rows * self.size
+
+    def offset(self, i):
+        return (i % self.columns) * self.size, (i // self.columns) * self.size
+
+    def tiles(self):
+        """hit id -> offset of its cell, in CSS pixels"""
+        tiles = {}
+        for i, hit_id in enumerate(self.ids):
+            x, y = self.offset(i)
+            tiles[hit_id] = {'x': x, 'y': y, 'width': self.size, 'height': self.size}
+        return tiles
+
+    def as_json(self):
+        return {
+            'width': self.width,
+            'height': self.height,
+            'size': self.size,
+            'tiles': {str(hit_id): tile for hit_id, tile in self.tiles().items()},
+        }
+
+
+def _tile(link, cache, rendition, preview=None):
+    """The thumbnail of `link` as an image, None for the placeholder; False if it may work later"""
+    if link is None:
+        return None
+
+    try:
+        stream = link.thumbnail_image_stream(cache, rendition, preview)
+
+        if stream is None:
+            return None
+
+        with stream:
+            image = Image.open(stream)
+            image.load()
+            return image
+
+    except RequestException:
+        return False
+
+    except OSError as e:
+        #   Also PIL.UnidentifiedImageError: a broken preview or thumbnail
+        logger.warning('Broken thumbnail of video {}: {}'.format(link.video_id, e))
+        return None
+
+
+def render_sprite(layout, links, cache, rendition):
+    """
+    Composites the thumbnails of `links` (hit id -> Link, missing ones are
+    placeholders) into one image in the format of `rendition`. The sprite
+    is cached under the ID list, the videos and the rendition; SQLite hands
+    out the IDs of deleted hits again. Missing preview images are
+    downloaded at once by `fetch_previews()`. Returns its bytes.
+    """
+    videos = ['{}:{}'.format(hit_id, links[hit_id].video_id if links.get(hit_id) else '') for hit_id in layout.ids]
+    description = 'Sprite of {} as {}'.format(','.join(videos), rendition.key)
+    sprite_hex_digest = working_checksum(description)
+
+    data = cache.get(sprite_hex_digest)
+    if data is not None:
+        return data
+
+    with Lock(cache, 'lock-' + sprite_hex_digest, expire=THUMBNAIL_LOCK_EXPIRE):
+        data = cache.get(sprite_hex_digest)
+        if data is not None:
+            return data
+
+        #   Tiles are rendered lossless, only the sprite is compressed
+        tile_rendition = Rendition(size=layout.size, scale=layout.scale, fmt='png')
+
+        previews = fetch_previews({hit_id: links[hit_id] for hit_id in layout.ids if links.get(hit_id)}, cache)
+
+        try:
+            tiles = [_tile(links.get(hit_id), cache, tile_rendition, previews.get(hit_id)) for hit_id in layout.ids]
+        finally:
+            for result in previews.values():
+                if result.stream is not None:
+                    result.stream.close()
+
+        cell = layout.size * layout.scale
+        sprite = Image.new('RGBA', (layout.width * layout.scale, layout.height * layout.scale), (0, 0, 0, 0))
+
+        with Image.open(Link.placeholder_stream()) as placeholder:
+            placeholder.thumbnail((cell, cell))
+            placeholder = placeholder.convert('RGBA')
+
+        for i, tile in enumerate(tiles):
+            image = tile or placeholder
+
+            x, y = layout.offset(i)
+            x, y = x * layout.scale, y * layout.scale
+
+            #   Centered in its cell like the single thumbnails
+            sprite.paste(image.convert('RGBA'), (x + (cell - image.width) // 2, y + (cell - image.height) // 2))
+
+        #   The sprite is already at its final size
+        data = rendition.encode(sprite)
+
+        #   A sprite with placeholders is built again once the negative
+        #   cache may have changed its mind, one with failed tiles at once
+        if False in tiles:
+            logger.info('Not caching {}, some thumbnails failed'.format(description))
+        elif None in tiles:
+            cache.set(sprite_hex_digest, data, expire=THUMBNAIL_MISSING_TTL)
+        else:
+            cache.set(sprite_hex_digest, data)
+
+        return data
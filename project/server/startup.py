@@ -1,6 +1,7 @@
 # project/server/__init__.py
 
 import datetime
+import gzip
 import io
 import logging
 import os
@@ -23,11 +24,24 @@ from project.diary import diary_blueprint
 from project.gallery import gallery_blueprint
 from project.hits import hits_blueprint
 from project.markdown import markdown_blueprint
+from project.middleware.decompress import RequestDecompression
 from project.order import order_blueprint
+from project.server.conditional import response_cache
 from project.server.crypt import bcrypt
 from project.server.database import db
-from project.server.models import User, MyUser, Hit
-from project.server.tools.cache import cache
+from project.server.export import export_hits, parse_since, EXPORT_FORMATS
+from project.server.fetcher import fetcher
+from project.server.identity import identity_cache
+from project.server.ingest import canonicalize_hits, backfill_link_metadata, import_hits, IMPORT_FORMATS, IMPORT_CHUNK_SIZE
+from project.server.models import User, MyUser, Archive, BlacklistToken
+from project.server.retention import compact_hits, totals, COMPACT_BATCH_SIZE
+from project.server.prefetch import thumbnail_prefetcher
+from project.server.schema import upgrade_schema
+from project.server.search import ensure_search_index, rebuild_search_index
+from project.server.spool import spool
+from project.server.video_index import video_index
+from project.server.token_cache import token_cache
+from project.server.tools.cache import cache, thumbnail_cache
 from project.storage import storage_blueprint
 from project.user import user_blueprint
 from project.v1.order import REST_Order_POST, REST_Order_GET, \
@@ -43,43 +57,70 @@ def root():
     return redirect(url_for("user.login"))
 
 
-def cli_db_import(filename):
+def cli_db_import(filename, fmt=None, chunk_size=IMPORT_CHUNK_SIZE):
 
-    with io.open(filename) as f:
-        for line in f.readlines():
-            line = line.rstrip("\n")
+    path = Path(filename)
+    suffixes = path.suffixes
 
-            data = line.split("\t")
+    if fmt is None:
+        fmt = 'ndjson' if set(suffixes) & {'.ndjson', '.jsonl'} else 'tsv'
 
-            click.echo(data)
+    def progress(state):
+        click.echo("{:>12} lines, {:>12} hits, {:>8} skipped, {:>10.1f} hits/s".format(
+            state.lines, state.result.received, state.skipped, state.rate))
 
-            youtube_hit = Hit(
-                url=data[0],
-                mtime=datetime.datetime.fromtimestamp(int(data[1])/1000),
-                title=data[2],
-            )
-            db.session.add(youtube_hit)
+    if filename == '-':
+        f = click.get_binary_stream('stdin')
+    elif '.gz' in suffixes:
+        f = gzip.open(path, 'rb')
+    else:
+        f = io.open(path, 'rb')
 
-    db.session.commit()
+    with f:
+        state = import_hits(f, fmt=fmt, chunk_size=chunk_size, progress=progress)
+
+    click.echo("Imported {} hits ({} new, {} updated, {} lines skipped) in {:.1f}s".format(
+        state.result.received, state.result.inserted, state.result.updated, state.skipped, state.seconds))
+
+
+def cli_db_export(filename, fmt=None, since=None):
+
+    path = Path(filename)
+    suffixes = path.suffixes
+
+    if fmt is None:
+        fmt = 'csv' if '.csv' in suffixes else 'ndjson'
+
+    if filename == '-':
+        f = click.get_binary_stream('stdout')
+        compress = False
+    else:
+        f = io.open(path, 'wb')
+        compress = '.gz' in suffixes
+
+    size = 0
+    with f:
+        for chunk in export_hits(fmt=fmt, since=since, gzip=compress):
+            f.write(chunk)
+            size += len(chunk)
+
+    if filename != '-':
+        click.echo("Exported {} bytes to {}".format(size, filename))
 
 
 def install_decorator_for_load_user(app, login_manager):
     @login_manager.user_loader
     def load_user(user_id):
-        app.logger.debug('load_user({})'.format(user_id))
-
-        user_in_database = db.session.query(User).filter(User.id == int(user_id)).one_or_none()
+        app.logger.debug('load_user(%s)', user_id)
 
-        user = MyUser(user_in_database)
-
-        return user
+        return MyUser(identity_cache.get(user_id))
 
 
 def install_decorator_for_request_loader(app, login_manager):
     @login_manager.request_loader
     def load_user_from_request(r):
         authorization_header = r.headers.get('Authorization', None)
-        app.logger.debug('Authorization = {}'.format(authorization_header))
+        app.logger.debug('Authorization = %s', authorization_header)
         if authorization_header is None:
             return None
 
@@ -88,28 +129,114 @@ def install_decorator_for_request_loader(app, login_manager):
             return None
 
         try:
-            payload = User.decode_auth_token(m.group(1))
-            logger.debug(payload)
+            payload = token_cache.verify(m.group(1))
+            logger.debug('payload = %s', payload)
             user_id = payload['sub']
         except ValueError as e:
             return None
 
-        user_in_database = db.session.query(User).filter(User.id == int(user_id)).one_or_none()
-        logger.debug('user = {}'.format(user_in_database))
-        if not user_in_database:
+        user = identity_cache.get(user_id)
+        logger.debug('user = %s', user)
+        if not user:
             return None
 
-        return MyUser(user_in_database)
+        return MyUser(user)
 
 
 def define_appgroup_data(app):
     data_cli = AppGroup('data', help='Modifies your SQL data (please be careful)')
 
     @data_cli.command('import')
+    @click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), default=None,
+                  help='Format of the dump (default: by file extension, else tsv)')
+    @click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True, help='Hits per commit')
+    @click.argument('filename')
+    def database_import(fmt, chunk_size, filename):
+        """Imports the given filename (NDJSON or TSV, maybe gzipped, '-' is stdin) into your table `hit`"""
+        cli_db_import(filename, fmt=fmt, chunk_size=chunk_size)
+
+    @data_cli.command('export')
+    @click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default=None,
+                  help='Format of the dump (default: by file extension, else ndjson)')
+    @click.option('--since', default=None, help='Only hits visited after then (ISO 8601 or milliseconds)')
     @click.argument('filename')
-    def database_import(filename):
-        """Imports the given filename into your table `hit`"""
-        cli_db_import(filename)
+    def database_export(fmt, since, filename):
+        """Exports your table `hit` to the given filename (gzipped for '.gz', '-' is stdout)"""
+        if since is not None:
+            try:
+                since = parse_since(since)
+            except ValueError:
+                raise click.BadParameter('expected ISO 8601 or milliseconds', param_hint='--since')
+
+        cli_db_export(filename, fmt=fmt, since=since)
+
+    @data_cli.command('flush')
+    def database_flush():
+        """Merges the spooled hits of the write-behind buffer into your table `hit`"""
+        batches = spool.flush()
+        if batches is None:
+            click.secho("Another process is flushing the spool right now", fg="yellow")
+            return
+        click.echo("Flushed {} batches".format(batches))
+
+    @data_cli.command('search-rebuild')
+    def database_search_rebuild():
+        """Rebuilds the full text search index `hits_fts` from your table `hit`"""
+        with db.engine.begin() as connection:
+            if not ensure_search_index(connection):
+                rebuild_search_index(connection)
+        click.echo("Rebuilt the search index")
+
+    @data_cli.command('dedupe')
+    def database_dedupe():
+        """Canonicalizes the URLs of your table `hit` and merges duplicate rows of `hit` and `archive`"""
+        updated, merged = canonicalize_hits()
+        click.echo("Canonicalized {} hits, merged {} duplicate hits".format(updated, merged))
+        removed = Archive.merge_duplicates()
+        click.echo("Removed {} duplicate archive entries".format(removed))
+        db.session.commit()
+
+    @data_cli.command('backfill-links')
+    def database_backfill_links():
+        """Parses the URLs of your table `hit` that have no link kind, hoster and video ID yet"""
+        updated = backfill_link_metadata()
+        click.echo("Parsed the links of {} hits".format(updated))
+
+    @data_cli.command('compact')
+    @click.option('--days', type=int, default=None,
+                  help='Archive hits not visited for that many days (default: HITS_RETENTION_DAYS)')
+    @click.option('--batch-size', default=COMPACT_BATCH_SIZE, show_default=True, help='Hits per commit')
+    @click.option('--dry-run', default=False, is_flag=True, help='Only count the hits to archive')
+    @click.option('--vacuum', default=False, is_flag=True, help='Give the freed pages back to the filesystem')
+    def database_compact(days, batch_size, dry_run, vacuum):
+        """Moves old hits of your table `hit` into `hits_archive`, keeping their visits"""
+        if days is None:
+            days = app.config.get('HITS_RETENTION_DAYS')
+        if days is None:
+            click.secho("No retention configured, use --days or HITS_RETENTION_DAYS", fg="yellow")
+            return
+
+        before = totals()
+        result = compact_hits(days, batch_size=batch_size, dry_run=dry_run)
+
+        click.echo("{} {} hits with {} visits older than {} ({})".format(
+            'Would archive' if dry_run else 'Archived',
+            result.rows, result.visits, result.cutoff.strftime("%Y-%m-%d"),
+            ', '.join(sorted(result.months)) or 'no months'))
+
+        if dry_run:
+            return
+
+        after = totals()
+        click.echo("Hot rows: {} -> {}, archived rows: {} -> {}, visits: {} -> {}".format(
+            before['hot']['rows'], after['hot']['rows'],
+            before['archive']['rows'], after['archive']['rows'],
+            before['visits'], after['visits']))
+
+        if vacuum:
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('VACUUM')
+            click.echo("Vacuumed the database")
 
     app.cli.add_command(data_cli)
 
@@ -151,6 +278,30 @@ def define_appgroup_token(app):
             print(str(e))
             return
 
+    @token_cli.command('revoke')
+    @click.argument("token")
+    def token_revoke(token):
+        """Blacklists the given token, all processes refuse it within seconds"""
+        try:
+            User.decode_auth_token(token)
+        except ValueError as e:
+            click.secho("Not revoking: {}".format(e), fg="yellow")
+            return
+
+        BlacklistToken.revoke(token)
+        db.session.commit()
+        token_cache.invalidate()
+
+        click.secho("Revoked the token", fg="green")
+
+    @token_cli.command('purge')
+    def token_purge():
+        """Deletes blacklist entries of expired tokens"""
+        purged = BlacklistToken.purge()
+        db.session.commit()
+
+        click.echo("Purged {} expired token(s) from the blacklist".format(purged))
+
     app.cli.add_command(token_cli)
 
 
@@ -227,6 +378,8 @@ def create_app(testing=False):
     app.logger.debug("Using database {} (testing={})".format(app.config['SQLALCHEMY_DATABASE_URI'], testing))
     setup_database(app, testing=testing)
 
+    app.wsgi_app = RequestDecompression(app.wsgi_app, app.config['REQUEST_DECOMPRESSION'])
+
     Migrate(app, db)
 
     login_manager = LoginManager()
@@ -253,6 +406,14 @@ def create_app(testing=False):
     bcrypt.init_app(app)
     #
     cache.init_app(app)
+    thumbnail_cache.init_app(app)
+    fetcher.init_app(app)
+    token_cache.init_app(app)
+    identity_cache.init_app(app)
+    spool.init_app(app)
+    video_index.init_app(app)
+    response_cache.init_app(app)
+    thumbnail_prefetcher.init_app(app)
     #
     setup_static_routes(app)
     setup_blueprints(app, testing)
@@ -277,6 +438,12 @@ def setup_database(app, testing=False):
     with app.app_context():
         db.create_all()
 
+        with db.engine.begin() as connection:
+            upgrade_schema(connection)
+
+            if ensure_search_index(connection):
+                app.logger.info("Created the search index `hits_fts`")
+
 
 def setup_static_routes(app):
     app.add_url_rule('/', 'root', root)
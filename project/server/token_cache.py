@@ -0,0 +1,122 @@
+# project/server/token_cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+from project.server.database import db
+from project.server.models import User, BlacklistToken, Generation, token_digest
+
+
+class TokenCache:
+    """
+    Per-process cache for bearer authentication.
+
+    Verified tokens are kept in a LRU keyed by their SHA-256 digest until
+    their `exp`, so a token that comes again costs a dict lookup instead of
+    a JWT decode and a blacklist query. The blacklist itself is held as a
+    set of digests; it is reloaded when the `blacklist` generation changed,
+    which is looked at every `TOKEN_BLACKLIST_REFRESH_INTERVAL` seconds.
+    A revoked token therefore stops working in all processes within that
+    interval, at once in the process that revoked it.
+    """
+    def __init__(self):
+        self.app = None
+
+        self.maxsize = 1024
+        self.refresh_interval = 5
+
+        self.entries = OrderedDict()
+        self.blacklist = frozenset()
+        self.version = None
+        self.checked_at = None
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+        self.maxsize = app.config.get('TOKEN_CACHE_SIZE', self.maxsize)
+        self.refresh_interval = app.config.get('TOKEN_BLACKLIST_REFRESH_INTERVAL', self.refresh_interval)
+
+        self.invalidate()
+
+    def invalidate(self):
+        """Forgets everything, the next lookup reloads the blacklist"""
+        with self._lock:
+            self.entries.clear()
+            self.blacklist = frozenset()
+            self.version = None
+            self.checked_at = None
+
+    def _refresh_blacklist(self):
+        now = time.monotonic()
+
+        if self.checked_at is not None and now - self.checked_at < self.refresh_interval:
+            return
+
+        self.checked_at = now
+
+        version, _ = Generation.current(Generation.BLACKLIST)[Generation.BLACKLIST]
+        if version == self.version:
+            return
+
+        #   Expired tokens fail the signature check anyway
+        rows = db.session.query(BlacklistToken.digest).filter(BlacklistToken.exp > int(time.time()))
+        blacklist = frozenset(digest for digest, in rows)
+
+        with self._lock:
+            self.blacklist = blacklist
+            self.version = version
+
+    def verify(self, auth_token):
+        """
+        The payload of a valid token, raises ValueError like
+        `User.decode_auth_token()` otherwise.
+        """
+        self._refresh_blacklist()
+
+        digest = token_digest(auth_token)
+
+        if digest in self.blacklist:
+            raise ValueError('Token blacklisted. Please log in again.')
+
+        with self._lock:
+            entry = self.entries.get(digest)
+
+            if entry is not None:
+                payload, expires_at = entry
+
+                if time.time() < expires_at:
+                    self.entries.move_to_end(digest)
+                    self.hits += 1
+                    return payload
+
+                del self.entries[digest]
+
+            self.misses += 1
+
+        payload = User.decode_signature(auth_token)
+
+        with self._lock:
+            self.entries[digest] = (payload, payload['exp'])
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return payload
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'maxsize': self.maxsize,
+            'blacklisted': len(self.blacklist),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+token_cache = TokenCache()
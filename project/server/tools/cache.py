@@ -1,10 +1,14 @@
 import hashlib
 import io
 import json
+import os
+import threading
 
 from pathlib import Path
 from datetime import datetime
 
+import diskcache
+
 
 class FileCacheEntry:
     def __init__(self, cache, name):
@@ -102,6 +106,42 @@ class Cache:
         return self.cache_directory / Entry(filename, attributes).cache_filename
 
 
+class SharedCache:
+    """
+    One `diskcache.Cache` handle per process for the thumbnails, instead of
+    opening the cache on every request. The handle is reopened after a fork,
+    uWSGI forks its workers after loading the app.
+    """
+    def __init__(self):
+        self.app = None
+        self.directory = None
+
+        self._cache = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+        self.directory = Path(app.config.get('THUMBNAIL_CACHE_DIRECTORY', Path(app.instance_path).parent / '.cache'))
+        self.close()
+
+    def handle(self) -> diskcache.Cache:
+        with self._lock:
+            if self._cache is None or self._pid != os.getpid():
+                self._cache = diskcache.Cache(self.directory)
+                self._pid = os.getpid()
+
+            return self._cache
+
+    def close(self):
+        with self._lock:
+            if self._cache is not None and self._pid == os.getpid():
+                self._cache.close()
+            self._cache = None
+
+
 # cache = Cache()
 cache = FileCache()
+thumbnail_cache = SharedCache()
 
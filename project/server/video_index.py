@@ -0,0 +1,151 @@
+# project/server/video_index.py
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+logger = logging.getLogger()
+
+#   youtube-dl names its files `<title>-<id>.<ext>`, yt-dlp `<title> [<id>].<ext>`
+PATTERN_VIDEO_ID = re.compile(r'(?:-|\[)([A-Za-z0-9_-]{11})\]?\.[A-Za-z0-9]+$')
+
+#   Files that are still being downloaded don't count
+PATTERN_PARTIAL = re.compile(r'\.(part|ytdl|temp)$')
+
+
+class DirectoryEntry:
+    def __init__(self, mtime_ns, video_ids, subdirectories):
+        self.mtime_ns = mtime_ns
+        self.video_ids = video_ids
+        self.subdirectories = subdirectories
+
+
+class VideoIndex:
+    """
+    In-process index of the video IDs that were already downloaded into
+    `VIDEO_ARCHIVE_DIRECTORY`.
+
+    A refresh stats every directory of the archive, but only lists the ones
+    whose mtime changed since the last refresh. Refreshes happen at most
+    every `VIDEO_INDEX_REFRESH_INTERVAL` seconds, so a lookup is usually a
+    set membership test.
+    """
+    def __init__(self):
+        self.app = None
+        self.directory = None
+        self.recursive = True
+        self.refresh_interval = 30
+
+        self.directories = {}
+        self.video_ids = Counter()
+
+        self.last_refresh = None
+        self.refresh_seconds = None
+
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+        self.directory = Path(app.config.get('VIDEO_ARCHIVE_DIRECTORY', '.'))
+        self.recursive = app.config.get('VIDEO_ARCHIVE_RECURSIVE', True)
+        self.refresh_interval = app.config.get('VIDEO_INDEX_REFRESH_INTERVAL', self.refresh_interval)
+
+        self.directories = {}
+        self.video_ids = Counter()
+        self.last_refresh = None
+
+    @staticmethod
+    def video_id_of(filename):
+        if PATTERN_PARTIAL.search(filename):
+            return None
+
+        m = PATTERN_VIDEO_ID.search(filename)
+        if m:
+            return m.group(1)
+
+        return None
+
+    def _scan(self, path, mtime_ns):
+        video_ids = set()
+        subdirectories = []
+
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive:
+                        subdirectories.append(entry.path)
+                    continue
+
+                video_id = VideoIndex.video_id_of(entry.name)
+                if video_id:
+                    video_ids.add(video_id)
+
+        return DirectoryEntry(mtime_ns, video_ids, subdirectories)
+
+    def refresh(self):
+        time_start = time.monotonic()
+
+        seen = set()
+        stack = [str(self.directory)]
+
+        while stack:
+            path = stack.pop()
+
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            seen.add(path)
+
+            entry = self.directories.get(path)
+            if entry is None or entry.mtime_ns != mtime_ns:
+                try:
+                    new_entry = self._scan(path, mtime_ns)
+                except (FileNotFoundError, NotADirectoryError, PermissionError):
+                    continue
+
+                if entry is not None:
+                    self.video_ids.subtract(entry.video_ids)
+                self.video_ids.update(new_entry.video_ids)
+
+                self.directories[path] = entry = new_entry
+
+            stack.extend(entry.subdirectories)
+
+        for path in set(self.directories) - seen:
+            self.video_ids.subtract(self.directories.pop(path).video_ids)
+
+        self.video_ids = +self.video_ids
+
+        self.last_refresh = time.monotonic()
+        self.refresh_seconds = self.last_refresh - time_start
+
+    def _refresh_if_stale(self):
+        with self._lock:
+            if self.last_refresh is None or time.monotonic() - self.last_refresh >= self.refresh_interval:
+                self.refresh()
+
+    def contains(self, video_id):
+        """True if the video with the given ID is in our archive directory"""
+        self._refresh_if_stale()
+        return video_id in self.video_ids
+
+    def stats(self):
+        return {
+            'directory': str(self.directory),
+            'directories': len(self.directories),
+            'videos': len(self.video_ids),
+            'refresh_seconds': self.refresh_seconds,
+        }
+
+
+video_index = VideoIndex()
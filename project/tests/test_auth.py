@@ -0,0 +1,146 @@
+# project/tests/test_auth.py
+
+import pytest
+from sqlalchemy import event
+
+import project.server.startup
+from project.server.database import db
+from project.server.identity import identity_cache
+from project.server.models import User, BlacklistToken
+from project.server.token_cache import token_cache
+
+
+@pytest.fixture
+def app():
+    app = project.server.startup.create_app(testing=True)
+    return app
+
+
+@pytest.fixture
+def token(app):
+    with app.app_context():
+        user = User(email='auth@test.com', password='auth')
+        db.session.add(user)
+        db.session.commit()
+
+        return user.encode_auth_token(user.id)
+
+
+def statements(app):
+    with app.app_context():
+        engine = db.engine
+
+    executed = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: executed.append(args[2]))
+
+    return executed
+
+
+def test_repeated_token_is_cached(app, token):
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    executed = statements(app)
+
+    with app.test_client() as client:
+        assert client.get('/hits/metrics', headers=headers).status_code == 200
+        first = len(executed)
+
+        assert client.get('/hits/metrics', headers=headers).status_code == 200
+
+    #   Neither the blacklist nor the generations are read again
+    assert not any('blacklist_tokens' in s or 'generations' in s for s in executed[first:])
+    assert token_cache.stats()['hits'] == 1
+
+
+def test_revoked_token_is_refused(app, token):
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+
+    with app.test_client() as client:
+        assert client.get('/hits/metrics', headers=headers).status_code == 200
+
+        result = app.test_cli_runner().invoke(args=['token', 'revoke', token])
+        assert 'Revoked' in result.output
+
+        assert client.get('/hits/metrics', headers=headers).status_code != 200
+
+    with app.app_context():
+        with pytest.raises(ValueError):
+            User.decode_auth_token(token)
+
+
+def test_invalid_tokens_are_not_cached(app, token):
+    with app.test_client() as client:
+        response = client.get('/hits/metrics', headers={'Authorization': 'Bearer {}x'.format(token)})
+        assert response.status_code != 200
+
+    assert token_cache.stats()['entries'] == 0
+
+
+def test_identity_is_cached(app, token):
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    executed = statements(app)
+
+    with app.test_client() as client:
+        assert client.get('/hits/metrics', headers=headers).status_code == 200
+        first = len(executed)
+
+        assert client.get('/hits/metrics', headers=headers).status_code == 200
+
+    #   The second request doesn't touch the database at all
+    assert executed[first:] == []
+    assert identity_cache.stats()['hits'] == 1
+
+
+def test_changed_user_is_loaded_again(app, token):
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+
+    with app.test_client() as client:
+        assert client.get('/hits/metrics', headers=headers).status_code == 200
+
+        with app.app_context():
+            user = db.session.query(User).filter(User.email == 'auth@test.com').one()
+            assert identity_cache.get(user.id).admin is False
+
+            user.admin = True
+            db.session.commit()
+
+            assert identity_cache.get(user.id).admin is True
+
+
+def test_identity_cache_saves_a_query_per_request(app, token, monkeypatch):
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    requests = 20
+
+    def count(ttl):
+        monkeypatch.setattr(identity_cache, 'ttl', ttl)
+        identity_cache.clear()
+        executed = statements(app)
+
+        with app.test_client() as client:
+            client.get('/hits/metrics', headers=headers)
+            del executed[:]
+
+            for _ in range(requests):
+                assert client.get('/hits/metrics', headers=headers).status_code == 200
+
+        return len(executed)
+
+    assert count(0) == requests
+    assert count(60) == 0
+
+
+def test_blacklist_stores_digests_and_purges(app, token):
+    with app.app_context():
+        BlacklistToken.revoke(token)
+        db.session.commit()
+
+        entry = db.session.query(BlacklistToken).one()
+        assert len(entry.digest) == 64
+        assert token not in entry.digest
+        assert BlacklistToken.check_blacklist(token)
+
+        assert BlacklistToken.purge() == 0
+        assert BlacklistToken.purge(now=entry.exp) == 1
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['token', 'purge'])
+    assert 'Purged 0' in result.output
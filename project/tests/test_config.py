@@ -166,6 +166,6 @@ def test_insert(app):
         assert Hit.query.count() == 1
         db.session.commit()
 
-        assert hit.url == 'https://www.google.de'
+        assert hit.url == 'https://www.google.de/'
         assert isinstance(hit.mtime, datetime.datetime)
         assert hit.title == 'Google it'
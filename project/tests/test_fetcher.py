@@ -0,0 +1,125 @@
+# project/tests/test_fetcher.py
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from project.server.fetcher import Fetcher
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.requests.append(self.path)
+            server.connections.add(self.client_address)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            failures = server.failures.get(self.path, 0)
+            if failures:
+                server.failures[self.path] = failures - 1
+
+        try:
+            if self.path.startswith('/slow'):
+                time.sleep(0.1)
+
+            if failures:
+                status, body = 503, b'busy'
+            elif self.path.startswith('/missing'):
+                status, body = 404, b'not found'
+            else:
+                status, body = 200, self.path.encode() * 100
+
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.connections = set()
+    server.failures = {}
+    server.active = 0
+    server.max_active = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = Fetcher()
+    fetcher.backoff = 0
+    fetcher.per_host = 2
+    fetcher.max_size = 4096
+    yield fetcher
+    fetcher.close()
+
+
+def url(server, path):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+
+def test_fetch_reuses_connections(server, fetcher):
+    for i in range(5):
+        result = fetcher.fetch(url(server, '/image/{}'.format(i)))
+        assert result.ok
+        assert result.stream.read() == '/image/{}'.format(i).encode() * 100
+
+    assert len(server.connections) == 1
+
+
+def test_fetch_retries_with_backoff(server, fetcher):
+    server.failures['/flaky'] = 2
+
+    result = fetcher.fetch(url(server, '/flaky'))
+    assert result.ok
+    assert server.requests.count('/flaky') == 3
+
+    result = fetcher.fetch(url(server, '/missing'))
+    assert not result.ok
+    assert result.status_code == 404
+    result.raise_for_error()
+
+
+def test_fetch_limits(server, fetcher):
+    result = fetcher.fetch(url(server, '/big/' + 'x' * 100))
+    assert not result.ok
+    assert result.error
+
+    result = fetcher.fetch('http://127.0.0.1:1/refused')
+    assert result.status_code is None
+    with pytest.raises(requests.ConnectionError):
+        result.raise_for_error()
+
+
+def test_fetch_many_respects_per_host_limit(server, fetcher):
+    urls = [url(server, '/slow/{}'.format(i)) for i in range(8)]
+
+    results = fetcher.fetch_many(urls)
+
+    assert list(results) == urls
+    assert all(result.ok for result in results.values())
+    assert server.max_active == fetcher.per_host
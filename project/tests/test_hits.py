@@ -0,0 +1,994 @@
+# project/tests/test_hits.py
+import datetime
+import gzip
+import io
+import json
+import math
+import zlib
+
+import pytest
+from PIL import Image
+from sqlalchemy import event
+
+import project.server.startup
+from project.server.database import db
+from project.server.ingest import store_hits, canonicalize_hits, backfill_link_metadata, CHUNK_SIZE
+from project.hits import Page
+from project.server.conditional import response_cache, source_version, SOURCE_DIRECTORY
+from project.server.models import User, Hit, Archive, HitArchive, HitRollup, Generation
+from project.server.retention import compact_hits, totals
+from project.server.fetcher import fetcher, FetchResult
+from project.server.link import LinkType, Youtube
+from project.server.tools.cache import thumbnail_cache
+from project.server.spool import spool
+from project.server.video_index import video_index
+
+
+@pytest.fixture
+def app():
+    app = project.server.startup.create_app(testing=True)
+    return app
+
+
+@pytest.fixture
+def headers(app):
+    with app.app_context():
+        user = User(email='hits@test.com', password='hits')
+        db.session.add(user)
+        db.session.commit()
+
+        auth_token = user.encode_auth_token(user.id)
+
+    return {'Authorization': 'Bearer {auth_token}'.format(auth_token=auth_token)}
+
+
+def generate_hits(n, start=0, timestamp_ms=None):
+    if timestamp_ms is None:
+        timestamp_ms = datetime.datetime.now().timestamp() * 1000
+
+    return [
+        {
+            'url': 'https://example.com/{}'.format(i),
+            'timestamp_ms': timestamp_ms + i,
+            'title': 'Example {}'.format(i),
+        }
+        for i in range(start, start + n)
+    ]
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def test_store_merges_batch(app, headers):
+
+    hits = generate_hits(3) + generate_hits(2)
+
+    with app.test_client() as client:
+        response = client.post('/hits/collection', headers=headers, json={'hits': hits})
+        assert response.status_code == 200
+        assert json.loads(response.data.decode()) == {'status': 'OK'}
+
+        response = client.post('/hits/collection', headers=headers, json={'hits': generate_hits(1)})
+        assert response.status_code == 200
+
+    with app.app_context():
+        assert Hit.query.count() == 3
+
+        visited = {hit.url: hit.visited for hit in Hit.query.all()}
+        assert visited == {
+            'https://example.com/0': 3,
+            'https://example.com/1': 2,
+            'https://example.com/2': 1,
+        }
+
+
+@pytest.mark.parametrize('n', [10, 1000])
+def test_store_statement_count_is_constant(app, n):
+    """Benchmark: ingest cost must not grow with one query per hit"""
+
+    with app.app_context():
+        store_hits(generate_hits(n // 2))
+        db.session.commit()
+
+        with StatementCounter(db.engine) as counter:
+            result = store_hits(generate_hits(n))
+            db.session.commit()
+
+        assert result.updated == n // 2
+        assert result.inserted == n - n // 2
+        #   per chunk lookup, update and insert, plus the rollups and the generation
+        assert counter.count <= 3 * math.ceil(n / CHUNK_SIZE) + 2
+        assert Hit.query.count() == n
+
+
+def test_current_lists_latest_hits(app, headers):
+
+    with app.app_context():
+        store_hits(generate_hits(15, timestamp_ms=1_600_000_000_000))
+        store_hits(generate_hits(1, start=3, timestamp_ms=1_700_000_000_000))
+        db.session.commit()
+
+    with app.test_client() as client:
+        response = client.get('/hits/current', headers=headers)
+        assert response.status_code == 200
+
+        queue = json.loads(response.data.decode())['queue']
+        assert len(queue) == 10
+        assert queue[0]['link'] == 'https://example.com/3'
+        assert queue[1]['link'] == 'https://example.com/14'
+
+        response = client.get('/hits/dashboard', headers=headers)
+        assert response.status_code == 200
+
+
+def test_latest_uses_index(app):
+
+    with app.app_context():
+        statement = db.session.query(Hit).\
+            order_by(Hit.mtime.desc(), Hit.id.desc()).limit(20).statement
+
+        plan = db.session.execute(
+            db.text('EXPLAIN QUERY PLAN ' + str(statement.compile(compile_kwargs={'literal_binds': True})))
+        ).all()
+
+        assert 'ix_hits_mtime_id' in ' '.join(str(row) for row in plan)
+        assert 'TEMP B-TREE' not in ' '.join(str(row) for row in plan)
+
+
+def test_dashboard_keyset_pagination(app):
+
+    with app.app_context():
+        store_hits(generate_hits(45, timestamp_ms=1_600_000_000_000))
+        db.session.commit()
+
+        first = Page()
+        assert not first.has_prev and first.has_next
+        assert [hit.url for hit in first.rows][:2] == ['https://example.com/44', 'https://example.com/43']
+
+        second = Page(first.next_cursor)
+        assert second.has_prev and second.has_next
+        assert second.rows[0].url == 'https://example.com/24'
+
+        third = Page(second.next_cursor)
+        assert third.has_prev and not third.has_next
+        assert [hit.url for hit in third.rows] == ['https://example.com/{}'.format(i) for i in range(4, -1, -1)]
+
+        back = Page(third.prev_cursor, direction='before')
+        assert [hit.id for hit in back.rows] == [hit.id for hit in second.rows]
+
+        back = Page(back.prev_cursor, direction='before')
+        assert not back.has_prev
+        assert [hit.id for hit in back.rows] == [hit.id for hit in first.rows]
+
+        assert Page('garbage').key is None
+
+
+def test_current_resolves_archives_in_one_query(app, headers):
+
+    with app.app_context():
+        store_hits([
+            {
+                'url': 'https://www.youtube.com/watch?v=video{:06d}'.format(i),
+                'timestamp_ms': 1_600_000_000_000 + i,
+                'title': 'Video {}'.format(i),
+            }
+            for i in range(10)
+        ])
+        db.session.add(Archive(source='youtube', name='video000003'))
+        db.session.add(Archive(source='youtube', name='video000007'))
+        db.session.commit()
+
+    with app.app_context():
+        engine = db.engine
+
+    with app.test_client() as client:
+        with StatementCounter(engine) as counter:
+            response = client.get('/hits/current', headers=headers)
+        assert response.status_code == 200
+
+        queue = json.loads(response.data.decode())['queue']
+        archived = sorted(row['link'][-11:] for row in queue if row['archive'])
+        assert archived == ['video000003', 'video000007']
+
+        #   first authentication of the process (blacklist generation, blacklist
+        #   and user: 3), generations (1), hits (1) and archive (1)
+        assert counter.count <= 6
+
+
+def test_store_rejects_malformed_hits(app, headers):
+
+    with app.test_client() as client:
+        response = client.post('/hits/collection', headers=headers, json={'hits': [{'url': 'https://example.com'}]})
+        assert response.status_code == 200
+        assert json.loads(response.data.decode()) == {
+            'status': 'ERROR',
+            'message': "Hit #0 misses the key 'timestamp_ms'",
+        }
+
+
+def test_store_spools_and_flushes(app, headers, tmp_path):
+
+    app.config.update({
+        'HITS_SPOOL': True,
+        'HITS_SPOOL_DIRECTORY': tmp_path,
+        'HITS_SPOOL_FLUSH_INTERVAL': 3600,
+        'HITS_SPOOL_FLUSH_HITS': 3,
+    })
+    spool.init_app(app)
+
+    try:
+        with app.test_client() as client:
+            for _ in range(2):
+                response = client.post('/hits/collection', headers=headers, json={'hits': generate_hits(4)})
+                assert response.status_code == 202
+                assert json.loads(response.data.decode()) == {'status': 'OK', 'spooled': 4}
+
+            response = client.get('/hits/metrics', headers=headers)
+            metrics = json.loads(response.data.decode())['spool']
+            assert metrics['pending_bytes'] > 0
+            assert metrics['lag_seconds'] >= 0
+
+        with app.app_context():
+            assert Hit.query.count() == 0
+
+            assert spool.flush() == 2
+
+            assert Hit.query.count() == 4
+            assert {hit.visited for hit in Hit.query.all()} == {2}
+
+            stats = spool.stats()
+            assert stats['pending_bytes'] == 0
+            assert stats['lag_seconds'] == 0
+            assert stats['flushed_hits'] == 8
+    finally:
+        app.config['HITS_SPOOL'] = False
+        spool.init_app(app)
+
+
+def test_spool_sets_failing_batches_aside(app, headers, tmp_path):
+
+    app.config.update({
+        'HITS_SPOOL': True,
+        'HITS_SPOOL_DIRECTORY': tmp_path,
+        'HITS_SPOOL_FLUSH_INTERVAL': 3600,
+        'HITS_SPOOL_MAX_ATTEMPTS': 2,
+    })
+    spool.init_app(app)
+
+    broken = [{'url': 'https://example.com/broken', 'timestamp_ms': 10 ** 18, 'title': 'Broken'}]
+
+    try:
+        with app.test_client() as client:
+            #   Validation refuses it ...
+            response = client.post('/hits/collection', headers=headers, json={'hits': broken})
+            assert json.loads(response.data.decode()) == {
+                'status': 'ERROR',
+                'message': "Hit #0 has an invalid 'timestamp_ms'",
+            }
+
+        #   ... but a batch of an older version may be in the spool already
+        spool.append(generate_hits(2))
+        spool.append(broken)
+        spool.append(generate_hits(1, start=5))
+
+        with app.app_context():
+            with pytest.raises(Exception):
+                spool.flush()
+
+            #   The batch before the broken one is stored
+            assert Hit.query.count() == 2
+
+            assert spool.flush() == 2
+            assert Hit.query.count() == 3
+            assert spool.stats()['pending_bytes'] == 0
+
+        dead = [json.loads(line) for line in (tmp_path / 'hits.dead.ndjson').read_text().splitlines()]
+        assert [entry['hits'] for entry in dead] == [broken]
+        assert 'out of range' in dead[0]['error']
+    finally:
+        app.config['HITS_SPOOL'] = False
+        spool.init_app(app)
+
+
+def test_import_of_old_dump_keeps_last_visit(app, headers):
+
+    recent = datetime.datetime(2025, 6, 1, 12, 0, 0)
+
+    with app.app_context():
+        store_hits([{'url': 'https://example.com/', 'timestamp_ms': recent.timestamp() * 1000, 'title': 'New'}])
+        db.session.commit()
+
+    tsv = "https://example.com/\t1500000000000\tOld\n" \
+          "https://example.com/\t1500000000001\tOld\n" \
+          "https://example.com/other\t{}\tBroken\n".format(10 ** 18)
+
+    with app.test_client() as client:
+        response = client.post('/hits/import?format=tsv', headers=headers, data=tsv, content_type='text/plain')
+        assert response.status_code == 200
+
+        progress = json.loads(response.data.decode())['progress']
+        assert progress['skipped'] == 1
+
+    with app.app_context():
+        hit = Hit.query.one()
+        assert hit.visited == 3
+        assert hit.mtime == recent
+
+
+def test_bulk_import_streams_ndjson_and_tsv(app, headers):
+
+    ndjson = "".join(json.dumps(hit) + "\n" for hit in generate_hits(7)) + "this is not json\n"
+    tsv = "".join("{url}\t{timestamp_ms:.0f}\t{title}\n".format(**hit) for hit in generate_hits(3, start=5))
+
+    with app.test_client() as client:
+        response = client.post('/hits/import?chunk_size=3', headers=headers, data=ndjson,
+                               content_type='application/x-ndjson')
+        assert response.status_code == 200
+
+        progress = json.loads(response.data.decode())['progress']
+        assert progress['lines'] == 8
+        assert progress['skipped'] == 1
+        assert progress['chunks'] == 3
+        assert progress['inserted'] == 7
+
+        response = client.post('/hits/import', headers=headers, data=tsv,
+                               content_type='text/tab-separated-values')
+        progress = json.loads(response.data.decode())['progress']
+        assert progress['updated'] == 2
+        assert progress['inserted'] == 1
+
+    with app.app_context():
+        assert Hit.query.count() == 8
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'raw-deflate'])
+def test_store_accepts_compressed_body(app, headers, encoding):
+
+    body = json.dumps({'hits': generate_hits(200)}).encode()
+
+    if encoding == 'gzip':
+        data = gzip.compress(body)
+    elif encoding == 'deflate':
+        data = zlib.compress(body)
+    else:
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        data = compressor.compress(body) + compressor.flush()
+        encoding = 'deflate'
+
+    assert len(data) * 5 < len(body)
+
+    with app.test_client() as client:
+        response = client.post('/hits/collection', data=data, content_type='application/json',
+                               headers=dict(headers, **{'Content-Encoding': encoding}))
+        assert response.status_code == 200
+        assert json.loads(response.data.decode()) == {'status': 'OK'}
+
+    with app.app_context():
+        assert Hit.query.count() == 200
+
+
+def test_store_rejects_compression_bomb(app, headers):
+
+    app.wsgi_app.limits = {'/hits/collection': 1024 * 1024}
+
+    data = gzip.compress(b'[' + b' ' * (8 * 1024 * 1024) + b']')
+
+    with app.test_client() as client:
+        response = client.post('/hits/collection', data=data, content_type='application/json',
+                               headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+        assert response.status_code == 413
+
+        response = client.post('/hits/collection', data=data[:100], content_type='application/json',
+                               headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+        assert response.status_code == 400
+
+
+def test_status_uses_video_index(app, headers, tmp_path):
+
+    (tmp_path / 'Downloaded-video000001.mp4').touch()
+
+    app.config['VIDEO_ARCHIVE_DIRECTORY'] = tmp_path
+    video_index.init_app(app)
+
+    with app.app_context():
+        store_hits([
+            {
+                'url': 'https://www.youtube.com/watch?v=video00000{}'.format(i),
+                'timestamp_ms': 1_600_000_000_000 + i,
+                'title': 'Video {}'.format(i),
+            }
+            for i in range(1, 3)
+        ])
+        db.session.commit()
+
+        ids = {hit.url[-11:]: hit.id for hit in Hit.query.all()}
+
+    with app.test_client() as client:
+        response = client.get('/hits/status/{}'.format(ids['video000001']), headers=headers)
+        assert json.loads(response.data.decode())['hit']['status'] == 'was-downloaded'
+
+        response = client.get('/hits/status/{}'.format(ids['video000002']), headers=headers)
+        assert json.loads(response.data.decode())['hit']['status'] == 'can-be-downloaded'
+
+
+def test_batch_status(app, headers, tmp_path):
+
+    (tmp_path / 'Downloaded-video000001.mp4').touch()
+
+    app.config['VIDEO_ARCHIVE_DIRECTORY'] = tmp_path
+    video_index.init_app(app)
+
+    with app.app_context():
+        store_hits([
+            {
+                'url': 'https://www.youtube.com/watch?v=video00000{}'.format(i),
+                'timestamp_ms': 1_600_000_000_000 + i,
+                'title': 'Video {}'.format(i),
+            }
+            for i in range(1, 4)
+        ] + generate_hits(1))
+        db.session.add(Archive(source='youtube', name='video000003'))
+        db.session.commit()
+
+        ids = {hit.url.split('/')[-1]: hit.id for hit in Hit.query.all()}
+        engine = db.engine
+
+    with app.test_client() as client:
+        with StatementCounter(engine) as counter:
+            response = client.post('/hits/status', headers=headers, json={'ids': list(ids.values()) + [4711]})
+        assert response.status_code == 200
+
+        #   first authentication of the process (blacklist generation, blacklist
+        #   and user: 3), generations (1), hits (1) and archive (1)
+        assert counter.count <= 6
+
+        statuses = json.loads(response.data.decode())['hits']
+        assert {hit_id: statuses[str(i)]['status'] for hit_id, i in ids.items()} == {
+            'watch?v=video000001': 'was-downloaded',
+            'watch?v=video000002': 'can-be-downloaded',
+            'watch?v=video000003': 'was-downloaded',
+            '0': '?',
+        }
+        assert '4711' not in statuses
+
+        response = client.get('/hits/status?ids={},{}'.format(ids['0'], ids['watch?v=video000001']), headers=headers)
+        assert len(json.loads(response.data.decode())['hits']) == 2
+
+        response = client.post('/hits/status', headers=headers, json={'ids': 'nope'})
+        assert response.status_code == 400
+
+
+def test_search(app, headers):
+
+    with app.app_context():
+        store_hits([
+            {'url': 'https://example.com/python', 'timestamp_ms': 1_600_000_000_000, 'title': 'Python <Tips>'},
+            {'url': 'https://example.com/rust', 'timestamp_ms': 1_600_000_000_001, 'title': 'Rust and python'},
+            {'url': 'https://python.example.com/', 'timestamp_ms': 1_600_000_000_002, 'title': 'Something else'},
+        ] + generate_hits(25))
+        db.session.commit()
+
+        db.session.execute(db.update(Hit).where(Hit.url == 'https://example.com/rust').values(title='Rust only'))
+        db.session.commit()
+
+    with app.test_client() as client:
+        response = client.get('/hits/search?q=pyth', headers=headers)
+        assert response.status_code == 200
+
+        data = json.loads(response.data.decode())
+        assert [row['link'] for row in data['results']] == [
+            'https://example.com/python',
+            'https://python.example.com/',
+        ]
+        assert data['results'][0]['snippet']['title'] == '<mark>Python</mark> &lt;Tips&gt;'
+        assert data['next_page'] is None
+
+        data = json.loads(client.get('/hits/search?q=example', headers=headers).data.decode())
+        assert len(data['results']) == 20
+        assert data['next_page']
+
+        data = json.loads(client.get(data['next_page'], headers=headers).data.decode())
+        assert len(data['results']) == 8
+
+        data = json.loads(client.get('/hits/search?q=" OR (', headers=headers).data.decode())
+        assert data['results'] == []
+
+
+def test_store_merges_canonical_urls(app, headers):
+
+    hits = [
+        {'url': 'https://www.youtube.com/watch?v=UOeNBCezeCo&t=42s', 'timestamp_ms': 1_600_000_000_000, 'title': 'A'},
+        {'url': 'https://youtu.be/UOeNBCezeCo', 'timestamp_ms': 1_600_000_000_001, 'title': 'A'},
+        {'url': 'https://example.com/?utm_source=feed', 'timestamp_ms': 1_600_000_000_002, 'title': 'B'},
+    ]
+
+    with app.test_client() as client:
+        client.post('/hits/collection', headers=headers, json={'hits': hits})
+        client.post('/hits/collection', headers=headers, json={'hits': [
+            {'url': 'https://example.com/?fbclid=1', 'timestamp_ms': 1_600_000_000_003, 'title': 'B'},
+        ]})
+
+    with app.app_context():
+        visited = {hit.url: hit.visited for hit in Hit.query.all()}
+        assert visited == {
+            'https://www.youtube.com/watch?v=UOeNBCezeCo': 2,
+            'https://example.com/': 2,
+        }
+
+
+def test_store_youtube_watch_without_video(app, headers):
+
+    hits = [
+        {'url': 'https://www.youtube.com/watch?list=PL1', 'timestamp_ms': 1_600_000_000_000, 'title': 'List'},
+        {'url': 'https://www.youtube.com/watch?feature=share', 'timestamp_ms': 1_600_000_000_001, 'title': 'Watch'},
+        {'url': 'https://www.youtube.com/watch?v=UOeNBCezeCo', 'timestamp_ms': 1_600_000_000_002, 'title': 'Video'},
+    ]
+
+    with app.test_client() as client:
+        response = client.post('/hits/collection', headers=headers, json={'hits': hits})
+        assert response.status_code == 200
+
+    with app.app_context():
+        kinds = {hit.url: (hit.link_kind, hit.video_id) for hit in Hit.query.all()}
+        assert kinds == {
+            'https://www.youtube.com/watch?list=PL1': (LinkType.PLAYLIST, None),
+            'https://www.youtube.com/watch': (LinkType.UNKNOWN, None),
+            'https://www.youtube.com/watch?v=UOeNBCezeCo': (LinkType.VIDEO, 'UOeNBCezeCo'),
+        }
+
+
+def test_canonicalize_legacy_hits(app):
+
+    with app.app_context():
+        for i, url in enumerate(['https://example.com/?utm_source=a', 'https://example.com/', 'https://example.com/b']):
+            db.session.add(Hit(
+                url=url,
+                mtime=datetime.datetime.fromtimestamp(1_600_000_000 + i),
+                title='Legacy',
+                visited=2,
+            ))
+        db.session.commit()
+
+        assert canonicalize_hits(batch_size=2) == (2, 1)
+
+        visited = {hit.url: hit.visited for hit in Hit.query.all()}
+        assert visited == {
+            'https://example.com/': 4,
+            'https://example.com/b': 2,
+        }
+
+
+def test_stats_from_rollups(app, headers):
+
+    now = datetime.datetime.now().replace(minute=30)
+    an_hour_ago = now - datetime.timedelta(hours=1)
+
+    def hit(url, mtime):
+        return {'url': url, 'timestamp_ms': mtime.timestamp() * 1000, 'title': 'Stats'}
+
+    with app.app_context():
+        store_hits([
+            hit('https://www.example.com/a', an_hour_ago),
+            hit('https://example.com/b', an_hour_ago),
+            hit('https://example.com/a', now),
+        ])
+        store_hits([hit('https://other.example.org/', now)])
+        db.session.commit()
+
+        assert HitRollup.query.filter_by(granularity='day', domain='').count() in (1, 2)
+
+    with app.test_client() as client:
+        response = client.get('/hits/stats', headers=headers)
+        assert response.status_code == 200
+
+        data = json.loads(response.data.decode())
+        assert data['total'] == 4
+        assert len(data['series']) == 49
+        assert [v for _, v in data['series'][-2:]] == [2, 2]
+        assert data['top_domains'] == [['example.com', 3], ['other.example.org', 1]]
+        assert sum(map(sum, data['heatmap'])) == 4
+
+        data = json.loads(client.get('/hits/stats?granularity=day&domain=example.com&days=7',
+                                     headers=headers).data.decode())
+        assert data['total'] == 3
+        assert len(data['series']) == 8
+
+        assert client.get('/hits/stats?granularity=year', headers=headers).status_code == 400
+
+
+def test_compact_keeps_totals(app):
+
+    now = datetime.datetime.now()
+    old = (now - datetime.timedelta(days=100)).timestamp() * 1000
+
+    with app.app_context():
+        store_hits(generate_hits(5, timestamp_ms=old) + generate_hits(2, timestamp_ms=old))
+        store_hits(generate_hits(3, start=10))
+        db.session.commit()
+
+        before = totals()
+        assert before['visits'] == 10
+
+        assert compact_hits(30, dry_run=True).rows == 5
+        assert Hit.query.count() == 8
+
+        result = compact_hits(30, batch_size=2)
+        assert result.rows == 5
+        assert result.visits == 7
+
+        assert Hit.query.count() == 3
+        assert HitArchive.query.count() == 5
+        assert totals()['visits'] == before['visits']
+
+        #   A revisit ends up in `hits` again and is merged on the next run
+        store_hits(generate_hits(1, timestamp_ms=old))
+        db.session.commit()
+        compact_hits(30)
+
+        assert HitArchive.query.count() == 5
+        assert HitArchive.query.filter_by(url='https://example.com/0').one().visited == 3
+        assert totals()['visits'] == 11
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['data', 'compact', '--days', '30'])
+    assert result.exit_code == 0
+    assert 'Archived 0 hits' in result.output
+
+
+def test_compact_with_reused_hit_id(app):
+
+    old = (datetime.datetime.now() - datetime.timedelta(days=100)).timestamp() * 1000
+
+    with app.app_context():
+        store_hits(generate_hits(1, timestamp_ms=old))
+        db.session.commit()
+        first_id = Hit.query.one().id
+
+        compact_hits(30)
+
+        #   SQLite hands out the ID of the deleted row again
+        store_hits(generate_hits(1, start=1, timestamp_ms=old))
+        db.session.commit()
+        assert Hit.query.one().id == first_id
+
+        assert compact_hits(30).rows == 1
+
+        rows = HitArchive.query.order_by(HitArchive.id).all()
+        assert [row.url for row in rows] == ['https://example.com/0', 'https://example.com/1']
+        assert [row.hit_id for row in rows] == [first_id, first_id]
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_export_streams_hits(app, headers, fmt):
+
+    old = (datetime.datetime.now() - datetime.timedelta(days=10)).timestamp() * 1000
+
+    with app.app_context():
+        store_hits(generate_hits(30, timestamp_ms=old))
+        store_hits(generate_hits(5, start=100))
+        db.session.commit()
+
+    with app.test_client() as client:
+        response = client.get('/hits/export?format={}'.format(fmt), headers=headers)
+        assert response.status_code == 200
+        assert response.is_streamed
+
+        lines = response.data.decode().splitlines()
+        if fmt == 'csv':
+            assert lines[0] == 'id,url,title,mtime,timestamp_ms,visited,archived'
+            lines = lines[1:]
+            assert lines[0].split(',')[1] == 'https://example.com/0'
+        else:
+            rows = [json.loads(line) for line in lines]
+            assert rows[0]['url'] == 'https://example.com/0'
+            assert rows[-1]['url'] == 'https://example.com/104'
+
+        assert len(lines) == 35
+
+        since = int((datetime.datetime.now() - datetime.timedelta(days=1)).timestamp() * 1000)
+        response = client.get('/hits/export?format={}&since={}'.format(fmt, since),
+                              headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+        assert response.headers['Content-Encoding'] == 'gzip'
+        lines = gzip.decompress(response.data).decode().splitlines()
+        assert len(lines) == 5 + (fmt == 'csv')
+
+        assert client.get('/hits/export?since=yesterday', headers=headers).status_code == 400
+        assert client.get('/hits/export?format=xml', headers=headers).status_code == 400
+
+
+def test_export_cli_round_trip(app, tmp_path):
+
+    old = (datetime.datetime.now() - datetime.timedelta(days=100)).timestamp() * 1000
+    recent = (datetime.datetime.now() - datetime.timedelta(days=1)).timestamp() * 1000
+
+    with app.app_context():
+        store_hits(generate_hits(20, timestamp_ms=recent))
+        store_hits(generate_hits(5))
+        store_hits(generate_hits(3, start=100, timestamp_ms=old))
+        db.session.commit()
+        compact_hits(30)
+
+        before = totals()
+        rollups = HitRollup.query.count()
+
+    filename = tmp_path / 'hits.ndjson.gz'
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['data', 'export', str(filename)])
+    assert result.exit_code == 0, result.output
+
+    with gzip.open(filename, 'rt') as f:
+        rows = [json.loads(line) for line in f]
+
+    #   The compacted hits are the oldest ones
+    order = [100, 101, 102] + list(range(5, 20)) + list(range(5))
+    assert [r['url'] for r in rows] == ['https://example.com/{}'.format(i) for i in order]
+    assert [r['archived'] for r in rows[:4]] == [True, True, True, False]
+
+    with app.app_context():
+        db.session.query(Hit).delete()
+        db.session.query(HitArchive).delete()
+        db.session.commit()
+
+    result = runner.invoke(args=['data', 'import', str(filename)])
+    assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        assert totals() == before
+        assert Hit.query.filter_by(url='https://example.com/0').one().visited == 2
+
+    #   Importing the same export again changes nothing
+    result = runner.invoke(args=['data', 'import', str(filename)])
+    assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        assert totals() == before
+        assert HitRollup.query.count() == rollups
+
+    #   The last row is the boundary of the next incremental export
+    since = rows[-1]['timestamp_ms']
+    result = runner.invoke(args=['data', 'export', '--since', str(since), str(tmp_path / 'next.ndjson')])
+    assert result.exit_code == 0, result.output
+    assert (tmp_path / 'next.ndjson').read_text() == ''
+
+
+def test_source_version_covers_templates(tmp_path):
+
+    templates = tmp_path / 'hits' / 'templates'
+    templates.mkdir(parents=True)
+
+    template = SOURCE_DIRECTORY / 'hits' / 'templates' / 'hits-dashboard.jinja2'
+    (templates / template.name).write_bytes(template.read_bytes())
+
+    version = source_version(tmp_path)
+    assert source_version(tmp_path) == version
+
+    #   A deploy that only changes markup changes every ETag
+    with (templates / template.name).open('a') as f:
+        f.write('<!-- changed -->\n')
+
+    assert source_version(tmp_path) != version
+
+
+def test_current_is_conditional(app, headers, monkeypatch):
+
+    with app.app_context():
+        store_hits(generate_hits(5))
+        db.session.commit()
+        engine = db.engine
+
+    with app.test_client() as client:
+        response = client.get('/hits/current', headers=headers)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert 'Last-Modified' not in response.headers
+
+        with StatementCounter(engine) as counter:
+            response = client.get('/hits/current', headers=dict(headers, **{'If-None-Match': etag}))
+
+        assert response.status_code == 304
+        assert response.data == b''
+        #   authentication (2) and the generations (1)
+        assert counter.count <= 3
+
+        #   A new hit changes the answer
+        with app.app_context():
+            store_hits(generate_hits(1, start=5))
+            db.session.commit()
+
+        response = client.get('/hits/current', headers=dict(headers, **{'If-None-Match': etag}))
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert len(json.loads(response.data.decode())['queue']) == 6
+
+        #   So does a new archive entry
+        etag = response.headers['ETag']
+        with app.app_context():
+            db.session.add(Archive(source='youtube', name='abcdefghijk'))
+            Generation.bump(Generation.ARCHIVE)
+            db.session.commit()
+
+        response = client.get('/hits/current', headers=dict(headers, **{'If-None-Match': etag}))
+        assert response.status_code == 200
+
+        #   Without If-None-Match the body comes from the response cache
+        hits = response_cache.hits
+        assert client.get('/hits/current', headers=headers).data == response.data
+        assert response_cache.hits == hits + 1
+
+        response = client.get('/hits/dashboard', headers=headers)
+        assert response.status_code == 200
+        response = client.get('/hits/dashboard', headers=dict(headers, **{'If-None-Match': response.headers['ETag']}))
+        assert response.status_code == 304
+
+        #   A deploy with other code or templates renders again
+        etag = response.headers['ETag']
+        monkeypatch.setattr(response_cache, 'version', 'next')
+        response = client.get('/hits/dashboard', headers=dict(headers, **{'If-None-Match': etag}))
+        assert response.status_code == 200
+
+
+def test_link_metadata_columns(app, headers):
+
+    with app.app_context():
+        store_hits([
+            {'url': 'https://youtu.be/video000001', 'timestamp_ms': 1_600_000_000_000, 'title': 'One'},
+            {'url': 'https://www.youtube.com/watch?v=video000002', 'timestamp_ms': 1_600_000_000_001, 'title': 'Two'},
+            {'url': 'https://example.com/', 'timestamp_ms': 1_600_000_000_002, 'title': 'Other'},
+        ])
+        db.session.add(Archive(source='youtube', name='video000002'))
+        db.session.commit()
+
+        hit = Hit.query.filter_by(video_id='video000001').one()
+        assert hit.link_hoster == 'youtube'
+        assert hit.link.kind == LinkType.VIDEO
+        assert Hit.query.filter_by(url='https://example.com/').one().link_kind == LinkType.UNKNOWN
+
+        assert [row.video_id for row in Hit.unarchived_videos('youtube', 10)] == ['video000001']
+
+        #   Rows from before the columns get them from the backfill
+        db.session.query(Hit).update({'link_kind': None, 'link_hoster': None, 'video_id': None})
+        db.session.commit()
+        assert backfill_link_metadata(batch_size=2) == 3
+        assert Hit.query.filter_by(link_hoster='youtube').count() == 2
+
+    with app.test_client() as client:
+        data = json.loads(client.get('/hits/videos/unarchived', headers=headers).data.decode())
+        assert [v['video_id'] for v in data['videos']] == ['video000001']
+
+        assert client.get('/hits/videos/unarchived?hoster=vimeo', headers=headers).status_code == 400
+
+
+def test_thumbnail_placeholder(app, headers):
+
+    with app.app_context():
+        store_hits([{'url': 'https://example.com/', 'timestamp_ms': 1_600_000_000_000, 'title': 'Other'}])
+        db.session.commit()
+        hit_id = Hit.query.one().id
+
+    with app.test_client() as client:
+        response = client.get('/hits/thumbnail/{}'.format(hit_id), headers=headers)
+        assert response.status_code == 200
+        assert response.mimetype == 'image/jpeg'
+        assert response.headers['X-Thumbnail'] == 'placeholder'
+
+        response = client.get('/hits/thumbnail/{}'.format(hit_id + 1), headers=headers)
+        assert response.status_code == 404
+        assert response.mimetype == 'image/jpeg'
+
+
+def test_thumbnail_renditions(app, headers, tmp_path, monkeypatch):
+
+    def preview_stream(self, result=None):
+        f = io.BytesIO()
+        Image.new('RGB', (1280, 720), 'red').save(f, format='JPEG')
+        f.seek(0)
+        return f
+
+    monkeypatch.setattr(Youtube, 'preview_stream', preview_stream)
+
+    app.config['THUMBNAIL_CACHE_DIRECTORY'] = tmp_path
+    thumbnail_cache.init_app(app)
+
+    with app.app_context():
+        store_hits([{'url': 'https://youtu.be/video000001', 'timestamp_ms': 1_600_000_000_000, 'title': 'Video'}])
+        db.session.commit()
+        hit_id = Hit.query.one().id
+
+    with app.test_client() as client:
+        url = '/hits/thumbnail/{}'.format(hit_id)
+
+        response = client.get(url, headers=dict(headers, Accept='image/webp,*/*'))
+        assert response.status_code == 200
+        assert response.mimetype == 'image/webp'
+        assert response.data.startswith(b'RIFF')
+        assert 'Accept' in response.headers['Vary']
+
+        response = client.get(url + '?scale=2', headers=dict(headers, Accept='*/*'))
+        assert response.mimetype == 'image/jpeg'
+        assert Image.open(io.BytesIO(response.data)).size == (512, 288)
+
+        response = client.get(url + '?size=64', headers=headers)
+        assert response.status_code == 400
+
+
+def test_sprite(app, headers, tmp_path, monkeypatch):
+    previews = []
+
+    def fetch_many(urls):
+        results = {}
+        for url in urls:
+            previews.append(url)
+            f = io.BytesIO()
+            Image.new('RGB', (1280, 720), 'red').save(f, format='JPEG')
+            f.seek(0)
+            results[url] = FetchResult(url, status_code=200, stream=f)
+        return results
+
+    #   All previews of a sprite are downloaded in one batch
+    monkeypatch.setattr(fetcher, 'fetch_many', fetch_many)
+
+    app.config['THUMBNAIL_CACHE_DIRECTORY'] = tmp_path
+    thumbnail_cache.init_app(app)
+
+    with app.app_context():
+        store_hits([
+            {'url': 'https://youtu.be/video000001', 'timestamp_ms': 1_600_000_000_000, 'title': 'One'},
+            {'url': 'https://youtu.be/video000002', 'timestamp_ms': 1_600_000_000_001, 'title': 'Two'},
+            {'url': 'https://example.com/', 'timestamp_ms': 1_600_000_000_002, 'title': 'Other'},
+        ])
+        db.session.commit()
+        ids = [hit.id for hit in Hit.query.order_by(Hit.id)]
+
+    query = 'ids={}'.format(','.join(map(str, ids)))
+
+    with app.test_client() as client:
+        data = json.loads(client.get('/hits/sprite.json?' + query, headers=headers).data.decode())
+        assert (data['width'], data['height']) == (384, 128)
+        assert data['tiles'][str(ids[1])] == {'x': 128, 'y': 0, 'width': 128, 'height': 128}
+
+        response = client.get('/hits/sprite?{}&scale=2'.format(query), headers=dict(headers, Accept='image/webp'))
+        assert response.status_code == 200
+        assert response.mimetype == 'image/webp'
+
+        with Image.open(io.BytesIO(response.data)) as image:
+            assert image.size == (768, 256)
+            #   Red thumbnails, centered in their cells, and the grey placeholder
+            assert image.convert('RGB').getpixel((128, 128))[0] > 200
+            assert image.convert('RGB').getpixel((640, 128))[1] > 150
+
+        assert sorted(previews) == ['https://i.ytimg.com/vi/video00000{}/maxresdefault.jpg'.format(i) for i in (1, 2)]
+
+        #   The sprite is cached under its ID list and videos
+        assert client.get('/hits/sprite?{}&scale=2'.format(query),
+                          headers=dict(headers, Accept='image/webp')).data == response.data
+
+        #   A broken thumbnail in the cache is a placeholder, not an error
+        cache = thumbnail_cache.handle()
+        for key in list(cache.iterkeys()):
+            if not key.startswith(('lock-', 'missing-')):
+                cache.set(key, io.BytesIO(b'garbage'), read=True)
+
+        response = client.get('/hits/sprite?' + query, headers=headers)
+        assert response.status_code == 200
+        with Image.open(io.BytesIO(response.data)) as image:
+            assert image.convert('RGB').getpixel((64, 64))[1] > 150
+
+        response = client.get('/hits/dashboard', headers=headers)
+        assert response.data.decode().count('sprite-tile" style') == 2
+
+        assert client.get('/hits/sprite?ids=', headers=headers).status_code == 400
+        assert client.get('/hits/sprite?ids=a,b', headers=headers).status_code == 400
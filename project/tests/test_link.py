@@ -1,9 +1,16 @@
 # project/tests/test_link.py
 
+import io
+import threading
+import time
+
 import pytest
 from diskcache import Cache
+from PIL import Image
 
-from project.server.link import factory, Youtube, LinkType
+import project.server.link
+from project.server.link import factory, Youtube, LinkType, canonical_url, url_key, \
+    THUMBNAIL_MISSING_TTL
 
 
 @pytest.fixture
@@ -20,3 +27,94 @@ def test_link(cache):
 
     h = l.thumbnail_image_stream(cache)
 
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://www.youtube.com/watch?v=UOeNBCezeCo&t=42s&feature=share', 'https://www.youtube.com/watch?v=UOeNBCezeCo'),
+    ('https://youtu.be/UOeNBCezeCo?si=abc', 'https://www.youtube.com/watch?v=UOeNBCezeCo'),
+    ('https://www.youtube.com/watch?list=PL1&v=UOeNBCezeCo&index=3', 'https://www.youtube.com/watch?list=PL1&v=UOeNBCezeCo'),
+    ('HTTPS://Example.COM:443/a?utm_source=x&fbclid=y&b=2&a=1#top', 'https://example.com/a?a=1&b=2'),
+    ('http://example.com:8080', 'http://example.com:8080/'),
+    ('https://app.example.com/#/inbox', 'https://app.example.com/#/inbox'),
+    ('about:blank', 'about:blank'),
+    ('http://[::1]:8080/a', 'http://[::1]:8080/a'),
+    ('http://user@[2001:DB8::1]/', 'http://user@[2001:db8::1]/'),
+    ('https://example.com/?flag&b=&a=1', 'https://example.com/?a=1&b=&flag'),
+    ('https://example.com/?q=a+b%26c', 'https://example.com/?q=a+b%26c'),
+])
+def test_canonical_url(url, expected):
+    assert canonical_url(url) == expected
+
+
+def test_url_key():
+    assert len(url_key('https://example.com/')) == 32
+    assert url_key(canonical_url('https://example.com/?utm_medium=x')) == url_key(canonical_url('https://EXAMPLE.com'))
+
+
+def test_thumbnail_single_flight(tmp_path, monkeypatch):
+    downloads = []
+
+    def preview_stream(self, result=None):
+        downloads.append(self.video_id)
+        time.sleep(0.2)
+
+        f = io.BytesIO()
+        Image.new('RGB', (640, 360), 'red').save(f, format='JPEG')
+        f.seek(0)
+        return f
+
+    monkeypatch.setattr(Youtube, 'preview_stream', preview_stream)
+
+    link = factory('https://www.youtube.com/watch?v=UOeNBCezeCo')
+    sizes = []
+
+    def request():
+        #   Every thread opens its own handle like a separate process would
+        with Cache(tmp_path) as cache:
+            with link.thumbnail_image_stream(cache) as f:
+                sizes.append(Image.open(f).size)
+
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert downloads == ['UOeNBCezeCo']
+    assert sizes == [(256, 144)] * 5
+
+
+def test_thumbnail_negative_cache(tmp_path, monkeypatch):
+    lookups = []
+    now = [1_000_000.0]
+
+    def preview_stream(self, result=None):
+        lookups.append(self.video_id)
+        return None
+
+    monkeypatch.setattr(Youtube, 'preview_stream', preview_stream)
+    monkeypatch.setattr(project.server.link.time, 'time', lambda: now[0])
+
+    link = factory('https://www.youtube.com/watch?v=UOeNBCezeCo')
+
+    with Cache(tmp_path) as cache:
+        assert link.thumbnail_image_stream(cache) is None
+        assert link.thumbnail_image_stream(cache) is None
+        assert lookups == ['UOeNBCezeCo']
+
+        #   Asked again after the TTL, then the TTL doubles
+        now[0] += THUMBNAIL_MISSING_TTL
+        assert link.thumbnail_image_stream(cache) is None
+        assert len(lookups) == 2
+
+        now[0] += THUMBNAIL_MISSING_TTL
+        assert link.thumbnail_image_stream(cache) is None
+        assert len(lookups) == 2
+
+        now[0] += THUMBNAIL_MISSING_TTL
+        assert link.thumbnail_image_stream(cache) is None
+        assert len(lookups) == 3
+
+        #   Links without a video don't even look
+        assert factory('https://example.com/').thumbnail_image_stream(cache) is None
+        assert len(lookups) == 3
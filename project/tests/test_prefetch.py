@@ -0,0 +1,104 @@
+# project/tests/test_prefetch.py
+
+import io
+import threading
+
+import pytest
+
+import project.server.startup
+from project.server.database import db
+from project.server.ingest import store_hits
+from project.server.link import LinkType, Youtube
+from project.server.prefetch import ThumbnailPrefetcher
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = project.server.startup.create_app(testing=True)
+    app.config.update({
+        'THUMBNAIL_PREFETCH': True,
+        'THUMBNAIL_PREFETCH_WORKERS': 1,
+        'THUMBNAIL_PREFETCH_QUEUE': 2,
+        'THUMBNAIL_PREFETCH_RETRIES': 2,
+        'THUMBNAIL_PREFETCH_RETRY_DELAY': 0,
+    })
+    return app
+
+
+@pytest.fixture
+def prefetcher(app, tmp_path):
+    prefetcher = ThumbnailPrefetcher()
+    prefetcher.init_app(app)
+    prefetcher.cache_directory = tmp_path / 'cache'
+    return prefetcher
+
+
+def video(video_id):
+    return ('https://www.youtube.com/watch?v={}'.format(video_id), int(LinkType.VIDEO), 'youtube', video_id)
+
+
+def test_prefetch_retries(prefetcher, monkeypatch):
+    calls = []
+
+    def thumbnail_image_stream(self, cache):
+        calls.append(self.video_id)
+        if len(calls) < 3:
+            raise ConnectionError('flaky')
+        return io.BytesIO(b'jpeg')
+
+    monkeypatch.setattr(Youtube, 'thumbnail_image_stream', thumbnail_image_stream)
+
+    assert prefetcher.enqueue(*video('video000001'))
+    prefetcher.queue.join()
+
+    assert calls == ['video000001'] * 3
+    assert prefetcher.stats()['done'] == 1
+    assert prefetcher.stats()['retried'] == 2
+    assert prefetcher.stats()['queue_depth'] == 0
+
+
+def test_prefetch_queue_is_bounded(prefetcher, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def thumbnail_image_stream(self, cache):
+        started.set()
+        release.wait(5)
+        return None
+
+    monkeypatch.setattr(Youtube, 'thumbnail_image_stream', thumbnail_image_stream)
+
+    #   One link in the worker, two in the queue, the fourth is dropped
+    assert prefetcher.enqueue(*video('video000001'))
+    started.wait(5)
+    assert prefetcher.enqueue(*video('video000002'))
+    assert prefetcher.enqueue(*video('video000002'))
+    assert prefetcher.enqueue(*video('video000003'))
+    assert not prefetcher.enqueue(*video('video000004'))
+
+    stats = prefetcher.stats()
+    assert stats['queue_depth'] == 2
+    assert stats['busy'] == 1
+    assert stats['dropped'] == 1
+
+    release.set()
+    prefetcher.queue.join()
+    assert prefetcher.stats()['done'] == 3
+
+
+def test_store_hits_enqueues_new_videos(app, monkeypatch):
+    queued = []
+
+    monkeypatch.setattr('project.server.ingest.thumbnail_prefetcher.enqueue', lambda *args: queued.append(args))
+
+    hits = [
+        {'url': 'https://youtu.be/video000001', 'timestamp_ms': 1_600_000_000_000, 'title': 'Video'},
+        {'url': 'https://example.com/', 'timestamp_ms': 1_600_000_000_001, 'title': 'Other'},
+    ]
+
+    with app.app_context():
+        store_hits(hits)
+        store_hits(hits)
+        db.session.commit()
+
+    assert queued == [video('video000001')]
@@ -0,0 +1,72 @@
+# project/tests/test_renditions.py
+
+import io
+import math
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from project.server.renditions import Rendition, negotiate_format
+
+
+def photo(size=(640, 360)):
+    image = Image.new('RGB', size)
+    pixels = image.load()
+
+    for x in range(size[0]):
+        for y in range(size[1]):
+            pixels[x, y] = (x * 255 // size[0], y * 255 // size[1], int(128 + 127 * math.sin(x / 40 + y / 60)))
+
+    return image
+
+
+@pytest.mark.parametrize('accept, expected', [
+    ('image/avif,image/webp,*/*', 'webp'),
+    ('image/webp;q=0.5,image/png', 'png'),
+    ('image/png,image/jpeg', 'jpeg'),
+    ('*/*', 'jpeg'),
+    ('', 'jpeg'),
+])
+def test_negotiate_format(accept, expected):
+    assert negotiate_format(parse_accept_header(accept, MIMEAccept)) == expected
+
+
+@pytest.mark.parametrize('fmt, magic', [
+    ('webp', b'RIFF'),
+    ('jpeg', b'\xff\xd8'),
+    ('png', b'\x89PNG'),
+])
+@pytest.mark.parametrize('size, scale', [(128, 1), (256, 2), (512, 1)])
+def test_render(fmt, magic, size, scale):
+    rendition = Rendition(size=size, scale=scale, fmt=fmt)
+
+    data = rendition.render(photo())
+    assert data.startswith(magic)
+
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.get_format_mimetype() == rendition.mimetype
+        assert max(image.size) == size * scale
+
+
+def test_render_flattens_transparency_for_jpeg():
+    image = Image.new('RGBA', (300, 300), (0, 0, 0, 0))
+
+    with Image.open(io.BytesIO(Rendition(fmt='jpeg').render(image))) as jpeg:
+        assert jpeg.getpixel((0, 0)) == (255, 255, 255)
+
+    with Image.open(io.BytesIO(Rendition(fmt='png').render(image))) as png:
+        assert png.mode == 'RGBA'
+
+
+def test_webp_is_smaller():
+    image = photo()
+    assert len(Rendition(fmt='webp').render(image)) < len(Rendition(fmt='jpeg').render(image))
+
+
+def test_invalid_rendition():
+    with pytest.raises(ValueError):
+        Rendition(size=100)
+    with pytest.raises(ValueError):
+        Rendition(scale=3)
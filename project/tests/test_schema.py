@@ -0,0 +1,108 @@
+# project/tests/test_schema.py
+
+import time
+
+import jwt
+import pytest
+from sqlalchemy import create_engine, inspect
+
+import project.server.models  # noqa: F401, registers the tables
+from project.server.database import db
+from project.server.models import token_digest
+from project.server.schema import upgrade_schema
+
+#   `hits` as created before the canonical URLs, with the unique URL index
+#   of the first batch upsert
+OLD_HITS = [
+    "CREATE TABLE hits ("
+    "id INTEGER NOT NULL PRIMARY KEY, url VARCHAR(512) NOT NULL, mtime DATETIME NOT NULL, "
+    "title VARCHAR(512) NOT NULL, download BOOLEAN NOT NULL, deleted BOOLEAN NOT NULL, "
+    "visited INTEGER NOT NULL, order_id INTEGER)",
+    "CREATE UNIQUE INDEX ix_hits_url ON hits (url)",
+    "INSERT INTO hits (url, mtime, title, download, deleted, visited) "
+    "VALUES ('https://example.com/', '2020-01-01 00:00:00', 'Example', 0, 0, 3)",
+]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'old.db'))
+
+    with engine.begin() as connection:
+        for statement in OLD_HITS:
+            connection.exec_driver_sql(statement)
+
+    yield engine
+
+    engine.dispose()
+
+
+def test_upgrade_existing_hits(engine):
+    with engine.begin() as connection:
+        db.metadata.create_all(connection)
+        changes = upgrade_schema(connection)
+
+    assert 'Dropped the index ix_hits_url' in changes
+    assert 'Added the column hits.url_key' in changes
+
+    inspector = inspect(engine)
+    columns = {column['name'] for column in inspector.get_columns('hits')}
+    indexes = {index['name']: index for index in inspector.get_indexes('hits')}
+
+    assert {'url_key', 'link_kind', 'link_hoster', 'video_id'} <= columns
+    assert indexes['ix_hits_url_key']['unique']
+    assert {'ix_hits_mtime_id', 'ix_hits_hoster_video'} <= set(indexes)
+    assert 'ix_hits_url' not in indexes
+
+    #   The ingest upsert needs the unique key
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO hits (url, url_key, mtime, title, download, deleted, visited) "
+            "VALUES ('https://example.com/', 'k', '2020-01-02 00:00:00', 'Example', 0, 0, 1) "
+            "ON CONFLICT(url_key) DO UPDATE SET visited = visited + excluded.visited")
+
+    with engine.begin() as connection:
+        assert upgrade_schema(connection) == []
+
+
+def test_upgrade_blacklist_tokens(engine):
+    valid = jwt.encode({'exp': int(time.time()) + 3600, 'sub': 1}, 'secret', algorithm='HS256')
+    expired = jwt.encode({'exp': int(time.time()) - 3600, 'sub': 1}, 'secret', algorithm='HS256')
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE blacklist_tokens (id INTEGER NOT NULL PRIMARY KEY, "
+            "token VARCHAR(500) NOT NULL UNIQUE, blacklisted_on DATETIME NOT NULL)")
+        connection.exec_driver_sql(
+            "INSERT INTO blacklist_tokens (token, blacklisted_on) VALUES (?, '2020-01-01 00:00:00'), "
+            "(?, '2020-01-01 00:00:00'), ('garbage', '2020-01-01 00:00:00')", (valid, expired))
+
+        db.metadata.create_all(connection)
+        changes = upgrade_schema(connection)
+
+    assert 'Rebuilt blacklist_tokens with 1 of 3 tokens, the others had expired' in changes
+
+    with engine.begin() as connection:
+        rows = connection.exec_driver_sql('SELECT digest, exp FROM blacklist_tokens').all()
+        assert [digest for digest, exp in rows] == [token_digest(valid)]
+
+        assert upgrade_schema(connection) == []
+
+
+def test_upgrade_archive_with_duplicates(engine):
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE archive (id INTEGER NOT NULL PRIMARY KEY, source TEXT NOT NULL, name TEXT NOT NULL)")
+        connection.exec_driver_sql(
+            "INSERT INTO archive (source, name) VALUES "
+            "('youtube', 'abcdefghijk'), ('youtube', 'abcdefghijk'), ('youtube', 'bcdefghijkl')")
+
+        db.metadata.create_all(connection)
+        changes = upgrade_schema(connection)
+
+    assert 'Removed 1 rows of archive that ix_archive_source_name refuses' in changes
+    assert 'Created the index ix_archive_source_name' in changes
+
+    with engine.begin() as connection:
+        rows = connection.exec_driver_sql('SELECT id, name FROM archive ORDER BY id').all()
+        assert rows == [(1, 'abcdefghijk'), (3, 'bcdefghijkl')]
@@ -0,0 +1,63 @@
+# project/tests/test_video_index.py
+
+import os
+
+import pytest
+
+import project.server.startup
+from project.server.video_index import VideoIndex
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = project.server.startup.create_app(testing=True)
+    app.config.update({
+        'VIDEO_ARCHIVE_DIRECTORY': tmp_path,
+        'VIDEO_INDEX_REFRESH_INTERVAL': 0,
+    })
+    return app
+
+
+@pytest.fixture
+def index(app):
+    index = VideoIndex()
+    index.init_app(app)
+    return index
+
+
+def test_video_id_of():
+    assert VideoIndex.video_id_of('Some Title-UOeNBCezeCo.mp4') == 'UOeNBCezeCo'
+    assert VideoIndex.video_id_of('Some Title [UOeNBCezeCo].webm') == 'UOeNBCezeCo'
+    assert VideoIndex.video_id_of('Some Title-UOeNBCezeCo.mp4.part') is None
+    assert VideoIndex.video_id_of('notes.txt') is None
+
+
+def test_index_refreshes_changed_directories(tmp_path, index):
+    (tmp_path / 'channel').mkdir()
+    (tmp_path / 'First-AAAAAAAAAAA.mp4').touch()
+    (tmp_path / 'channel' / 'Second [BBBBBBBBBBB].mkv').touch()
+
+    assert index.contains('AAAAAAAAAAA')
+    assert index.contains('BBBBBBBBBBB')
+    assert not index.contains('CCCCCCCCCCC')
+
+    (tmp_path / 'channel' / 'Third-CCCCCCCCCCC.mp4').touch()
+    os.utime(tmp_path / 'channel', ns=(0, 1))
+    assert index.contains('CCCCCCCCCCC')
+
+    (tmp_path / 'First-AAAAAAAAAAA.mp4').unlink()
+    os.utime(tmp_path, ns=(0, 2))
+    assert not index.contains('AAAAAAAAAAA')
+    assert index.stats()['videos'] == 2
+
+
+def test_index_skips_unchanged_directories(tmp_path, index, monkeypatch):
+    (tmp_path / 'First-AAAAAAAAAAA.mp4').touch()
+    assert index.contains('AAAAAAAAAAA')
+
+    scanned = []
+    original_scan = index._scan
+    monkeypatch.setattr(index, '_scan', lambda *args: scanned.append(args) or original_scan(*args))
+
+    assert index.contains('AAAAAAAAAAA')
+    assert scanned == []
@@ -9,7 +9,7 @@ from flask_restful import Resource, url_for
 from marshmallow import Schema, fields, ValidationError
 
 from project.server.database import db
-from project.server.models import Worker, Archive
+from project.server.models import Worker, Archive, Generation
 
 logger = logging.getLogger()
 
@@ -100,6 +100,7 @@ class REST_Result(Resource):
             )
 
             db.session.add(archive)
+            Generation.bump(Generation.ARCHIVE)
 
         db.session.commit()
 